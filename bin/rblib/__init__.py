@@ -4,23 +4,98 @@
 # Copyright © 2015-2017 Holger Levsen <holger@layer-acht.org>
 # Licensed under GPL-2
 
-from sqlalchemy import Table, text
-from sqlalchemy.exc import NoSuchTableError, OperationalError
+import os
+import pickle
+import tempfile
+
+from sqlalchemy import Table, MetaData, text
+from sqlalchemy.exc import DBAPIError, NoSuchTableError, OperationalError
 
 from .confparse import log
-from .const import PGDATABASE, DB_METADATA, conn_db
+from .const import (
+    PGDATABASE, DB_METADATA, DB_METADATA_CACHE, conn_db, db_engine, _database,
+)
 from .utils import print_critical_message
 
 
+# number of rows fetched at a time by query_db_iter()
+QUERY_FETCH_SIZE = 1000
+
+
+def reconnect_db():
+    """Open a new database connection for the current thread.
+
+    Every process and thread gets its own connection anyway (see
+    rblib.const), so this is only needed to get rid of a broken one.
+    """
+    _database.release()
+    _database.connection()
+
+
+_metadata_loaded = False
+
+
+def _schema_version():
+    try:
+        return query_db('SELECT MAX(version) FROM rb_schema')[0][0]
+    except DBAPIError:  # no schema yet
+        return None
+
+
+def _load_metadata():
+    """Fill DB_METADATA with the definitions of all the tables.
+
+    They are read from DB_METADATA_CACHE if it was written for the current
+    version of the schema, otherwise the whole schema is reflected once and
+    the cache is written again.
+    """
+    global _metadata_loaded
+    _metadata_loaded = True
+    version = _schema_version()
+    if version is None:
+        return
+    try:
+        with open(DB_METADATA_CACHE, 'rb') as f:
+            cached_version, metadata = pickle.load(f)
+    except Exception as e:
+        log.debug('Could not read the tables definitions cache: %s', e)
+        cached_version = None
+    if cached_version != version:
+        log.info('Caching the definitions of the tables of schema version '
+                 '%s', version)
+        metadata = MetaData()
+        metadata.reflect(bind=db_engine())
+        try:
+            fd, tmpfile = tempfile.mkstemp(
+                dir=os.path.dirname(DB_METADATA_CACHE))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((version, metadata), f)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, DB_METADATA_CACHE)
+        except (OSError, pickle.PicklingError) as e:
+            log.warning('Could not write the tables definitions cache: %s', e)
+    for table in metadata.sorted_tables:
+        if table.name not in DB_METADATA.tables:
+            table.tometadata(DB_METADATA)
+
+
 def db_table(table_name):
     """Returns a SQLAlchemy Table objects to be used in queries
     using SQLAlchemy's Expressive Language.
 
+    The definitions come from a cache (see _load_metadata()), the tables
+    missing there are loaded from the database.
+
     Arguments:
         table_name: a string corrosponding to an existing table name
     """
+    if not _metadata_loaded:
+        _load_metadata()
+    if table_name in DB_METADATA.tables:
+        return DB_METADATA.tables[table_name]
     try:
-        return Table(table_name, DB_METADATA, autoload=True)
+        return Table(table_name, DB_METADATA, autoload=True,
+                     autoload_with=db_engine())
     except NoSuchTableError:
         log.error(
             "Table %s does not exist or schema for %s could not be loaded",
@@ -53,6 +128,30 @@ def query_db(query, *args, **kwargs):
         return None
 
 
+def query_db_iter(query, *args, fetch_size=QUERY_FETCH_SIZE, **kwargs):
+    """Excutes a raw SQL select, and yields its rows one at a time.
+
+    Unlike query_db(), the rows are not all loaded in memory: they are read
+    from a server side cursor fetch_size rows at a time, so this is the way
+    to go through large tables.  As the cursor lives in the current
+    transaction, nothing must be committed until the iteration is over.
+    """
+    try:
+        result = conn_db.execution_options(stream_results=True).execute(
+            query, *args, **kwargs)
+    except OperationalError as ex:
+        print_critical_message('Error executing this query:\n' + str(query))
+        raise
+    try:
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        result.close()
+
+
 def get_trailing_bug_icon(bug, bugs, package=None):
     html = ''
     if not package:
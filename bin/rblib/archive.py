@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Local cache of the archive indexes (the Sources files).
+#
+# The Sources files are kept uncompressed under TEMP_PATH, one directory per
+# suite, and shared by all the jobs running on the host.  They are
+# revalidated against the mirror with a conditional GET (ETag and
+# If-Modified-Since), so they are downloaded and decompressed only when the
+# archive changed.  If `archive_local_mirror` is set in the configuration,
+# they are taken from that local mirror directory instead, without any
+# network access.
+
+import os
+import json
+import lzma
+import fcntl
+import shutil
+from contextlib import contextmanager
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from .confparse import log, conf_distro
+from .const import TEMP_PATH
+
+
+ARCHIVE_MIRROR = conf_distro.get('archive_mirror',
+                                 'http://deb.debian.org/debian')
+ARCHIVE_LOCAL_MIRROR = conf_distro.get('archive_local_mirror')
+ARCHIVE_CACHE_PATH = os.path.join(TEMP_PATH, 'archive-cache')
+
+
+def _sources_index(suite, component='main'):
+    return os.path.join('dists', suite, component, 'source', 'Sources.xz')
+
+
+def _decompress(fileobj, destfile):
+    # decompress in a temporary file renamed in place at the end, so that a
+    # reader never sees a half written file
+    tmpfile = destfile + '.new'
+    with lzma.open(fileobj) as src, open(tmpfile, 'wb') as dest:
+        shutil.copyfileobj(src, dest, 1024*1024)
+    os.replace(tmpfile, destfile)
+
+
+@contextmanager
+def _locked(directory):
+    # only one process at a time updates the files of a suite
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'w') as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _load_meta(metafile):
+    try:
+        with open(metafile) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_meta(metafile, meta):
+    with open(metafile + '.new', 'w') as fd:
+        json.dump(meta, fd)
+    os.replace(metafile + '.new', metafile)
+
+
+def _update_from_local_mirror(suite, component, destfile, meta):
+    srcfile = os.path.join(ARCHIVE_LOCAL_MIRROR,
+                           _sources_index(suite, component))
+    mtime = os.stat(srcfile).st_mtime
+    if os.path.exists(destfile) and meta.get('mtime') == mtime:
+        log.info('Sources file for %s is up to date (local mirror)', suite)
+        return meta
+    log.info('Decompressing sources file for %s: %s', suite, srcfile)
+    with open(srcfile, 'rb') as fd:
+        _decompress(fd, destfile)
+    return {'mtime': mtime}
+
+
+def _update_from_mirror(suite, component, destfile, meta):
+    remotefile = ARCHIVE_MIRROR + '/' + _sources_index(suite, component)
+    request = Request(remotefile)
+    if os.path.exists(destfile):
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last-modified'):
+            request.add_header('If-Modified-Since', meta['last-modified'])
+    log.info('Downloading sources file for %s: %s', suite, remotefile)
+    try:
+        with urlopen(request) as response:
+            _decompress(response, destfile)
+            return {'etag': response.headers.get('ETag'),
+                    'last-modified': response.headers.get('Last-Modified')}
+    except HTTPError as e:
+        if e.code == 304:
+            log.info('Sources file for %s not modified, using the cached one',
+                     suite)
+            return meta
+        if not os.path.exists(destfile):
+            raise
+        log.warning('Failed to download %s (%s), using the cached copy',
+                    remotefile, e)
+    except URLError as e:
+        if not os.path.exists(destfile):
+            raise
+        log.warning('Failed to download %s (%s), using the cached copy',
+                    remotefile, e)
+    return meta
+
+
+def sources_file(suite, component='main'):
+    """
+    Return the path of the uncompressed Sources file of suite, after making
+    sure it is up to date with the archive.
+    """
+    directory = os.path.join(ARCHIVE_CACHE_PATH, suite, component)
+    destfile = os.path.join(directory, 'Sources')
+    metafile = os.path.join(directory, 'Sources.meta')
+    with _locked(directory):
+        meta = _load_meta(metafile)
+        if ARCHIVE_LOCAL_MIRROR:
+            new_meta = _update_from_local_mirror(suite, component, destfile,
+                                                 meta)
+        else:
+            new_meta = _update_from_mirror(suite, component, destfile, meta)
+        if new_meta != meta:
+            _save_meta(metafile, new_meta)
+    return destfile
+
+
+def parse_sources(lines):
+    """
+    Minimal streaming parser of a Sources file, given as an iterable of lines
+    (bytes).  Yield a (package, version, extra_source_only) tuple for every
+    paragraph, without keeping anything else in memory.
+    """
+    package = version = None
+    extra_source_only = False
+    for line in lines:
+        if not line.strip():  # end of the paragraph
+            if package is not None:
+                yield (package, version, extra_source_only)
+            package = version = None
+            extra_source_only = False
+        elif line[0] in b' \t':  # continuation of a multiline field
+            continue
+        else:
+            key, _, value = line.partition(b':')
+            if key == b'Package':
+                package = value.strip().decode()
+            elif key == b'Version':
+                version = value.strip().decode()
+            elif key == b'Extra-Source-Only':
+                extra_source_only = value.strip() == b'yes'
+    if package is not None:
+        yield (package, version, extra_source_only)
+
+
+def iter_sources(suite, component='main'):
+    """
+    Yield a (package, version, extra_source_only) tuple for every source in
+    the up to date Sources file of suite, reading it line by line.
+    """
+    with open(sources_file(suite, component), 'rb') as fd:
+        yield from parse_sources(fd)
+
@@ -33,6 +33,13 @@ parser.add_argument("--skip-database-connection", action="store_true",
 parser.add_argument("--ignore-missing-files", action="store_true",
                     help="useful for local testing, where you don't have all "
                     "the build logs, etc..")
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="number of worker processes to use, for the scripts "
+                    "that support it")
+parser.add_argument("--incremental", action="store_true",
+                    help="only rebuild the pages affected by the changes "
+                    "recorded since the previous run, for the scripts that "
+                    "support it")
 args, unknown_args = parser.parse_known_args()
 DISTRO = args.distro
 log_level = logging.INFO
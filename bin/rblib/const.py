@@ -6,6 +6,9 @@
 
 import os
 import csv
+import time
+import atexit
+import threading
 from urllib.parse import urljoin
 from sqlalchemy import MetaData, create_engine
 
@@ -77,13 +80,108 @@ with open(os.path.join(BIN_PATH, 'reproducible_pkgsets.csv'), newline='') as f:
 
 # DATABSE CONSTANT
 PGDATABASE = 'reproducibledb'
-
-
-# init the database data and connection
-if not args.skip_database_connection:
-    DB_ENGINE = create_engine("postgresql:///%s" % PGDATABASE)
-    DB_METADATA = MetaData(DB_ENGINE)  # Get all table definitions
-    conn_db = DB_ENGINE.connect()      # the local postgres reproducible db
+# the table definitions are cached there, see rblib.db_table()
+DB_METADATA_CACHE = os.path.join(TEMP_PATH, PGDATABASE + '.metadata.pickle')
+# every process keeps up to DB_POOL_SIZE connections open, opens up to
+# DB_POOL_MAX_OVERFLOW more when needed, and waits up to DB_POOL_TIMEOUT
+# seconds for one to be free when all of them are in use
+DB_POOL_SIZE = 5
+DB_POOL_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 60
+# waiting longer than this (in seconds) for a connection gets logged
+DB_POOL_SLOW_WAIT = 1
+
+
+class _Database:
+    """
+    The engine and the connections to the local postgres reproducible db.
+    Nothing is opened before it is actually used.  Every process creates its
+    own engine, and so its own pool (the ones inherited by a forked process
+    are left alone, closing them would close them for the parent too), and
+    every thread gets its own connection from that pool, pinged when taken
+    out of it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self._engine = None
+
+    def engine(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                if args.skip_database_connection:
+                    raise RuntimeError('database connection requested, but '
+                                       '--skip-database-connection was given')
+                self._engine = create_engine(
+                    "postgresql:///%s" % PGDATABASE,
+                    pool_size=DB_POOL_SIZE,
+                    max_overflow=DB_POOL_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT,
+                    pool_pre_ping=True,
+                )
+                self.pid = os.getpid()
+                self.local = threading.local()
+                self.stats = {'checkouts': 0, 'wait': 0.0, 'max_wait': 0.0}
+            return self._engine
+
+    def connection(self):
+        engine = self.engine()
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.closed:
+            start = time.monotonic()
+            conn = self.local.conn = engine.connect()
+            wait = time.monotonic() - start
+            with self.lock:
+                self.stats['checkouts'] += 1
+                self.stats['wait'] += wait
+                self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+            if wait > DB_POOL_SLOW_WAIT:
+                log.warning('Waited %.2fs for a database connection (%s)',
+                            wait, engine.pool.status())
+        return conn
+
+    def release(self):
+        """Give the connection of the current thread back to the pool."""
+        if self.pid == os.getpid() and getattr(self.local, 'conn', None):
+            self.local.conn.close()
+            self.local.conn = None
+
+
+class _Connection:
+    """
+    Stands for the database connection of the current process and thread:
+    use it like a sqlalchemy Connection.
+    """
+    def __getattr__(self, name):
+        return getattr(_database.connection(), name)
+
+
+_database = _Database()
+conn_db = _Connection()  # the local postgres reproducible db
+DB_METADATA = MetaData()  # the table definitions, see rblib.db_table()
+
+
+def db_engine():
+    """Return the sqlalchemy engine of the current process."""
+    return _database.engine()
+
+
+def db_pool_stats():
+    """
+    Return how many connections the current process took from its pool,
+    and how long it waited for them in total and at most, in seconds.
+    """
+    if _database.pid != os.getpid():
+        return {'checkouts': 0, 'wait': 0.0, 'max_wait': 0.0}
+    return dict(_database.stats)
+
+
+@atexit.register
+def _log_db_pool_stats():
+    stats = db_pool_stats()
+    if stats['checkouts']:
+        log.debug('%(checkouts)s database connection(s) used, after waiting '
+                  '%(wait).2fs in total, %(max_wait).2fs at most', stats)
 
 for key, value in conf_distro.items():
     log.debug('%-16s: %s', key, value)
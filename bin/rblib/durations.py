@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Statistics of the build durations.
+#
+# stats_build records every build by name, suite and architecture, without
+# any link to the sources table, so averaging it for every package shown is
+# slow.  The build_duration_stats table keeps, per package (and so per
+# suite and architecture), the number of builds, their mean duration, the
+# median and 95th percentile of the last RECENT_BUILDS durations, the last
+# duration, and an exponentially weighted moving average used as the
+# expected duration of the next build.  It is updated incrementally from the
+# stats_build rows newer than the last one it includes, by the builders
+# after every build and by the scheduler to catch up.
+#
+# As the ids of the builds are given when they are inserted, a build can be
+# committed after one with a higher id: the last SAFETY_WINDOW ids are read
+# again at every update, and the builds among them already folded in are
+# remembered in build_duration_progress, next to the last id folded in.
+
+import math
+
+from sqlalchemy import text
+
+from . import query_db
+from .confparse import log
+from .const import conn_db
+
+
+# the builds whose duration says something about the next build
+DURATION_STATUSES = ['reproducible', 'FTBR']
+# weight of the last build in the expected duration of the next one
+EWMA_ALPHA = 0.3
+# the percentiles are computed on this many last builds
+RECENT_BUILDS = 100
+# how many ids below the last one folded in are read again, keep in sync
+# with schema update 54 in reproducible_db_maintenance.py
+SAFETY_WINDOW = 1000
+# any number, to make sure a single process updates the table at a time
+_LOCK_ID = 0x6275696c64  # 'build'
+
+
+def _percentile(values, pct):
+    # nearest rank, like percentile_disc() in postgres
+    values = sorted(values)
+    return values[max(0, math.ceil(pct * len(values)) - 1)]
+
+
+def _fold(stats, duration):
+    # stats is a [builds, mean, ewma, recent] list, recent being the last
+    # durations, the newest first
+    builds, mean, ewma, recent = stats
+    if builds == 0:
+        ewma = duration
+    stats[0] = builds + 1
+    stats[1] = mean + (duration - mean) / (builds + 1)
+    stats[2] = EWMA_ALPHA * duration + (1 - EWMA_ALPHA) * ewma
+    stats[3] = ([duration] + recent)[:RECENT_BUILDS]
+
+
+def update_build_stats(wait=True, batch=100000):
+    """
+    Fold the builds recorded in stats_build since the previous call into
+    build_duration_stats.  If wait is False, give up if another process is
+    already doing it: it will fold in the same builds anyway.
+    Return the number of builds processed.
+    """
+    select_builds = text(
+        "SELECT b.id, s.id AS package_id, s.name, s.suite, s.architecture, "
+        "CAST(b.build_duration AS INTEGER) AS duration "
+        "FROM stats_build AS b JOIN sources AS s ON s.name=b.name "
+        "AND s.suite=b.suite AND s.architecture=b.architecture "
+        "WHERE b.id > :low_id AND b.id <> ALL(:folded) "
+        "AND b.status = ANY(:statuses) ORDER BY b.id LIMIT :batch"
+    )
+    select_stats = text(
+        "SELECT package_id, builds, mean, ewma, recent "
+        "FROM build_duration_stats WHERE package_id = ANY(:ids)"
+    )
+    upsert = text(
+        "INSERT INTO build_duration_stats (package_id, builds, mean, ewma, "
+        "p50, p95, last_duration, recent, last_build_id) "
+        "VALUES (:package_id, :builds, :mean, :ewma, :p50, :p95, "
+        ":last_duration, :recent, :last_build_id) "
+        "ON CONFLICT (package_id) DO UPDATE SET builds=EXCLUDED.builds, "
+        "mean=EXCLUDED.mean, ewma=EXCLUDED.ewma, p50=EXCLUDED.p50, "
+        "p95=EXCLUDED.p95, last_duration=EXCLUDED.last_duration, "
+        "recent=EXCLUDED.recent, last_build_id=GREATEST("
+        "build_duration_stats.last_build_id, EXCLUDED.last_build_id)"
+    )
+    processed = 0
+    transaction = conn_db.begin()
+    try:
+        if wait:
+            query_db(text("SELECT pg_advisory_xact_lock(:id)"), id=_LOCK_ID)
+        elif not query_db(text("SELECT pg_try_advisory_xact_lock(:id)"),
+                          id=_LOCK_ID)[0][0]:
+            log.info('The build durations are being updated by another '
+                     'process already')
+            transaction.rollback()
+            return 0
+        last_id, folded = query_db(
+            "SELECT last_build_id, folded FROM build_duration_progress"
+        )[0]
+        folded = set(folded)
+        while True:
+            builds = query_db(select_builds, low_id=last_id - SAFETY_WINDOW,
+                              folded=sorted(folded),
+                              statuses=DURATION_STATUSES, batch=batch)
+            if not builds:
+                break
+            ids = list({x.package_id for x in builds})
+            stats = {x.package_id: [x.builds, x.mean, x.ewma, list(x.recent)]
+                     for x in query_db(select_stats, ids=ids)}
+            touched = {}
+            for build in builds:
+                _fold(stats.setdefault(build.package_id, [0, 0.0, 0.0, []]),
+                      build.duration)
+                touched[build.package_id] = build.id
+            query_db(upsert, [{
+                'package_id': package_id,
+                'builds': stats[package_id][0],
+                'mean': stats[package_id][1],
+                'ewma': stats[package_id][2],
+                'p50': _percentile(stats[package_id][3], 0.5),
+                'p95': _percentile(stats[package_id][3], 0.95),
+                'last_duration': stats[package_id][3][0],
+                'recent': stats[package_id][3],
+                'last_build_id': build_id,
+            } for package_id, build_id in touched.items()])
+            last_id = max(last_id, builds[-1].id)
+            folded.update(x.id for x in builds)
+            folded = {x for x in folded if x > last_id - SAFETY_WINDOW}
+            processed += len(builds)
+        if processed:
+            query_db(text("UPDATE build_duration_progress "
+                          "SET last_build_id=:last_id, folded=:folded"),
+                     last_id=last_id, folded=sorted(folded))
+    except Exception:
+        transaction.rollback()
+        raise
+    transaction.commit()
+    log.info('Updated the build duration statistics with %s builds',
+             processed)
+    return processed
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Hot and cold storage of the build history.
+#
+# stats_build keeps the builds of the last HOT_HISTORY months.  The older
+# builds are rolled into stats_build_archive, one row per package, suite,
+# architecture, distribution, build type and month, every other column being
+# an array: such large rows are compressed by postgres, and a package history
+# reads a few of them instead of hundreds of rows.  The yearly partitions of
+# stats_build emptied that way are dropped.  The stats_build_all view shows
+# both the recent and the archived builds.
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import text
+
+from . import query_db
+from .confparse import log
+from .const import conn_db
+
+
+# number of months of builds kept in stats_build
+HOT_HISTORY = 12
+# the oldest year stats_build has a partition for
+FIRST_YEAR = 2014
+
+HistoryRecord = namedtuple('HistoryRecord', 'id version suite architecture '
+                           'status build_date build_duration node1 node2 job')
+
+# the columns of stats_build, and the array columns of stats_build_archive
+# they are archived in
+_COLUMNS = (('id', 'ids'), ('version', 'versions'), ('status', 'statuses'),
+            ('build_date', 'build_dates'),
+            ('build_duration', 'build_durations'), ('node1', 'node1s'),
+            ('node2', 'node2s'), ('job', 'jobs'))
+# the columns of stats_build of another type than their archive array
+_CASTS = {'build_duration': 'CAST(build_duration AS INTEGER)'}
+# the columns stats_build_archive groups the builds by, besides the month
+_KEYS = 'name, suite, architecture, distribution, build_type'
+
+
+def archive_cutoff(now=None):
+    """Return the date before which the builds are archived."""
+    now = now or datetime.now()
+    months = now.year * 12 + now.month - 1 - HOT_HISTORY
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def archive_history(now=None):
+    """
+    Move the builds older than HOT_HISTORY months from stats_build to
+    stats_build_archive, and drop the partitions of stats_build left empty.
+    Return the set of the (name, distribution) of the packages whose archive
+    changed.  The builds without a distribution are left alone.
+    """
+    cutoff = archive_cutoff(now)
+    aggregates = ', '.join(
+        'array_agg({} ORDER BY build_date DESC)'.format(_CASTS.get(c, c))
+        for c, _ in _COLUMNS)
+    updates = ', '.join(
+        '{0}=EXCLUDED.{0} || a.{0}'.format(a) for _, a in _COLUMNS)
+    archive = text(
+        "INSERT INTO stats_build_archive AS a (" + _KEYS + ", month, "
+        "builds, " + ', '.join(a for _, a in _COLUMNS) + ") "
+        "SELECT " + _KEYS + ", date_trunc('month', build_date), "
+        "count(*), " + aggregates + " FROM stats_build "
+        "WHERE build_date < :cutoff AND distribution IS NOT NULL "
+        "GROUP BY " + _KEYS + ", date_trunc('month', build_date) "
+        "ON CONFLICT (" + _KEYS + ", month) DO UPDATE SET "
+        "builds=a.builds + EXCLUDED.builds, " + updates + " "
+        "RETURNING name, distribution"
+    )
+    transaction = conn_db.begin()
+    try:
+        names = {tuple(x) for x in query_db(archive, cutoff=cutoff)}
+        moved = query_db(text(
+            "DELETE FROM stats_build WHERE build_date < :cutoff "
+            "AND distribution IS NOT NULL"), cutoff=cutoff)
+        for year in range(FIRST_YEAR, cutoff.year):
+            partition = 'stats_build_{}'.format(year)
+            if query_db(text("SELECT to_regclass(:p) IS NOT NULL"),
+                        p=partition)[0][0] and \
+                    not query_db('SELECT 1 FROM {} LIMIT 1'.format(partition)):
+                query_db('DROP TABLE {}'.format(partition))
+    except Exception:
+        transaction.rollback()
+        raise
+    transaction.commit()
+    log.info('Archived %s builds older than %s, of %s packages', moved,
+             cutoff.strftime('%Y-%m'), len(names))
+    return names
+
+
+def history(name, arch=None, year=None, limit=None, distribution=None):
+    """
+    Return the builds of a package, the newest first, as a list of
+    HistoryRecord.  By default only the recent builds (from stats_build)
+    are returned; if year is given, only the archived builds of that year.
+    If distribution (an id) is given, only the builds of that distribution.
+    """
+    params = {'name': name, 'arch': arch, 'limit': limit,
+              'distribution': distribution}
+    if year is None:
+        query = (
+            "SELECT id, version, suite, architecture, status, build_date, "
+            "build_duration, node1, node2, job FROM stats_build "
+            "WHERE name=:name"
+        )
+    else:
+        query = (
+            "SELECT b.id, b.version, a.suite, a.architecture, b.status, "
+            "b.build_date, b.build_duration, b.node1, b.node2, b.job "
+            "FROM stats_build_archive AS a, unnest(" +
+            ', '.join('a.' + a for _, a in _COLUMNS) + ") AS b(" +
+            ', '.join(c for c, _ in _COLUMNS) + ") "
+            "WHERE a.name=:name AND a.month >= :start AND a.month < :end"
+        )
+        params['start'] = datetime(year, 1, 1)
+        params['end'] = datetime(year + 1, 1, 1)
+    if arch:
+        query += " AND architecture=:arch"
+    if distribution:
+        query += " AND distribution=:distribution"
+    query += " ORDER BY build_date DESC LIMIT :limit"
+    return [HistoryRecord(*x) for x in query_db(text(query), **params)]
+
+
+def archived_years(name, distribution):
+    """
+    Return a {architecture: [year, ...]} dict of the years of the archived
+    builds of a package in a distribution (an id), the newest first.
+    """
+    query = text(
+        "SELECT DISTINCT architecture, "
+        "CAST(EXTRACT(YEAR FROM month) AS INTEGER) AS year "
+        "FROM stats_build_archive WHERE name=:name "
+        "AND distribution=:distribution ORDER BY year DESC"
+    )
+    years = {}
+    for arch, year in query_db(query, name=name, distribution=distribution):
+        years.setdefault(arch, []).append(year)
+    return years
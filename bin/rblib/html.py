@@ -6,8 +6,11 @@
 
 import os
 import errno
+import atexit
 import hashlib
+import time
 import pystache
+import tempfile
 from datetime import datetime
 
 from .confparse import log, conf_distro
@@ -28,24 +31,84 @@ with open(REPRODUCIBLE_STYLES, 'rb') as f:
     _hasher.update(f.read())
 REPRODUCIBLE_STYLE_SHA1 = _hasher.hexdigest()
 
-# Templates used for creating package pages
+# the permissions of the written pages, as a plain open() would set them
+_umask = os.umask(0)
+os.umask(_umask)
+_PAGE_MODE = 0o666 & ~_umask
+
+# how many pages were written or left untouched because they didn't change
+_write_stats = {'written': 0, 'skipped': 0}
+# appended to the pages written with a digest, see _write_file()
+_DIGEST_MARK = '<!-- content sha1: {} -->\n'
+
+# Registry of the mustache templates: every template is read and parsed only
+# once per process, and the time spent rendering each of them is recorded.
 _renderer = pystache.Renderer()
-status_icon_link_template = _renderer.load_template(
-    TEMPLATE_PATH + '/status_icon_link')
-default_page_footer_template = _renderer.load_template(
-    TEMPLATE_PATH + '/default_page_footer')
-pkg_legend_template = _renderer.load_template(
-    TEMPLATE_PATH + '/pkg_symbol_legend')
-project_links_template = _renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'project_links'))
-main_navigation_template = _renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'main_navigation'))
-basic_page_template = _renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'basic_page'))
+_templates = {}
+_render_stats = {}
+
+
+def get_template(name):
+    """
+    Return the parsed template called name (the file name in the templates
+    directory, without the .mustache extension).
+    """
+    try:
+        return _templates[name]
+    except KeyError:
+        pass
+    path = os.path.join(TEMPLATE_PATH, name + '.mustache')
+    with open(path, encoding='UTF-8') as fd:
+        _templates[name] = pystache.parse(fd.read())
+    return _templates[name]
+
+
+def render_template(name, context=None):
+    """Render the template called name with context."""
+    template = get_template(name)
+    start = time.perf_counter()
+    html = _renderer.render(template, context or {})
+    stats = _render_stats.setdefault(name, [0, 0.0])
+    stats[0] += 1
+    stats[1] += time.perf_counter() - start
+    return html
+
+
+def render_stats(since=None):
+    """
+    Return {template: [renders, seconds]} for this process, counting only
+    what was rendered after since, a previous return value, if given.
+    """
+    since = since or {}
+    return {name: [count - since.get(name, [0, 0.0])[0],
+                   total - since.get(name, [0, 0.0])[1]]
+            for name, (count, total) in _render_stats.items()}
+
+
+def add_render_stats(stats):
+    """Add the counters returned by render_stats() in another process."""
+    for name, (count, total) in stats.items():
+        if count:
+            own = _render_stats.setdefault(name, [0, 0.0])
+            own[0] += count
+            own[1] += total
+
+
+@atexit.register
+def _log_render_stats():
+    if not _render_stats:
+        return
+    log.info('Templates: %s renders in %.2fs',
+             sum(x[0] for x in _render_stats.values()),
+             sum(x[1] for x in _render_stats.values()))
+    for name, (count, total) in sorted(_render_stats.items(),
+                                       key=lambda x: x[1][1], reverse=True):
+        log.debug('Template %s: rendered %s times in %.2fs',
+                  name, count, total)
 
 
 def _create_default_page_footer(date):
-    return _renderer.render(default_page_footer_template, {
+    return render_template('default_page_footer', {
             'date': date,
             'job_url': JOB_URL,
             'job_name': JOB_NAME,
@@ -62,6 +125,8 @@ def _gen_suite_arch_nav_context(suite, arch, suite_arch_nav_template=None,
             '/{{distro}}/{{suite}}/index_suite_{{arch}}_stats.html'
     if not suite_arch_nav_template:
         suite_arch_nav_template = default_nav_template
+    # it's rendered once per suite and arch, parse it only once
+    nav_template = pystache.parse(suite_arch_nav_template)
 
     suite_list = []
     if not no_suite:
@@ -72,7 +137,7 @@ def _gen_suite_arch_nav_context(suite, arch, suite_arch_nav_template=None,
             suite_list.append({
                 's': s,
                 'class': 'current' if s == suite else '',
-                'uri': _renderer.render(suite_arch_nav_template,
+                'uri': _renderer.render(nav_template,
                                         {'distro': conf_distro['distro_root'],
                                          'suite': s, 'arch': arch})
                 if include_suite else '',
@@ -84,7 +149,7 @@ def _gen_suite_arch_nav_context(suite, arch, suite_arch_nav_template=None,
             arch_list.append({
                 'a': a,
                 'class': 'current' if a == arch else '',
-                'uri': _renderer.render(suite_arch_nav_template,
+                'uri': _renderer.render(nav_template,
                                         {'distro': conf_distro['distro_root'],
                                          'suite': suite, 'arch': a}),
             })
@@ -102,7 +167,7 @@ def create_main_navigation(suite=defaultsuite, arch=defaultarch,
     context = {
         'suite': suite,
         'arch': arch,
-        'project_links_html': _renderer.render(project_links_template),
+        'project_links_html': render_template('project_links'),
         'suite_nav': {
             'suite_list': suite_list
         } if len(suite_list) else '',
@@ -119,16 +184,17 @@ def create_main_navigation(suite=defaultsuite, arch=defaultarch,
     # items will be highlighted.
     if displayed_page:
         context[displayed_page] = True
-    return _renderer.render(main_navigation_template, context)
+    return render_template('main_navigation', context)
 
 
 def write_html_page(title, body, destfile, no_header=False, style_note=False,
                     noendpage=False, refresh_every=None, displayed_page=None,
-                    left_nav_html=None):
+                    left_nav_html=None, only_if_changed=True):
     meta_refresh_html = '<meta http-equiv="refresh" content="%d"></meta>' % \
         refresh_every if refresh_every is not None else ''
     if style_note:
-        body += _renderer.render(pkg_legend_template, {})
+        body += render_template('pkg_symbol_legend')
+    now = None
     if not noendpage:
         now = datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
         body += _create_default_page_footer(now)
@@ -140,16 +206,82 @@ def write_html_page(title, body, destfile, no_header=False, style_note=False,
         'main_html': body,
         'style_dot_css_sha1sum': REPRODUCIBLE_STYLE_SHA1,
     }
-    html = _renderer.render(basic_page_template, context)
+    html = render_template('basic_page', context)
 
     try:
         os.makedirs(destfile.rsplit('/', 1)[0], exist_ok=True)
     except OSError as e:
         if e.errno != errno.EEXIST:  # that's 'File exists' error (errno 17)
             raise
+    html = html.encode('UTF-8')
+    digest = None
+    if now is not None:
+        # the footer says when the page was generated, which changes at
+        # every run: compare the pages by the hash of everything else
+        digest = hashlib.sha1(html.replace(now.encode(), b'')).hexdigest()
+        html += _DIGEST_MARK.format(digest).encode()
+    _write_file(destfile, html, only_if_changed, digest)
+
+
+def _write_file(destfile, content, only_if_changed=True, digest=None):
+    """
+    Write content (bytes) to destfile, atomically: the content is written to
+    a temporary file in the same directory, which is then renamed over the
+    destination, so a reader never sees a partially written page.
+    With only_if_changed the file is left untouched (keeping its mtime, which
+    is good for HTTP caching and rsync) if it already has the same content,
+    or if digest is given, if it ends with the same _DIGEST_MARK.
+    Return whether the file was written.
+    """
+    if only_if_changed:
+        try:
+            if digest is not None:
+                mark = _DIGEST_MARK.format(digest).encode()
+                with open(destfile, 'rb') as fd:
+                    fd.seek(max(0, os.fstat(fd.fileno()).st_size - len(mark)))
+                    unchanged = fd.read() == mark
+            else:
+                unchanged = os.path.getsize(destfile) == len(content)
+                if unchanged:
+                    with open(destfile, 'rb') as fd:
+                        unchanged = fd.read() == content
+            if unchanged:
+                log.debug("Not writing " + destfile + ", unchanged")
+                _write_stats['skipped'] += 1
+                return False
+        except FileNotFoundError:
+            pass
     log.debug("Writing " + destfile)
-    with open(destfile, 'w', encoding='UTF-8') as fd:
-        fd.write(html)
+    dirname, basename = os.path.split(destfile)
+    fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix='.' + basename + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmpfile, _PAGE_MODE)
+        os.replace(tmpfile, destfile)
+    except BaseException:
+        os.unlink(tmpfile)
+        raise
+    _write_stats['written'] += 1
+    return True
+
+
+def write_stats():
+    """Return the number of pages written and skipped by this process."""
+    return dict(_write_stats)
+
+
+def add_write_stats(stats):
+    """Add the counters returned by write_stats() in another process."""
+    for key in _write_stats:
+        _write_stats[key] += stats[key]
+
+
+@atexit.register
+def _log_write_stats():
+    if _write_stats['written'] or _write_stats['skipped']:
+        log.info('HTML pages: %(written)s written, %(skipped)s unchanged',
+                 _write_stats)
 
 
 def gen_status_link_icon(status, spokenstatus, icon, suite, arch):
@@ -168,4 +300,4 @@ def gen_status_link_icon(status, spokenstatus, icon, suite, arch):
         'arch': arch,
         'untested': True if status == 'untested' else False,
     }
-    return _renderer.render(status_icon_link_template, context)
+    return render_template('status_icon_link', context)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Journal of the changes to the (package, suite, architecture) rows.
+#
+# Everything that changes what is shown about a package (the scheduler when
+# importing the Sources files, the build result writer, the notes importer)
+# records the rows it touched in the `changes` table.  The html generators
+# keep a watermark (the id of the last change they processed) in the
+# `changes_consumers` table, so that in incremental mode they only rebuild
+# the pages affected by what happened since their previous run.
+#
+# As the ids are given when the rows are inserted, a change can be committed
+# after one with a higher id: to never read a watermark past such a change,
+# the writers hold a shared lock until they commit, and the watermark is read
+# under the exclusive one.
+
+from sqlalchemy import text
+
+from . import query_db
+from .confparse import log
+
+
+# any number, but keep in sync with record_change() in reproducible_common.sh
+_LOCK_ID = 0x6368616e676573  # 'changes'
+# to prefix the inserts in the journal with
+_LOCK_SHARED = (
+    "WITH journal_lock AS (SELECT pg_advisory_xact_lock_shared(:lock_id)) ")
+
+
+def record_changes(packages, reason):
+    """
+    Record a change to some packages.
+
+    packages is an iterable of (name, suite, architecture) tuples, reason a
+    short free form text saying what happened to them.  To be called before
+    deleting a package, so that its id can still be looked up.
+    """
+    rows = [{'name': name, 'suite': suite, 'architecture': arch,
+             'reason': reason, 'lock_id': _LOCK_ID}
+            for name, suite, arch in packages]
+    if not rows:
+        return
+    query = text(
+        _LOCK_SHARED +
+        "INSERT INTO changes (package_id, name, suite, architecture, reason, "
+        "date) SELECT (SELECT id FROM sources WHERE name=:name AND "
+        "suite=:suite AND architecture=:architecture), :name, :suite, "
+        ":architecture, :reason, CURRENT_TIMESTAMP FROM journal_lock"
+    )
+    query_db(query, rows)
+    log.debug('Recorded %s changes (%s) in the journal', len(rows), reason)
+
+
+def record_package_ids(package_ids, reason):
+    """Same as record_changes(), for packages given by their id."""
+    package_ids = list(package_ids)
+    if not package_ids:
+        return
+    query = text(
+        _LOCK_SHARED +
+        "INSERT INTO changes (package_id, name, suite, architecture, reason, "
+        "date) SELECT id, name, suite, architecture, :reason, "
+        "CURRENT_TIMESTAMP FROM sources, journal_lock "
+        "WHERE id = ANY(:ids)"
+    )
+    query_db(query, ids=package_ids, reason=reason, lock_id=_LOCK_ID)
+    log.debug('Recorded %s changes (%s) in the journal', len(package_ids),
+              reason)
+
+
+def get_watermark(consumer):
+    """Return the id of the last change processed by consumer, or None."""
+    query = text(
+        "SELECT last_id FROM changes_consumers WHERE consumer=:consumer")
+    result = query_db(query, consumer=consumer)
+    if not result:
+        return None
+    return result[0][0]
+
+
+def set_watermark(consumer, last_id):
+    query = text(
+        "INSERT INTO changes_consumers (consumer, last_id, date) "
+        "VALUES (:consumer, :last_id, CURRENT_TIMESTAMP) "
+        "ON CONFLICT (consumer) DO UPDATE "
+        "SET last_id=:last_id, date=CURRENT_TIMESTAMP"
+    )
+    query_db(query, consumer=consumer, last_id=last_id)
+
+
+def last_change_id():
+    """
+    Return the id of the last change, once every change with a lower id has
+    been committed.
+    """
+    # waits for the writers holding the shared lock to commit
+    query_db(text("SELECT pg_advisory_lock(:id)"), id=_LOCK_ID)
+    try:
+        return query_db('SELECT COALESCE(MAX(id), 0) FROM changes')[0][0]
+    finally:
+        query_db(text("SELECT pg_advisory_unlock(:id)"), id=_LOCK_ID)
+
+
+def changes_since(consumer):
+    """
+    Return a (last_id, changes) tuple, where changes is the list of the
+    (name, suite, architecture, reason) rows recorded since the watermark of
+    consumer, and last_id the id to pass to set_watermark() once they have
+    been processed.
+    changes is None if the consumer never ran before, in which case
+    everything needs to be rebuilt.
+    """
+    last_id = last_change_id()
+    watermark = get_watermark(consumer)
+    if watermark is None:
+        log.info('No watermark found for %s, everything has to be rebuilt',
+                 consumer)
+        return last_id, None
+    query = text(
+        "SELECT name, suite, architecture, reason FROM changes "
+        "WHERE id > :watermark AND id <= :last_id ORDER BY id"
+    )
+    changes = query_db(query, watermark=watermark, last_id=last_id)
+    log.info('%s changes recorded since the last run of %s',
+             len(changes), consumer)
+    return last_id, changes
+
+
+def purge_changes(days=7):
+    """
+    Remove the changes that every consumer has already processed and that
+    are older than the given number of days.
+    """
+    query = text(
+        "DELETE FROM changes WHERE date < CURRENT_TIMESTAMP - :days * "
+        "INTERVAL '1 day' AND id <= (SELECT COALESCE(MIN(last_id), 0) "
+        "FROM changes_consumers)"
+    )
+    removed = query_db(query, days=days)
+    log.info('Removed %s old changes from the journal', removed)
@@ -7,10 +7,12 @@
 import os
 import json
 import os.path
+import resource
 import functools
 import html as HTML
 from enum import Enum
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from sqlalchemy import text
 
 from .const import (
     ARCHS,
@@ -24,6 +26,8 @@ from .const import (
     DIFFS_PATH, DIFFS_URI,
 )
 from .bugs import Bugs
+from .history import history
+from .confparse import log
 from .utils import strip_epoch
 from . import query_db
 
@@ -66,6 +70,81 @@ class Status(Enum):
         return cls[name.upper()]
 
 
+class _Issues_cache:
+    """
+    All the issues, loaded from the database the first time one is needed and
+    then kept for the whole process, as the same issue is referenced by many
+    packages.
+    """
+    __singleton = {}
+
+    def __init__(self):
+        self.__dict__ = self.__singleton
+        if not self.__singleton:
+            self._issues = None
+
+    @property
+    def issues(self):
+        if self._issues is None:
+            query = "SELECT name, url, description FROM issues"
+            self._issues = {
+                row[0]: (row[1] or '', row[2] or '') for row in query_db(query)
+            }
+        return self._issues
+
+    def get(self, name):
+        """Returns the (url, description) tuple of the given issue."""
+        return self.issues.get(name, ('', ''))
+
+    def invalidate(self):
+        self._issues = None
+
+
+class _Notes_cache:
+    """
+    All the notes, loaded from the database the first time one is needed and
+    then kept for the whole process.  Notes are keyed by package_id, with an
+    additional (name, suite, architecture) -> package_id mapping.
+    """
+    __singleton = {}
+
+    def __init__(self):
+        self.__dict__ = self.__singleton
+        if not self.__singleton:
+            self._notes = None
+            self._ids = None
+
+    def _load(self):
+        query = """
+            SELECT n.package_id, s.name, s.suite, s.architecture,
+                n.issues, n.bugs, n.comments
+            FROM notes AS n JOIN sources AS s ON s.id=n.package_id
+        """
+        self._notes = {}
+        self._ids = {}
+        for row in query_db(query):
+            self._notes[row[0]] = tuple(row[4:7])
+            self._ids[(row[1], row[2], row[3])] = row[0]
+
+    def get_by_id(self, package_id):
+        """Returns the (issues, bugs, comments) tuple of the note, or None."""
+        if self._notes is None:
+            self._load()
+        return self._notes.get(package_id)
+
+    def get(self, name, suite, arch):
+        if self._ids is None:
+            self._load()
+        try:
+            return self._notes[self._ids[(name, suite, arch)]]
+        except KeyError:
+            return None
+
+    def invalidate(self):
+        self._notes = None
+        self._ids = None
+
+
 class Bug:
     def __init__(self, bug):
         self.bug = bug
@@ -87,16 +166,7 @@ class Issue:
         self._set()
 
     def _set(self):
-        query = "SELECT url, description  FROM issues WHERE name='{}'"
-        result = query_db(query.format(self.name))
-        try:
-            self._l_url = result[0][0]
-        except IndexError:
-            self._l_url = ''
-        try:
-            self._l_desc = result[0][1]
-        except IndexError:
-            self._l_desc = ''
+        self._l_url, self._l_desc = _Issues_cache().get(self.name)
 
 
 class Note:
@@ -169,21 +239,17 @@ class Build:
                     result = ('untested', str(result), None)
             except IndexError:  # there is no package with this name in this
                 result = (None, None, None)  # suite/arch, or none at all
-        self._l_status = result[0]
-        self._l_version = result[1]
-        self._l_build_date = str(result[2]) + ' UTC' if result[2] else None
+        self._set_status(*result)
+
+    def _set_status(self, status, version, build_date):
+        self._l_status = status
+        self._l_version = version
+        self._l_build_date = str(build_date) + ' UTC' if build_date else None
 
     @lazyproperty
     def note(self):
-        query = """
-            SELECT n.issues, n.bugs, n.comments
-            FROM sources AS s JOIN notes AS n ON s.id=n.package_id
-            WHERE s.name='{}' AND s.suite='{}' AND s.architecture='{}'
-        """
-        result = query_db(query.format(self.package, self.suite, self.arch))
-        try:
-            result = result[0]
-        except IndexError:
+        result = _Notes_cache().get(self.package, self.suite, self.arch)
+        if result is None:
             self._l_note = None
         else:
             self._l_note = Note(self, result)
@@ -209,20 +275,158 @@ class Build:
         self._l_logdiff = self.__file(self, filename, DIFFS_PATH, DIFFS_URI)
 
 
+# everything the lazy properties of Build would query, for many packages at once
+_prefetch_builds_query = text("""
+    SELECT s.name, s.suite, s.architecture, s.version,
+        r.status, r.version, r.build_date,
+        n.package_id, n.issues, n.bugs, n.comments
+    FROM sources AS s
+    LEFT JOIN results AS r ON r.package_id=s.id
+    LEFT JOIN notes AS n ON n.package_id=s.id
+    WHERE s.name = ANY(:names)
+    AND s.suite = ANY(:suites) AND s.architecture = ANY(:archs)
+""")
+
+
+def prefetch_builds(packages, chunk_size=1000):
+    """
+    Fill status, version, build_date and note of every Build of the given
+    packages using one query per chunk of packages, instead of the 2 or 3
+    queries per (package, suite, arch) that the lazy properties would run.
+    Builds not present in the database are marked as such, exactly like the
+    lazy path would do.
+    """
+    packages = list(packages)
+    for i in range(0, len(packages), chunk_size):
+        chunk = {pkg.name: pkg for pkg in packages[i:i+chunk_size]}
+        rows = query_db(_prefetch_builds_query, names=list(chunk),
+                        suites=SUITES, archs=ARCHS)
+        found = set()
+        for row in rows:
+            name, suite, arch = row[0], row[1], row[2]
+            build = chunk[name].builds[suite][arch]
+            if row[4] is not None:
+                build._set_status(row[4], row[5], row[6])
+            else:  # not tested yet
+                build._set_status('untested', str(row[3]), None)
+            if row[7] is not None:
+                build._l_note = Note(build, row[8:11])
+            else:
+                build._l_note = None
+            found.add((name, suite, arch))
+        for name, pkg in chunk.items():
+            for suite in SUITES:
+                for arch in ARCHS:
+                    if (name, suite, arch) in found:
+                        continue
+                    # there is no package with this name in this suite/arch
+                    build = pkg.builds[suite][arch]
+                    build._set_status(None, None, None)
+                    build._l_note = None
+
+
+# maximum number of packages kept in _Package_cache
+PACKAGE_CACHE_SIZE = 5000
+# if set, packages are evicted from _Package_cache while the resident memory
+# of the process (in bytes) is higher than this
+PACKAGE_CACHE_MEMORY = None
+
+
+def _resident_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
 class _Package_cache:
+    """
+    Keeps the attributes of the Package objects, so that all the instances
+    for the same package share them.  This is a LRU cache: when more than
+    `maxsize` packages are cached, or the process uses more memory than
+    `memory_budget`, the least recently used packages are evicted.
+    Evicting (or invalidating) a package drops all its lazily loaded
+    attributes, which are then loaded again on the next access, also by
+    Package objects still referencing them.
+    """
     __singleton = {}
+    # check the memory usage once every this many new packages
+    _memory_check_interval = 100
 
     def __init__(self):
         self.__dict__ = self.__singleton
         if not self.__singleton:
-            self._cache = {}
+            self._cache = OrderedDict()
+            self.maxsize = PACKAGE_CACHE_SIZE
+            self.memory_budget = PACKAGE_CACHE_MEMORY
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
 
     def get(self, pkgname):
         try:
-            return self._cache[pkgname]
+            attrs = self._cache[pkgname]
         except KeyError:
-            self._cache[pkgname] = {}
-            return self._cache[pkgname]
+            self.misses += 1
+            attrs = self._cache[pkgname] = {}
+            self._shrink()
+        else:
+            self.hits += 1
+            self._cache.move_to_end(pkgname)
+        return attrs
+
+    @staticmethod
+    def _drop_lazy_attributes(attrs):
+        for key in [x for x in attrs if x.startswith('_l_')]:
+            del attrs[key]
+
+    def _evict(self, amount):
+        for i in range(min(amount, len(self._cache) - 1)):
+            self._drop_lazy_attributes(self._cache.popitem(last=False)[1])
+            self.evictions += 1
+
+    def _shrink(self):
+        if len(self._cache) > self.maxsize:
+            self._evict(len(self._cache) - self.maxsize)
+        if self.memory_budget and \
+                self.misses % self._memory_check_interval == 0 and \
+                _resident_memory() > self.memory_budget:
+            log.debug('Memory budget exceeded, evicting a quarter of the '
+                      '%s cached packages', len(self._cache))
+            self._evict(len(self._cache) // 4)
+
+    def invalidate(self, pkgname=None):
+        """
+        Forget what is known about the given package (or about all of them),
+        e.g. after its status or notes changed in the database.
+        """
+        if pkgname is None:
+            for attrs in self._cache.values():
+                self._drop_lazy_attributes(attrs)
+            self._cache.clear()
+        elif pkgname in self._cache:
+            self._drop_lazy_attributes(self._cache.pop(pkgname))
+
+    def stats(self):
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def invalidate_package(name=None):
+    """
+    Drop everything cached about the package `name` (or about every package),
+    to be called after changing it in the database.
+    """
+    _Package_cache().invalidate(name)
+
+
+def package_cache_stats():
+    return _Package_cache().stats()
 
 
 class Package:
@@ -272,13 +476,8 @@ class Package:
             'build date', 'build duration', 'node1', 'node2', 'job',
             'schedule message'
         ]
-        query = """
-                SELECT id, version, suite, architecture, status, build_date,
-                    build_duration, node1, node2, job
-                FROM stats_build WHERE name='{}' ORDER BY build_date DESC
-            """.format(self.name)
-        results = query_db(query)
-        for record in results:
+        # only the recent builds, see rblib/history.py
+        for record in history(self.name):
             self._l_history.append(dict(zip(keys, record)))
 
     def html_link(self, suite, arch, bugs=True, popcon=None, is_popular=None):
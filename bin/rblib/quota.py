@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Quotas of the manual scheduling.
+#
+# Manual schedulings are admitted against token buckets counted in hours of
+# builder time: every package costs its expected build duration (the average
+# of its past builds).  Every requester has a bucket of REQUESTER_BUDGET
+# hours, refilled at that rate per day.  All the requesters share a global
+# bucket sized after what the builders actually did during the last day:
+# requests exceeding it are still admitted, but deferred, i.e. scheduled
+# with a lower priority than the manual schedulings.
+#
+# Every admitted scheduling is logged in quota_log, partitioned by month (the
+# partitions are created ahead by reproducible_db_maintenance.py).
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from . import query_db
+from .confparse import log
+
+
+# build hours a requester can schedule per day
+REQUESTER_BUDGET = 100
+# share of the builder time of the last day available to manual schedulings
+GLOBAL_SHARE = 0.5
+# name of the bucket shared by everybody
+GLOBAL_BUCKET = '*'
+# cost of the packages never built, in hours
+DEFAULT_COST = 0.25
+
+
+Admission = namedtuple('Admission',
+                       'admitted deferred cost tokens global_tokens')
+
+
+def estimate_costs(package_ids):
+    """
+    Return a {package_id: hours} dict of the expected build cost of the
+    packages, the average duration of their builds (see rblib/durations.py).
+    """
+    query = text(
+        "SELECT s.id, d.mean FROM sources AS s "
+        "LEFT JOIN build_duration_stats AS d ON d.package_id=s.id "
+        "WHERE s.id = ANY(:ids)"
+    )
+    return {
+        package_id: float(mean) / 3600 if mean is not None else DEFAULT_COST
+        for package_id, mean in query_db(query, ids=list(package_ids))
+    }
+
+
+def global_budget():
+    """
+    Return the size in hours of the global bucket: GLOBAL_SHARE of the
+    builder time spent during the last day.
+    """
+    query = text(
+        "SELECT COALESCE(SUM(CAST(build_duration AS INTEGER)), 0) "
+        "FROM stats_build WHERE build_date > :since"
+    )
+    spent = query_db(query, since=datetime.now() - timedelta(days=1))[0][0]
+    return GLOBAL_SHARE * float(spent) / 3600
+
+
+def _refill(bucket, budget, now):
+    # lock the bucket and return its current amount of tokens, refilled at
+    # budget per day since its last update, up to budget
+    query_db(text(
+        "INSERT INTO quota_buckets (requester, tokens, updated) "
+        "VALUES (:bucket, :budget, :now) ON CONFLICT (requester) DO NOTHING"
+    ), bucket=bucket, budget=budget, now=now)
+    tokens, updated = query_db(text(
+        "SELECT tokens, updated FROM quota_buckets "
+        "WHERE requester=:bucket FOR UPDATE"
+    ), bucket=bucket)[0]
+    elapsed = (now - updated).total_seconds() / 86400
+    return min(budget, tokens + budget * elapsed)
+
+
+def _take(bucket, tokens, now):
+    query_db(text(
+        "UPDATE quota_buckets SET tokens=:tokens, updated=:now "
+        "WHERE requester=:bucket"
+    ), bucket=bucket, tokens=tokens, now=now)
+
+
+def admit(requester, arch, costs, local=False, dry_run=False):
+    """
+    Decide whether the scheduling by requester of the packages with the
+    given costs ({package_id: hours}, see estimate_costs()) on arch is
+    admitted, and if so whether it is deferred.  Unless dry_run, take the
+    tokens from the buckets and log the scheduling.
+    The local calls (from the jenkins jobs) are always admitted.
+    This has to run in the transaction that schedules the packages: the
+    buckets stay locked until it ends, and the tokens are only spent if it
+    is committed.
+    """
+    now = datetime.now()
+    cost = sum(costs.values())
+    tokens = _refill(requester, REQUESTER_BUDGET, now)
+    global_tokens = _refill(GLOBAL_BUCKET, global_budget(), now)
+    admitted = local or cost <= tokens
+    deferred = not local and cost > global_tokens
+    if admitted and not dry_run:
+        _take(requester, max(0, tokens - cost), now)
+        _take(GLOBAL_BUCKET, max(0, global_tokens - cost), now)
+        query_db(text(
+            "INSERT INTO quota_log (requester, package_id, architecture, "
+            "cost, date) VALUES (:requester, :package_id, :arch, :cost, "
+            ":now)"
+        ), [{'requester': requester, 'package_id': package_id,
+             'arch': arch, 'cost': c, 'now': now}
+            for package_id, c in costs.items()])
+    return Admission(admitted, deferred, cost, tokens, global_tokens)
+
+
+def cost_report(requester, arch, names, costs, admission):
+    """
+    Log what a scheduling costs and what admit() decided about it.  names is
+    a {package_id: name} dict.
+    """
+    for package_id, cost in sorted(costs.items(), key=lambda x: -x[1]):
+        log.info('%8.2fh  %s/%s', cost, names.get(package_id, package_id),
+                 arch)
+    log.info('Total cost: %.2f build hours for %s packages', admission.cost,
+             len(costs))
+    log.info('Budget of %s: %.2f hours left out of %s', requester,
+             admission.tokens, REQUESTER_BUDGET)
+    log.info('Global budget: %.2f hours left', admission.global_tokens)
+    if not admission.admitted:
+        log.info('This scheduling exceeds the budget of %s', requester)
+    elif admission.deferred:
+        log.info('This scheduling exceeds the global budget, it would be '
+                 'deferred')
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# The build queue (the schedule table) is a priority queue: builders pick
+# the packages ordered by (priority, date_scheduled), the lower priority
+# value being the most urgent.  date_scheduled only orders the packages
+# within the same priority; the scheduler uses it to share the builders
+# fairly between the suites.  Packages waiting for too long get their
+# priority raised with the time they waited, but never out of their priority
+# class, so that nothing starves within a class.
+#
+# The expected build duration of every package (see rblib/durations.py) is
+# used to pack the queue by build hours instead of package counts.
+#
+# Builders take packages out of the queue with claim(), which marks them as
+# building (date_build_started and job) under a lease.  A builder alive keeps
+# renewing its lease; the claims whose lease expired, because their builder
+# died, are put back in the queue by expire_claims().  Like the timestamps
+# the builders write from the shell (date -u), the claims are in UTC.
+
+from enum import IntEnum
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from . import query_db
+from .confparse import log
+
+
+class Priority(IntEnum):
+    MANUAL = 10
+    DEFERRED = 15  # manual, over the global quota (see rblib/quota.py)
+    NEW = 20
+    UNTESTED = 30
+    DEPWAIT = 40
+    E404 = 50
+    FTBFS = 60
+    OLD = 70
+
+
+# the default priority of the schedule table, for the entries inserted
+# without one
+DEFAULT_PRIORITY = Priority.E404
+
+# within a priority class, a suite with weight 1 gets one package in the
+# queue every STRIDE, a suite with weight 2 every STRIDE/2, and so on
+STRIDE = timedelta(seconds=60)
+
+# packages waiting for longer than AGING_AFTER get their priority raised by
+# one every AGING_STEP, up to just after the class before theirs
+AGING_AFTER = timedelta(hours=24)
+AGING_STEP = timedelta(hours=12)
+
+# expected duration of the packages never built, in seconds
+DEFAULT_DURATION = 900
+
+# a claimed package goes back to the queue if its builder doesn't renew the
+# claim within LEASE
+LEASE = timedelta(hours=1)
+
+
+def fair_share(packages, priority, weights=None, start=None, costs=None):
+    """
+    Interleave the packages of several suites within a priority class.
+
+    packages is a {suite: [package_id, ...]} dict, every list already in the
+    order the packages should be built in; weights an optional {suite:
+    weight} dict (default 1).  This is stride scheduling: the n-th package of
+    a suite is scheduled at start + n*STRIDE/weight, so that builders pulling
+    by date_scheduled build the suites proportionally to their weight.
+    If costs, a {package_id: expected duration} dict, is given, the stride
+    after every package is proportional to its duration instead, so that the
+    suites get their share of build hours rather than of packages.
+    Return a list of rows for the schedule table.
+    """
+    if start is None:
+        start = datetime.now()
+    weights = weights or {}
+    mean = sum(costs.values()) / len(costs) if costs else None
+    rows = []
+    for suite, ids in packages.items():
+        stride = STRIDE / weights.get(suite, 1)
+        date = start
+        for package_id in ids:
+            rows.append({
+                'package_id': package_id,
+                'priority': int(priority),
+                'date_scheduled': date,
+            })
+            if mean:
+                date += stride * (costs.get(package_id, mean) / mean)
+            else:
+                date += stride
+    return rows
+
+
+def _aging_bands():
+    # yield (class, floor) for every priority class: the aged priorities of
+    # a class are in [floor, class], floor being just after the class before
+    previous = None
+    for priority in sorted(int(x) for x in Priority):
+        yield priority, (previous + 1 if previous is not None else priority)
+        previous = priority
+
+
+def aged_priority(priority, date_scheduled, now):
+    """
+    Return the priority of a package of the given (possibly already aged)
+    priority, scheduled at date_scheduled, once aged until now.
+    This is what age_schedule() computes in the database.
+    """
+    for cls, floor in _aging_bands():
+        if floor <= priority <= cls:
+            break
+    else:  # not in any class, leave it alone
+        return priority
+    waited = now - date_scheduled - AGING_AFTER
+    if waited <= timedelta(0):
+        return priority
+    return max(floor, cls - int(waited / AGING_STEP))
+
+
+def age_schedule(arch=None, now=None):
+    """
+    Raise the priority of the packages waiting to be built for longer than
+    AGING_AFTER, by one every AGING_STEP they waited after that, without
+    leaving their priority class (see aged_priority()).  As the priority
+    only depends on the time waited, this can run at any rate.
+    Return the number of packages aged.
+    """
+    now = now or datetime.now()
+    aged_sql = (
+        "GREATEST(:floor, :top - CAST(FLOOR((EXTRACT(EPOCH FROM "
+        ":now - sch.date_scheduled) - :after) / :step) AS INTEGER))"
+    )
+    query = (
+        "UPDATE schedule AS sch SET priority = " + aged_sql + " "
+        "FROM sources AS s WHERE s.id=sch.package_id "
+        "AND sch.build_type='ci_build' AND sch.date_build_started IS NULL "
+        "AND sch.priority BETWEEN :floor AND :top "
+        "AND sch.date_scheduled < :limit "
+        "AND sch.priority <> " + aged_sql
+    )
+    params = {'now': now, 'limit': now - AGING_AFTER,
+              'after': AGING_AFTER.total_seconds(),
+              'step': AGING_STEP.total_seconds()}
+    if arch:
+        query += " AND s.architecture=:arch"
+        params['arch'] = arch
+    aged = 0
+    for cls, floor in _aging_bands():
+        if floor < cls:
+            aged += query_db(text(query), floor=floor, top=cls,
+                             **params)
+    log.info('Raised the priority of %s packages waiting for more than %s',
+             aged, AGING_AFTER)
+    return aged
+
+
+def build_rate(arch, period=timedelta(days=1)):
+    """
+    Return the number of builds per second done on arch during the last
+    period, to estimate when the scheduled packages will be built.
+    """
+    query = text(
+        "SELECT count(*) FROM stats_build "
+        "WHERE architecture=:arch AND build_date > :since")
+    builds = query_db(query, arch=arch, since=datetime.now() - period)[0][0]
+    return builds / period.total_seconds()
+
+
+def build_costs(arch):
+    """Return a {package_id: expected build duration in seconds} dict for
+    arch."""
+    query = text(
+        "SELECT d.package_id, d.ewma FROM build_duration_stats AS d "
+        "JOIN sources AS s ON s.id=d.package_id WHERE s.architecture=:arch")
+    return dict(query_db(query, arch=arch))
+
+
+def queued_hours(arch):
+    """Return the expected build hours of the packages scheduled on arch."""
+    query = text(
+        "SELECT COALESCE(SUM(COALESCE(d.ewma, :default)), 0) "
+        "FROM schedule AS p JOIN sources AS s ON s.id=p.package_id "
+        "LEFT JOIN build_duration_stats AS d ON d.package_id=s.id "
+        "WHERE s.architecture=:arch AND p.build_type='ci_build'"
+    )
+    seconds = query_db(query, arch=arch, default=DEFAULT_DURATION)[0][0]
+    return float(seconds) / 3600
+
+
+def claim(arch, job, count=1, build_type='ci_build', distribution='debian',
+          lease=LEASE):
+    """
+    Atomically take the next count packages out of the queue of arch, and
+    mark them as being built by job.
+
+    The rows locked by a concurrent claim are skipped instead of waited for,
+    so any number of builders can claim at the same time without ever getting
+    the same package.  Return a list of (suite, id, name, version,
+    save_artifacts, notify, notify_maintainer, date_scheduled) rows, empty if
+    there is nothing to build.
+    """
+    now = datetime.utcnow()
+    query = text(
+        "UPDATE schedule AS sch "
+        "SET date_build_started=:started, job=:job, lease_expires=:expires "
+        "FROM sources AS s "
+        "WHERE s.id=sch.package_id AND sch.id IN ("
+        "  SELECT sch2.id FROM schedule AS sch2 "
+        "  JOIN sources AS s2 ON s2.id=sch2.package_id "
+        "  JOIN distributions AS d ON d.id=s2.distribution "
+        "  WHERE sch2.date_build_started IS NULL "
+        "  AND sch2.build_type=:build_type AND s2.architecture=:arch "
+        "  AND d.name=:distribution "
+        "  ORDER BY sch2.priority, sch2.date_scheduled LIMIT :count "
+        "  FOR UPDATE OF sch2 SKIP LOCKED) "
+        "RETURNING s.suite, s.id, s.name, s.version, sch.save_artifacts, "
+        "sch.notify, s.notify_maintainer, sch.date_scheduled"
+    )
+    claimed = query_db(query, started=now.strftime('%Y-%m-%d %H:%M'),
+                       job=job, expires=now + lease, build_type=build_type,
+                       arch=arch, distribution=distribution, count=count)
+    for row in claimed:
+        log.info('%s claimed %s/%s/%s', job, row[2], row[0], arch)
+    return claimed
+
+
+def renew(package_id, job, build_type='ci_build', lease=LEASE):
+    """
+    Extend the lease of a claim of job.  Return False if job doesn't hold
+    the claim anymore (it expired and the package went back to the queue).
+    """
+    query = text(
+        "UPDATE schedule SET lease_expires=:expires "
+        "WHERE package_id=:package_id AND job=:job AND build_type=:build_type"
+    )
+    renewed = query_db(query, expires=datetime.utcnow() + lease,
+                       package_id=package_id, job=job, build_type=build_type)
+    if not renewed:
+        log.warning('%s lost its claim on package %s', job, package_id)
+    return bool(renewed)
+
+
+def release(package_id, job=None, build_type='ci_build'):
+    """
+    Put a claimed package back in the queue, so that it is tried again.  If
+    job is given, only if that job still holds the claim.
+    """
+    query = (
+        "UPDATE schedule "
+        "SET date_build_started=NULL, job=NULL, lease_expires=NULL "
+        "WHERE package_id=:package_id AND build_type=:build_type"
+    )
+    params = {'package_id': package_id, 'build_type': build_type}
+    if job:
+        query += " AND job=:job"
+        params['job'] = job
+    return query_db(text(query), **params)
+
+
+def expire_claims():
+    """
+    Put back in the queue the packages whose claim expired, because their
+    builder died without releasing them.  Return the number of claims
+    expired.
+    """
+    query = text(
+        "UPDATE schedule AS sch "
+        "SET date_build_started=NULL, job=NULL, lease_expires=NULL "
+        "FROM sources AS s "
+        "WHERE s.id=sch.package_id AND sch.lease_expires < :now "
+        "RETURNING s.name, s.suite, s.architecture, sch.job"
+    )
+    expired = query_db(query, now=datetime.utcnow())
+    for name, suite, arch, job in expired:
+        log.warning('The claim of %s on %s/%s/%s expired, rescheduling it',
+                    job, name, suite, arch)
+    return len(expired)
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Depends: python3
+#
+# Move the old builds from stats_build to the archive (see rblib/history.py)
+# and regenerate the history pages of the packages whose archive changed.
+
+from rblib.confparse import log
+from rblib.history import archive_history
+from rblib.models import Package
+from reproducible_html_packages import gen_history_pages, distro_id
+
+
+if __name__ == '__main__':
+    # the builds of every distribution are archived, but only the pages of
+    # this one are generated
+    names = [name for name, distribution in archive_history()
+             if distribution == distro_id]
+    written = 0
+    for name in sorted(names):
+        written += gen_history_pages(Package(name, no_notes=True),
+                                     archive=True)
+    log.info('Wrote %s history pages of %s packages', written, len(names))
@@ -24,6 +24,7 @@ blacklist_packages() {
 			query_db "INSERT into results (package_id, version, status, build_date, job) VALUES ('$PKGID', '$VERSION', 'blacklisted', '$DATE', '');"
 		fi
 		query_db "DELETE FROM schedule WHERE package_id='$PKGID'"
+		record_change $PKGID "blacklisted"
 	done
 }
 
@@ -33,6 +34,7 @@ revert_blacklisted_packages() {
 		VERSION=$(query_db "SELECT version FROM sources WHERE name='$PKG' AND suite='$SUITE' AND architecture='$ARCH';")
 		PKGID=$(query_db "SELECT id FROM sources WHERE name='$PKG' AND suite='$SUITE' AND architecture='$ARCH';")
 		query_db "DELETE FROM results WHERE package_id='$PKGID' AND status='blacklisted';"
+		record_change $PKGID "unblacklisted"
 	done
 }
 
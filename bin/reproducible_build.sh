@@ -99,6 +99,9 @@ notification() {
 
 cleanup_all() {
 	echo "Starting cleanup."
+	if [ -n "$CLAIM_RENEWAL_PID" ] ; then
+		kill $CLAIM_RENEWAL_PID 2>/dev/null || true
+	fi
 	cd  # move out of $TMPDIR, if we are still inside
 	if [ "$MODE" = "master" ] ; then
 		notification
@@ -136,14 +139,25 @@ update_db_and_html() {
 	# Insert or update existing entry in results table
 	query_db "INSERT INTO results (package_id, version, status, build_date, build_duration, node1, node2, job) VALUES ('$SRCPKGID', '$VERSION', '$STATUS', '$DATE', '$DURATION', '$NODE1', '$NODE2', '$JOB') ON CONFLICT (package_id) DO UPDATE SET version='$VERSION', status='$STATUS', build_date='$DATE', build_duration='$DURATION', node1='$NODE1', node2='$NODE2', job='$JOB' WHERE results.package_id='$SRCPKGID'"
 	query_db "INSERT INTO stats_build (name, version, suite, architecture, status, build_date, build_duration, node1, node2, job) VALUES ('$SRCPACKAGE', '$VERSION', '$SUITE', '$ARCH', '$STATUS', '$DATE', '$DURATION', '$NODE1', '$NODE2', '$JOB')"
+	update_build_stats
 	# unmark build since it's properly finished
 	query_db "DELETE FROM schedule WHERE package_id='$SRCPKGID' AND build_type='ci_build';"
+	record_change $SRCPKGID "build result"
 	gen_package_html $SRCPACKAGE
 	echo
 	echo "$(date -u) - successfully updated the database and updated $DEBIAN_URL/rb-pkg/${SUITE}/${ARCH}/$SRCPACKAGE.html"
 	echo
 }
 
+update_build_stats() {
+	# fold this build (and any other not yet) into the statistics of the
+	# build durations, see rblib/durations.py
+	cd /srv/jenkins/bin
+	python3 -c "from rblib.durations import update_build_stats
+update_build_stats(wait=False)" -q || echo "Warning: cannot update the build duration statistics"
+	cd - > /dev/null
+}
+
 update_rbuildlog() {
 	chmod 644 $RBUILDLOG
 	mv $RBUILDLOG $DEBIAN_BASE/rbuild/${SUITE}/${ARCH}/${SRCPACKAGE}_${EVERSION}.rbuild.log
@@ -407,28 +421,37 @@ call_diffoscope_on_changes_files() {
 	esac
 }
 
+claim_package() {
+	# atomically take the next package out of the queue, see rblib/scheduling.py
+	cd /srv/jenkins/bin
+	local RESULT=0
+	python3 -c "from rblib.scheduling import claim
+for row in claim('$ARCH', '$JOB'):
+    print('|'.join('' if field is None else str(field) for field in row))" -q || RESULT=$?
+	cd - > /dev/null
+	return $RESULT
+}
+
+renew_claim() {
+	cd /srv/jenkins/bin
+	local RESULT=0
+	python3 -c "import sys
+from rblib.scheduling import renew
+sys.exit(not renew($SRCPKGID, '$JOB'))" -q || RESULT=$?
+	cd - > /dev/null
+	return $RESULT
+}
+
+start_claim_renewal() {
+	# keep our claim alive while building: the claims not renewed expire
+	# and their packages are put back in the queue by the scheduler
+	( while sleep 10m ; do
+		renew_claim || break
+	done ) > /dev/null 2>&1 &
+	CLAIM_RENEWAL_PID=$!
+}
+
 choose_package() {
-	DISTROID=$(query_db "SELECT id FROM distributions WHERE name='debian'")
-	local RESULT=$(query_db "
-		SELECT s.suite, s.id, s.name, s.version, sch.save_artifacts, sch.notify, s.notify_maintainer, sch.date_scheduled
-		FROM schedule AS sch JOIN sources AS s ON sch.package_id=s.id
-		WHERE sch.date_build_started is NULL
-		AND sch.build_type='ci_build'
-		AND s.distribution=$DISTROID
-		AND s.architecture='$ARCH'
-		ORDER BY date_scheduled LIMIT 5"|sort -R|head -1)
-	if [ -z "$RESULT" ] ; then
-		echo "No packages scheduled, sleeping 30m."
-		sleep 30m
-		exit 0
-	fi
-	SUITE=$(echo $RESULT|cut -d "|" -f1)
-	SRCPKGID=$(echo $RESULT|cut -d "|" -f2)
-	SRCPACKAGE=$(echo $RESULT|cut -d "|" -f3)
-	VERSION=$(echo $RESULT|cut -d "|" -f4)
-	SAVE_ARTIFACTS=$(echo $RESULT|cut -d "|" -f5)
-	NOTIFY=$(echo $RESULT|cut -d "|" -f6)
-	NOTIFY_MAINTAINER=$(echo $RESULT|cut -d "|" -f7)
 	# remove previous build attempts which didnt finish correctly:
 	JOB_PREFIX="${JOB_NAME#reproducible_builder_}/"
 	BAD_BUILDS=$(mktemp --tmpdir=$TMPDIR)
@@ -438,25 +461,32 @@ choose_package() {
 		# reproducible-stale-builds.log is mailed once a day by reproducible_maintenance.sh
 		echo -n "$(date -u) - stale builds found, cleaning db from these: " | tee -a $STALELOG
 		cat $BAD_BUILDS | tee -a $STALELOG
-		query_db "UPDATE schedule SET date_build_started = NULL, job = NULL WHERE job LIKE '${JOB_PREFIX}%'"
+		query_db "UPDATE schedule SET date_build_started = NULL, job = NULL, lease_expires = NULL WHERE job LIKE '${JOB_PREFIX}%'"
 	fi
 	rm -f $BAD_BUILDS
-	# mark build attempt, first test if none else marked a build attempt recently
-	echo "ok, let's check if $SRCPACKAGE is building anywhere yet…"
-	RESULT=$(query_db "SELECT date_build_started FROM schedule WHERE package_id='$SRCPKGID' AND build_type='ci_build'")
+	# claim a build, concurrent builders never get the same package
+	local RESULT
+	local CLAIMED=0
+	RESULT=$(claim_package) || CLAIMED=$?
+	if [ $CLAIMED -ne 0 ] ; then
+		# the traceback of the failure has been printed above
+		echo "$(date -u) - claiming a package failed with exit code $CLAIMED, aborting."
+		exit 1
+	fi
 	if [ -z "$RESULT" ] ; then
-		echo "ok, $SRCPACKAGE is not building anywhere…"
-		# try to update the schedule with our build attempt, then check no else did it, if so, abort
-		query_db "UPDATE schedule SET date_build_started='$DATE', job='$JOB' WHERE package_id='$SRCPKGID' AND build_type='ci_build' AND date_build_started IS NULL"
-		RESULT=$(query_db "SELECT date_build_started FROM schedule WHERE package_id='$SRCPKGID' AND date_build_started='$DATE' AND job='$JOB' AND build_type='ci_build'")
-		if [ -z "$RESULT" ] ; then
-			echo "hm, seems $SRCPACKAGE is building somewhere… failed to update the schedule table with our build ($SRCPKGID, $DATE, $JOB)."
-			handle_race_condition
-		fi
-	else
-		echo "hm, seems $SRCPACKAGE is building somewhere… schedule table now listed it as building somewhere else."
-		handle_race_condition
+		echo "No packages scheduled, sleeping 30m."
+		sleep 30m
+		exit 0
 	fi
+	SUITE=$(echo $RESULT|cut -d "|" -f1)
+	SRCPKGID=$(echo $RESULT|cut -d "|" -f2)
+	SRCPACKAGE=$(echo $RESULT|cut -d "|" -f3)
+	VERSION=$(echo $RESULT|cut -d "|" -f4)
+	SAVE_ARTIFACTS=$(echo $RESULT|cut -d "|" -f5)
+	NOTIFY=$(echo $RESULT|cut -d "|" -f6)
+	NOTIFY_MAINTAINER=$(echo $RESULT|cut -d "|" -f7)
+	echo "ok, $SRCPACKAGE claimed for building by $JOB."
+	start_claim_renewal
 	local ANNOUNCE=""
 	if [ $SAVE_ARTIFACTS -eq 1 ] ; then
 		ANNOUNCE="Artifacts will be preserved."
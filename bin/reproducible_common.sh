@@ -16,6 +16,12 @@ query_db() {
 	psql -t --no-align -c "$@" || exit 1
 }
 
+# record in the journal of changes that a package changed
+# (see bin/rblib/journal.py, including for the lock), parameters: package id and reason
+record_change() {
+	query_db "WITH journal_lock AS (SELECT pg_advisory_xact_lock_shared(27980790367741299)) INSERT INTO changes (package_id, name, suite, architecture, reason, date) SELECT id, name, suite, architecture, '$2', CURRENT_TIMESTAMP FROM sources, journal_lock WHERE id=$1"
+}
+
 # query reproducible database, output to csv format
 query_to_csv() {
 	psql -c "COPY ($@) to STDOUT with csv DELIMITER ','" || exit 1
@@ -742,7 +748,7 @@ handle_race_condition() {
 unregister_build() {
 	# unregister this build so it will immeditiatly tried again
 	if [ -n "$SRCPKGID" ] ; then
-		query_db "UPDATE schedule SET date_build_started = NULL, job = NULL WHERE package_id=$SRCPKGID AND build_type='ci_build'"  # XXX not only ci_build
+		query_db "UPDATE schedule SET date_build_started = NULL, job = NULL, lease_expires = NULL WHERE package_id=$SRCPKGID AND build_type='ci_build'"  # XXX not only ci_build
 	fi
 	NOTIFY=""
 }
@@ -13,12 +13,14 @@
 
 import re
 import sys
-from datetime import datetime
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 
 from rblib import query_db
-from rblib.confparse import log
-from rblib.const import DB_ENGINE, DB_METADATA
+from rblib.confparse import log, unknown_args
+from rblib.const import DB_METADATA, db_engine
 from rblib.utils import print_critical_message
 
 now = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
@@ -755,11 +757,222 @@ schema_updates = {
                 s.architecture, s.notify_maintainer, d.name AS distribution
             FROM sources s JOIN distributions d on s.distribution=d.id""",
     ],
+    50: [  # journal of the changes, for the incremental html generation
+        """CREATE TABLE changes
+           (id SERIAL PRIMARY KEY,
+            package_id INTEGER,
+            name TEXT NOT NULL,
+            suite TEXT NOT NULL,
+            architecture TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            date TIMESTAMP NOT NULL)""",
+        "CREATE INDEX changes_date_idx ON changes (date)",
+        """CREATE TABLE changes_consumers
+           (consumer TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            date TIMESTAMP NOT NULL,
+            PRIMARY KEY (consumer))""",
+    ],
+    51: [  # turn the schedule into a priority queue, see rblib/scheduling.py
+        "ALTER TABLE schedule ADD COLUMN priority SMALLINT NOT NULL DEFAULT 50",
+        "UPDATE schedule SET priority=10 WHERE scheduler IS NOT NULL",
+        """CREATE INDEX schedule_queue_idx
+           ON schedule (build_type, priority, date_scheduled)
+           WHERE date_build_started IS NULL""",
+    ],
+    52: [  # leases of the builds claimed, see rblib/scheduling.py
+        "ALTER TABLE schedule ADD COLUMN lease_expires TIMESTAMP",
+        """CREATE INDEX schedule_lease_idx ON schedule (lease_expires)
+           WHERE lease_expires IS NOT NULL""",
+    ],
+    53: [  # quotas of the manual scheduling, see rblib/quota.py
+        """CREATE TABLE quota_buckets
+           (requester TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            updated TIMESTAMP NOT NULL,
+            PRIMARY KEY (requester))""",
+        """CREATE TABLE quota_log
+           (id SERIAL,
+            requester TEXT NOT NULL,
+            package_id INTEGER,
+            architecture TEXT NOT NULL,
+            cost REAL NOT NULL,
+            date TIMESTAMP NOT NULL,
+            PRIMARY KEY (id, date))
+           PARTITION BY RANGE (date)""",
+        "CREATE TABLE quota_log_default PARTITION OF quota_log DEFAULT",
+        "CREATE INDEX quota_log_requester_idx ON quota_log (requester, date)",
+    ],
+    54: [  # statistics of the build durations, see rblib/durations.py
+        """CREATE TABLE build_duration_stats
+           (package_id INTEGER NOT NULL,
+            builds INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            ewma REAL NOT NULL,
+            p50 INTEGER NOT NULL,
+            p95 INTEGER NOT NULL,
+            last_duration INTEGER NOT NULL,
+            recent INTEGER[] NOT NULL,
+            last_build_id INTEGER NOT NULL,
+            PRIMARY KEY (package_id),
+            FOREIGN KEY (package_id) REFERENCES sources(id) ON DELETE CASCADE)""",
+        # a single row: the builds up to last_build_id are folded in the
+        # statistics, except the ones above last_build_id - 1000 not in folded
+        """CREATE TABLE build_duration_progress
+           (last_build_id INTEGER NOT NULL,
+            folded INTEGER[] NOT NULL)""",
+        # the percentiles are on the last 100 builds, the newest first; the
+        # moving average starts from the mean
+        """INSERT INTO build_duration_stats (package_id, builds, mean, ewma,
+               p50, p95, last_duration, recent, last_build_id)
+           SELECT h.package_id, h.builds, h.mean, h.mean,
+               (SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY x)
+                FROM unnest(h.recent) AS x),
+               (SELECT percentile_disc(0.95) WITHIN GROUP (ORDER BY x)
+                FROM unnest(h.recent) AS x),
+               h.recent[1], h.recent, h.last_build_id
+           FROM (SELECT s.id AS package_id,
+                     count(*) AS builds,
+                     avg(CAST(b.build_duration AS INTEGER)) AS mean,
+                     (array_agg(CAST(b.build_duration AS INTEGER)
+                                ORDER BY b.id DESC))[1:100] AS recent,
+                     max(b.id) AS last_build_id
+                 FROM stats_build AS b JOIN sources AS s ON s.name=b.name
+                 AND s.suite=b.suite AND s.architecture=b.architecture
+                 WHERE b.status IN ('reproducible', 'FTBR')
+                 GROUP BY s.id) AS h""",
+        """INSERT INTO build_duration_progress (last_build_id, folded)
+           SELECT COALESCE(MAX(id), 0), ARRAY(SELECT id FROM stats_build
+               WHERE id > (SELECT MAX(id) - 1000 FROM stats_build))
+           FROM stats_build""",
+    ],
+    55: [  # index what the queries filter on (results.package_id,
+           # schedule.package_id and stats_build.name are already indexed by
+           # their unique constraints)
+        """CREATE INDEX sources_suite_arch_idx
+           ON sources (suite, architecture, distribution)""",
+        "CREATE INDEX results_status_idx ON results (status)",
+        "CREATE INDEX results_build_date_idx ON results (build_date)",
+        """CREATE INDEX schedule_build_type_idx
+           ON schedule (build_type, package_id)""",
+        # stats_build only grows: partition it by year of build, so that the
+        # queries on the recent builds only look at the recent partitions
+        "ALTER TABLE stats_build RENAME TO stats_build_old",
+        """CREATE TABLE stats_build
+           (LIKE stats_build_old INCLUDING DEFAULTS)
+           PARTITION BY RANGE (build_date)""",
+        # the primary key of a partitioned table has to include build_date
+        "ALTER TABLE stats_build ADD PRIMARY KEY (id, build_date)",
+        """ALTER TABLE stats_build
+           ADD UNIQUE (name, version, suite, architecture, build_date)""",
+        """ALTER TABLE stats_build
+           ADD FOREIGN KEY (distribution) REFERENCES distributions(id)""",
+        """CREATE INDEX stats_build_arch_date_idx
+           ON stats_build (architecture, build_date)""",
+        "CREATE TABLE stats_build_default PARTITION OF stats_build DEFAULT",
+    ] + [
+        """CREATE TABLE stats_build_{0} PARTITION OF stats_build
+           FOR VALUES FROM ('{0}-01-01') TO ('{1}-01-01')""".format(y, y + 1)
+        for y in range(2014, datetime.now().year + 2)
+    ] + [
+        "INSERT INTO stats_build SELECT * FROM stats_build_old",
+        "DROP TABLE stats_build_old",
+    ],
+    56: [  # archive of the old builds, see rblib/history.py
+        # the arrays are large enough to be compressed and stored out of line
+        """CREATE TABLE stats_build_archive
+           (name TEXT NOT NULL,
+            suite TEXT NOT NULL,
+            architecture TEXT NOT NULL,
+            distribution INTEGER NOT NULL,
+            build_type build_type NOT NULL,
+            month TIMESTAMP NOT NULL,
+            builds INTEGER NOT NULL,
+            ids INTEGER[] NOT NULL,
+            versions TEXT[] NOT NULL,
+            statuses TEXT[] NOT NULL,
+            build_dates TIMESTAMP[] NOT NULL,
+            build_durations INTEGER[] NOT NULL,
+            node1s TEXT[] NOT NULL,
+            node2s TEXT[] NOT NULL,
+            jobs TEXT[] NOT NULL,
+            PRIMARY KEY (name, suite, architecture, distribution, build_type,
+                         month),
+            FOREIGN KEY (distribution) REFERENCES distributions(id))""",
+        # every build, archived or not
+        """CREATE VIEW stats_build_all AS
+           SELECT id, name, version, suite, architecture, distribution,
+               build_type, status, build_date,
+               CAST(build_duration AS INTEGER) AS build_duration, node1,
+               node2, job
+           FROM stats_build
+           UNION ALL
+           SELECT b.id, a.name, b.version, a.suite, a.architecture,
+               a.distribution, a.build_type, b.status, b.build_date,
+               b.build_duration, b.node1, b.node2, b.job
+           FROM stats_build_archive AS a,
+               unnest(a.ids, a.versions, a.statuses, a.build_dates,
+                      a.build_durations, a.node1s, a.node2s, a.jobs)
+               AS b(id, version, status, build_date, build_duration, node1,
+                    node2, job)""",
+    ],
 }
 
+# the queries run the most often, with example parameters, see explain()
+HOT_QUERIES = [
+    ('scheduler: candidates (query_candidates)',
+     """SELECT s.id, s.name, s.suite, s.version, r.version, r.status,
+            r.build_date, n.package_id IS NOT NULL, n.bugs
+        FROM sources AS s
+        LEFT JOIN results AS r ON r.package_id=s.id
+        LEFT JOIN notes AS n ON n.package_id=s.id
+        WHERE s.architecture=:arch AND s.suite = ANY(:suites)
+        AND NOT EXISTS (SELECT 1 FROM schedule AS p
+        WHERE p.package_id=s.id AND p.build_type='ci_build')"""),
+    ('scheduler: queue size',
+     """SELECT count(*) FROM schedule AS p
+        JOIN sources AS s ON p.package_id=s.id
+        WHERE s.architecture=:arch AND build_type='ci_build'"""),
+    ('builders: next packages (rblib.scheduling.claim)',
+     """SELECT sch.id FROM schedule AS sch
+        JOIN sources AS s ON s.id=sch.package_id
+        JOIN distributions AS d ON d.id=s.distribution
+        WHERE sch.date_build_started IS NULL
+        AND sch.build_type='ci_build' AND s.architecture=:arch
+        AND d.name='debian'
+        ORDER BY sch.priority, sch.date_scheduled LIMIT 5"""),
+    ('live status: schedule page (generate_schedule)',
+     """SELECT sch.date_scheduled, s.suite, s.name, r.status,
+            r.build_duration, d.mean, sch.priority
+        FROM sources AS s JOIN schedule AS sch ON sch.package_id=s.id
+        LEFT JOIN results AS r ON r.package_id=s.id
+        LEFT JOIN build_duration_stats AS d ON d.package_id=s.id
+        WHERE sch.date_build_started IS NULL AND s.architecture=:arch
+        ORDER BY sch.priority, sch.date_scheduled"""),
+    ('index pages: packages by status',
+     """SELECT s.name, r.status, r.build_date
+        FROM sources AS s JOIN results AS r ON r.package_id=s.id
+        WHERE s.suite=:suite AND s.architecture=:arch
+        AND s.distribution=1 AND r.status=:status
+        ORDER BY r.build_date DESC"""),
+    ('index pages: last builds',
+     """SELECT s.name, r.status, r.build_date
+        FROM sources AS s JOIN results AS r ON r.package_id=s.id
+        WHERE r.build_date > CURRENT_TIMESTAMP - INTERVAL '1 day'
+        ORDER BY r.build_date DESC"""),
+    ('builders: build rate (rblib.scheduling.build_rate)',
+     """SELECT count(*) FROM stats_build
+        WHERE architecture=:arch
+        AND build_date > CURRENT_TIMESTAMP - INTERVAL '1 day'"""),
+    ('package pages: build history',
+     """SELECT build_date, version, status, build_duration
+        FROM stats_build WHERE name=:name AND suite=:suite
+        AND architecture=:arch ORDER BY build_date DESC"""),
+]
+
 
 def table_exists(tablename):
-    DB_METADATA.reflect()
+    DB_METADATA.reflect(bind=db_engine())
     if tablename in DB_METADATA.tables:
         return True
     else:
@@ -783,6 +996,76 @@ def db_create_tables():
     return changed
 
 
+def ensure_stats_build_partitions():
+    """
+    Create the partitions of stats_build for this year and the next, if
+    they don't exist yet (the builds of the years without a partition go to
+    the default one).
+    """
+    if query_db('SELECT MAX(version) FROM rb_schema')[0][0] < 55:
+        return
+    year = datetime.now().year
+    for y in (year, year + 1):
+        query_db("CREATE TABLE IF NOT EXISTS stats_build_{0} PARTITION OF "
+                 "stats_build FOR VALUES FROM ('{0}-01-01') TO "
+                 "('{1}-01-01')".format(y, y + 1))
+
+
+def ensure_quota_log_partitions(months=3):
+    """
+    Create the monthly partitions of quota_log for this month and the next
+    ones, if they don't exist yet: manual schedulings only insert into it
+    (see rblib/quota.py), they have to be there beforehand.
+    """
+    if query_db('SELECT MAX(version) FROM rb_schema')[0][0] < 53:
+        return
+    start = datetime.now().replace(day=1, hour=0, minute=0, second=0,
+                                   microsecond=0)
+    for _ in range(months + 1):
+        end = (start + timedelta(days=32)).replace(day=1)
+        query_db("CREATE TABLE IF NOT EXISTS quota_log_{:%Y_%m} PARTITION OF "
+                 "quota_log FOR VALUES FROM ('{:%Y-%m-%d}') TO "
+                 "('{:%Y-%m-%d}')".format(start, start, end))
+        start = end
+
+
+def _seq_scans(plan):
+    # walk a plan from EXPLAIN (FORMAT JSON), yield its sequential scans
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan
+    for subplan in plan.get('Plans', []):
+        yield from _seq_scans(subplan)
+
+
+def explain(arch='amd64', suite='unstable'):
+    """
+    Run the HOT_QUERIES with EXPLAIN (ANALYZE, BUFFERS) and report their
+    execution time, their buffer usage and the sequential scans they do.
+    Everything is rolled back.
+    """
+    params = {'arch': arch, 'suite': suite, 'suites': [suite],
+              'status': 'FTBR', 'name': 'bash'}
+    conn = db_engine().connect()
+    for name, query in HOT_QUERIES:
+        transaction = conn.begin()
+        try:
+            result = conn.execute(text(
+                'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query), **params)
+            report = result.fetchone()[0][0]
+        finally:
+            transaction.rollback()
+        plan = report['Plan']
+        log.info('%s: %.1fms, %s shared buffers hit, %s read', name,
+                 report['Execution Time'], plan.get('Shared Hit Blocks', 0),
+                 plan.get('Shared Read Blocks', 0))
+        for scan in _seq_scans(plan):
+            log.warning('\tSeq Scan on %s: %s rows%s', scan['Relation Name'],
+                        scan.get('Actual Rows', '?'),
+                        ', filter: ' + scan['Filter'] if 'Filter' in scan
+                        else '')
+    conn.close()
+
+
 def db_update():
     """
     Update the database schema.
@@ -803,7 +1086,7 @@ def db_update():
                                '  the last update available.\nPlease check!')
         sys.exit(1)
     log.info('Found schema updates.')
-    Session = sessionmaker(bind=DB_ENGINE, autocommit=True)
+    Session = sessionmaker(bind=db_engine(), autocommit=True)
     session = Session()
     for update in range(current+1, last+1):
         log.info('Applying database update #' + str(update) + '. Queries:')
@@ -822,6 +1105,23 @@ def db_update():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--explain', action='store_true',
+                        help='report how the hot queries are executed instead '
+                        'of updating the database')
+    parser.add_argument('--partitions', action='store_true',
+                        help='only create the upcoming partitions of the '
+                        'partitioned tables')
+    parser.add_argument('-a', '--architecture', default='amd64')
+    parser.add_argument('-s', '--suite', default='unstable')
+    maintenance_args = parser.parse_known_args(unknown_args)[0]
+    if maintenance_args.explain:
+        explain(maintenance_args.architecture, maintenance_args.suite)
+        sys.exit(0)
+    if maintenance_args.partitions:
+        ensure_stats_build_partitions()
+        ensure_quota_log_partitions()
+        sys.exit(0)
     changed_created = False
     if table_exists('rb_schema'):
         if not query_db('SELECT * FROM rb_schema'):
@@ -832,6 +1132,8 @@ if __name__ == '__main__':
         log.error('Will run a full db_create_tables().')
         changed_created = db_create_tables()
     changed = db_update()
+    ensure_stats_build_partitions()
+    ensure_quota_log_partitions()
     if changed or changed_created:
         log.info('Total execution time: ' + str(datetime.now() -
                  datetime.strptime(now, "%Y-%m-%d-%H-%M-%S")))
@@ -17,7 +17,7 @@ import os.path
 from subprocess import check_call
 from datetime import datetime, timedelta
 
-from rblib import query_db
+from rblib import query_db, query_db_iter
 from rblib.confparse import log
 from rblib.models import Package
 from rblib.html import tab, create_main_navigation, write_html_page
@@ -40,7 +40,7 @@ def unrep_with_dbd_issues():
                WHERE r.status='FTBR'
                AND s.distribution = (SELECT id FROM distributions WHERE name = 'debian')
                ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
+    results = query_db_iter(query)
     for pkg, version, suite, arch in results:
         eversion = strip_epoch(version)
         dbd = DBD_PATH + '/' + suite + '/' + arch + '/' + pkg + '_' + \
@@ -78,7 +78,7 @@ def not_unrep_with_dbd_file():
                WHERE r.status != 'FTBR'
                AND s.distribution = (SELECT id FROM distributions WHERE name = 'debian')
                ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
+    results = query_db_iter(query)
     for pkg, version, suite, arch in results:
         eversion = strip_epoch(version)
         for prefix, extension in ((
@@ -104,7 +104,7 @@ def lack_rbuild():
                WHERE r.status NOT IN ('blacklisted', '')
                AND s.distribution = (SELECT id FROM distributions WHERE name = 'debian')
                ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
+    results = query_db_iter(query)
     for pkg, version, suite, arch in results:
         rbuild = os.path.join(RBUILD_PATH, suite, arch) + \
                 '/{}_{}.rbuild.log.gz'.format(pkg, strip_epoch(version))
@@ -124,7 +124,7 @@ def lack_buildinfo():
                 ('blacklisted', 'NFU', 'FTBFS', 'timeout', 'depwait', 'E404')
                AND s.distribution = (SELECT id FROM distributions WHERE name = 'debian')
                ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
+    results = query_db_iter(query)
     for pkg, version, suite, arch in results:
         eversion = strip_epoch(version)
         buildinfo = BUILDINFO_PATH + '/' + suite + '/' + arch + '/' + pkg + \
@@ -270,15 +270,25 @@ def alien_rbpkg():
 
 def alien_history():
     log.info('running alien_history check...')
-    result = query_db('SELECT DISTINCT name FROM sources')
-    actual_packages = [x[0] for x in result]
+    # the package names and the pages are both walked in the same order, so
+    # that the names don't need to be all kept in memory
+    actual_packages = query_db_iter(
+        'SELECT DISTINCT name FROM sources ORDER BY name COLLATE "C"')
+    current = next(actual_packages, None)
     bad_files = []
-    for f in sorted(os.listdir(HISTORY_PATH)):
+    # the pages are name.html, or name_year.html for the archived builds
+    page_name = lambda f: f.rsplit('.', 1)[0].split('_')[0]
+    for f in sorted(os.listdir(HISTORY_PATH), key=page_name):
         full_path = os.path.join(HISTORY_PATH, f)
-        if f.rsplit('.', 1)[0] not in actual_packages and not os.path.isdir(full_path):
+        if os.path.isdir(full_path):
+            continue
+        while current is not None and current[0] < page_name(f):
+            current = next(actual_packages, None)
+        if current is None or current[0] != page_name(f):
             bad_files.append(full_path)
             os.remove(full_path)
             log.warning('%s should not be there so it has been removed.', full_path)
+    actual_packages.close()
     return bad_files
 
 
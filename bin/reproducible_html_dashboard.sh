@@ -302,7 +302,7 @@ _average_builds_per_day() {
 	local MIN_DAYS="${3-0}"
 	write_page "<tr><td class=\"left\">packages tested on average per day in the last $TIMESPAN_VERBOSE</td>"
 	for ARCH in ${ARCHS} ; do
-		local OLDEST_BUILD="$(query_db "SELECT build_date FROM stats_build WHERE architecture='$ARCH' ORDER BY build_date ASC LIMIT 1")"
+		local OLDEST_BUILD="$(query_db "SELECT build_date FROM stats_build_all WHERE architecture='$ARCH' ORDER BY build_date ASC LIMIT 1")"
 		local DAY_DIFFS="$(( ($(date -d "$DATE" +%s) - $(date -d "$OLDEST_BUILD" +%s)) / (60*60*24) ))"
 		local DISCLAIMER=""
 		local TIMESPAN="$TIMESPAN_RAW"
@@ -11,15 +11,19 @@
 # Build quite all index_* pages
 
 import sys
+import time
+import sqlalchemy
+import multiprocessing
 from string import Template
 from datetime import datetime, timedelta
-from sqlalchemy import select, and_, or_, func, bindparam, desc
 
-from rblib import query_db, db_table
-from rblib.confparse import log
+from rblib import query_db, reconnect_db
+from rblib.confparse import log, args
+from rblib.journal import changes_since, last_change_id, set_watermark
 from rblib.models import Status, Package
 from rblib.utils import print_critical_message
-from rblib.html import tab, create_main_navigation, write_html_page
+from rblib.html import tab, create_main_navigation, write_html_page, \
+    write_stats, add_write_stats, render_stats, add_render_stats
 from rblib.const import (
     DISTRO, DISTRO_BASE, DISTRO_URI, DISTRO_URL,
     SUITES, ARCHS,
@@ -31,19 +35,21 @@ from rblib.const import (
 Reference doc for the folowing lists:
 
 * queries is just a list of queries. They are referred further below.
-  + every query must return only a list of package names (excpet count_total)
+  + every query is a function filtering the rows returned by package_rows()
+    for a suite/arch, and returns the rows of the packages to list (except
+    count_total and count_timespan, which return a number).
 * pages is just a list of pages. It is actually a dictionary, where every
   element is a page. Every page has:
   + `title`: The page title
   + `header`: (optional) sane html to be printed on top of the page
-  + `header_query`: (optional): the output of this query is put inside "tot" of
-    the string above
+  + `header_count`: (optional): the number of rows of package_rows() matching
+    this function is put inside "tot" of the string above
   + `body`: a list of dicts containing every section that made up the page.
     Every section has:
     - `icon_status`: the name of a icon (see rblib.models.Status)
     - `icon_link`: a link to hide below the icon
-    - `query`: query to perform against the reproducible db to get the list of
-      packages to show
+    - `query`: query to perform against the rows of the suite/arch to get the
+      list of packages to show
     - `text` a string. Template instance with $tot (total of packages listed)
       and $percent (percentage of all packages)
     - `timespan`: value set to '24' or '48' to enable to add $count, $count_total.
@@ -61,283 +67,124 @@ Reference doc for the folowing lists:
     - force the suite/arch to the defaults
   + notes: if true the query also takes the value "status"
 
+All the data comes from a single query per suite/arch, see package_rows().
+
 
 Technically speaking, a page can be empty (we all love nonsense) but every
 section must have at least a `query` defining what to file in.
 """
 
 timespan_date_map = {}
-timespan_date_map[24] = (datetime.now()-timedelta(hours=24)).strftime('%Y-%m-%d %H:%M')
-timespan_date_map[48] = (datetime.now()-timedelta(hours=48)).strftime('%Y-%m-%d %H:%M')
+timespan_date_map[24] = datetime.now() - timedelta(hours=24)
+timespan_date_map[48] = datetime.now() - timedelta(hours=48)
+
+distro_id = query_db(sqlalchemy.text(
+    "SELECT id FROM distributions WHERE name=:name"), name=DISTRO)[0][0]
+
+# every section, count and header of the pages of a suite/arch is computed
+# from this single set of rows, see package_rows()
+_package_rows_query = sqlalchemy.text(
+    "SELECT s.name, s.notify_maintainer, r.status, r.build_date, "
+    "n.package_id IS NOT NULL AS noted, n.issues "
+    "FROM sources AS s "
+    "LEFT JOIN results AS r ON r.package_id=s.id "
+    "LEFT JOIN notes AS n ON n.package_id=s.id "
+    "WHERE s.distribution=:distro AND s.suite=:suite AND s.architecture=:arch"
+)
+_package_rows = {}
+
+
+def package_rows(suite, arch):
+    """
+    Return the packages of suite/arch, with their name, notify_maintainer,
+    status and build_date (both None if the package was never tested),
+    whether they have notes (noted) and their issues.
+    The rows are fetched once per suite/arch and kept for the whole run.
+    """
+    if (suite, arch) not in _package_rows:
+        _package_rows[(suite, arch)] = query_db(
+            _package_rows_query, distro=distro_id, suite=suite, arch=arch)
+    return _package_rows[(suite, arch)]
+
+
+def tested(row):
+    return row.status is not None
+
+
+def built_since(row, timespan):
+    return row.build_date is not None and \
+        row.build_date > timespan_date_map[timespan]
+
+
+def by_date(rows):
+    return sorted(rows, key=lambda r: r.build_date or datetime.min,
+                  reverse=True)
+
+
+def by_name(rows):
+    return sorted(rows, key=lambda r: r.name)
+
+
+def select_sources(where, order=by_date):
+    """
+    Return a query: a function returning the package rows matching where, a
+    function taking the row and the status of the section, sorted by order.
+    """
+    def query(rows, status=None):
+        return order([r for r in rows if where(r, status)])
+    return query
+
+
+def status_is(status, timespan=None):
+    """Match the packages with status, built in the last timespan hours."""
+    def where(row, _):
+        return row.status == status.value.name and (
+            timespan is None or built_since(row, timespan))
+    return where
 
-# sqlalchemy table definitions needed for queries
-distributions = db_table('distributions')
-results = db_table('results')
-sources = db_table('sources')
-notes = db_table('notes')
 
 # filtered_issues is defined in reproducible_common.py and
 # can be used to excludes some FTBFS issues
-filter_issues_list = []
-for issue in filtered_issues:
-    filter_issues_list.append(notes.c.issues.contains(issue))
-if not filtered_issues:
-    filter_issues_list = [None]
-
-distro_id = query_db(select([distributions.c.id]).where(distributions.c.name == DISTRO))[0][0]
-
-count_results = select(
-    [func.count(results.c.id)]
-).select_from(
-    results.join(sources)
-).where(
-    and_(
-        sources.c.distribution == distro_id,
-        sources.c.suite == bindparam('suite'),
-        sources.c.architecture == bindparam('arch')
-    )
-)
+def filtered(row):
+    return row.noted and any(issue in (row.issues or '')
+                             for issue in filtered_issues)
 
-select_sources = select(
-    [sources.c.name]
-).select_from(
-    results.join(sources)
-).where(
-    and_(
-        sources.c.distribution == distro_id,
-        sources.c.suite == bindparam('suite'),
-        sources.c.architecture == bindparam('arch')
-    )
-)
 
 queries = {
-    "count_total": count_results,
-    "count_timespan":
-        count_results.where(
-                results.c.build_date > bindparam('timespan_date'),
-        ),
-    "reproducible_all":
-        select_sources.where(
-            results.c.status == Status.REPRODUCIBLE.value.name,
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "reproducible_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.REPRODUCIBLE.value.name,
-                results.c.build_date > timespan_date_map[24],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "reproducible_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.REPRODUCIBLE.value.name,
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "reproducible_all_abc":
-        select_sources.where(
-            results.c.status == Status.REPRODUCIBLE.value.name,
-        ).order_by(
-            sources.c.name
-        ),
-    "FTBR_all":
-        select_sources.where(
-            results.c.status == Status.FTBR.value.name
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBR_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.FTBR.value.name,
-                results.c.build_date > timespan_date_map[24],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBR_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.FTBR.value.name,
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBR_all_abc":
-        select_sources.where(
-            results.c.status == Status.FTBR.value.name
-        ).order_by(
-            sources.c.name
-        ),
-    "FTBFS_all":
-        select_sources.where(
-            results.c.status == Status.FTBFS.value.name,
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.FTBFS.value.name,
-                results.c.build_date > timespan_date_map[24],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.FTBFS.value.name,
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_all_abc":
-        select_sources.where(
-            results.c.status == Status.FTBFS.value.name,
-        ).order_by(
-            sources.c.name
-        ),
-    "FTBFS_filtered":
-        select_sources.where(
-            and_(
-                results.c.status == Status.FTBFS.value.name,
-                sources.c.id.notin_(
-                    select(
-                        [notes.c.package_id]
-                    ).select_from(
-                        notes
-                    ).where(
-                        or_(*filter_issues_list)
-                    )
-                )
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_caused_by_us":
-        select_sources.where(
-            and_(
-                results.c.status == Status.FTBFS.value.name,
-                sources.c.id.in_(
-                    select(
-                        [notes.c.package_id]
-                    ).select_from(
-                        notes
-                    ).where(
-                        or_(*filter_issues_list)
-                    )
-                )
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "E404_all":
-        select_sources.where(
-            results.c.status == Status.E404.value.name,
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "E404_all_abc":
-        select_sources.where(
-            results.c.status == Status.E404.value.name,
-        ).order_by(
-            sources.c.name
-        ),
-    "depwait_all":
-        select_sources.where(
-            results.c.status == Status.DEPWAIT.value.name,
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "depwait_all_abc":
-        select_sources.where(
-            results.c.status == Status.DEPWAIT.value.name,
-        ).order_by(
-            sources.c.name
-        ),
-    "depwait_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.DEPWAIT.value.name,
-                results.c.build_date > timespan_date_map[24],
-
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "depwait_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == Status.DEPWAIT.value.name,
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "timeout_all":
-        select_sources.where(
-            and_(
-                results.c.status == Status.TIMEOUT.value.name
-            )
-        ).order_by(
-            sources.c.name
-        ),
-    "not_for_us_all":
-        select_sources.where(
-            and_(
-                results.c.status == Status.NFU.value.name
-            )
-        ).order_by(
-            sources.c.name
-        ),
-    "blacklisted_all":
-        select_sources.where(
-            results.c.status == Status.BLACKLISTED.value.name,
-        ).order_by(
-            sources.c.name
-        ),
-    "notes":
-        select(
-            [sources.c.name]
-        ).select_from(
-            sources.join(results).join(notes)
-        ).where(
-            and_(
-                sources.c.distribution == distro_id,
-                results.c.status == bindparam('status'),
-                sources.c.suite == bindparam('suite'),
-                sources.c.architecture == bindparam('arch')
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "no_notes":
-        select_sources.where(
-            and_(
-                results.c.status == bindparam('status'),
-                sources.c.id.notin_(select([notes.c.package_id]).select_from(notes))
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "notification":
-        select_sources.where(
-            and_(
-                results.c.status == bindparam('status'),
-                sources.c.notify_maintainer == 1
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
+    "count_total": lambda rows: sum(1 for r in rows if tested(r)),
+    "count_timespan": lambda rows, timespan: sum(
+        1 for r in rows if tested(r) and built_since(r, timespan)),
+    "reproducible_all": select_sources(status_is(Status.REPRODUCIBLE)),
+    "reproducible_last24h": select_sources(status_is(Status.REPRODUCIBLE, 24)),
+    "reproducible_last48h": select_sources(status_is(Status.REPRODUCIBLE, 48)),
+    "reproducible_all_abc": select_sources(status_is(Status.REPRODUCIBLE),
+                                           by_name),
+    "FTBR_all": select_sources(status_is(Status.FTBR)),
+    "FTBR_last24h": select_sources(status_is(Status.FTBR, 24)),
+    "FTBR_last48h": select_sources(status_is(Status.FTBR, 48)),
+    "FTBR_all_abc": select_sources(status_is(Status.FTBR), by_name),
+    "FTBFS_all": select_sources(status_is(Status.FTBFS)),
+    "FTBFS_last24h": select_sources(status_is(Status.FTBFS, 24)),
+    "FTBFS_last48h": select_sources(status_is(Status.FTBFS, 48)),
+    "FTBFS_all_abc": select_sources(status_is(Status.FTBFS), by_name),
+    "FTBFS_filtered": select_sources(
+        lambda r, s: status_is(Status.FTBFS)(r, s) and not filtered(r)),
+    "FTBFS_caused_by_us": select_sources(
+        lambda r, s: status_is(Status.FTBFS)(r, s) and filtered(r)),
+    "E404_all": select_sources(status_is(Status.E404)),
+    "E404_all_abc": select_sources(status_is(Status.E404), by_name),
+    "depwait_all": select_sources(status_is(Status.DEPWAIT)),
+    "depwait_all_abc": select_sources(status_is(Status.DEPWAIT), by_name),
+    "depwait_last24h": select_sources(status_is(Status.DEPWAIT, 24)),
+    "depwait_last48h": select_sources(status_is(Status.DEPWAIT, 48)),
+    "timeout_all": select_sources(status_is(Status.TIMEOUT), by_name),
+    "not_for_us_all": select_sources(status_is(Status.NFU), by_name),
+    "blacklisted_all": select_sources(status_is(Status.BLACKLISTED), by_name),
+    "notes": select_sources(lambda r, status: r.status == status and r.noted),
+    "no_notes": select_sources(
+        lambda r, status: r.status == status and not r.noted),
+    "notification": select_sources(
+        lambda r, status: r.status == status and r.notify_maintainer == 1),
 }
 
 pages = {
@@ -566,7 +413,7 @@ pages = {
         'notes': True,
         'title': 'Packages with notes',
         'header': '<p>There are {tot} packages with notes in {suite}/{arch}.</p>',
-        'header_query': "SELECT count(*) FROM (SELECT s.name FROM sources AS s JOIN notes AS n ON n.package_id=s.id WHERE s.distribution={distro} AND s.suite='{suite}' AND s.architecture='{arch}' GROUP BY s.name) AS tmp",
+        'header_count': lambda r: r.noted,
         'body': [
             {
                 'status': Status.FTBR,
@@ -623,7 +470,7 @@ pages = {
         'notes_hint': True,
         'title': 'Packages without notes',
         'header': '<p>There are {tot} faulty packages without notes in {suite}/{arch}.{hint}</p>',
-        'header_query': "SELECT COUNT(*) FROM (SELECT s.id FROM sources AS s JOIN results AS r ON r.package_id=s.id WHERE s.distribution={distro} AND r.status IN ('FTBR', 'FTBFS', 'blacklisted') AND s.id NOT IN (SELECT package_id FROM notes) AND s.suite='{suite}' AND s.architecture='{arch}') AS tmp",
+        'header_count': lambda r: r.status in ('FTBR', 'FTBFS', 'blacklisted') and not r.noted,
         'body': [
             {
                 'status': Status.FTBR,
@@ -652,7 +499,7 @@ pages = {
         'nosuite': True,
         'title': 'Packages with notification enabled',
         'header': '<p>The following {tot} packages have notifications enabled. (This page only shows packages in {suite}/{arch} though notifications are send for these packages in unstable and experimental in all tested architectures.) On status changes (e.g. reproducible → unreproducible) the system notifies the maintainer and relevant parties via an email to $srcpackage@packages.debian.org. Notifications are collected and send once a day to avoid flooding.<br />Please ask us to enable notifications for your package(s) in our IRC channel #debian-reproducible or via <a href="mailto:reproducible-builds@lists.alioth.debian.org">mail</a> - but ask your fellow team members first if they want to receive such notifications.</p>',
-        'header_query': "SELECT COUNT(*) FROM sources WHERE distribution={distro} AND suite='{suite}' AND architecture='{arch}' AND notify_maintainer = 1",
+        'header_count': lambda r: r.notify_maintainer == 1,
         'body': [
             {
                 'status': Status.FTBR,
@@ -683,7 +530,8 @@ pages = {
 def build_leading_text_section(section, rows, suite, arch):
     html = '<p>\n' + tab
     total = len(rows)
-    count_total = int(query_db(queries['count_total'].params({'suite': suite, 'arch': arch}))[0][0])
+    all_rows = package_rows(suite, arch)
+    count_total = queries['count_total'](all_rows)
     try:
         percent = round(((total/count_total)*100), 1)
     except ZeroDivisionError:
@@ -702,13 +550,10 @@ def build_leading_text_section(section, rows, suite, arch):
         html += '</a>'
     html += '\n' + tab
     if section.get('text') and section.get('timespan'):
-        count = len(query_db(queries[section['query2']].params(
-            {'suite': suite, 'arch': arch})))
+        count = len(queries[section['query2']](all_rows))
         percent = round(((count/count_total)*100), 1)
-        timespan = section['timespan']
-        timespan_date = timespan_date_map[timespan]
-        timespan_count = int(query_db(queries['count_timespan'].params(
-            {'suite': suite, 'arch': arch, 'timespan_date': timespan_date}))[0][0])
+        timespan_count = queries['count_timespan'](all_rows,
+                                                   section['timespan'])
         try:
             timespan_percent = round(((total/timespan_count)*100), 1)
         except ZeroDivisionError:
@@ -731,46 +576,50 @@ def build_leading_text_section(section, rows, suite, arch):
 
 
 def build_page_section(page, section, suite, arch):
-    try:
-        if pages[page].get('global') and pages[page]['global']:
-            suite = defaultsuite
-            arch = defaultarch
-        if pages[page].get('notes') and pages[page]['notes']:
-            db_status = section['status'].value.name
-            query = queries[section['query']].params({
-                'status': db_status,
-                'suite': suite, 'arch': arch
-            })
-            section['icon_status'] = section['status'].value.icon
-        else:
-            query = queries[section['query']].params({'suite': suite, 'arch': arch})
-        rows = query_db(query)
-    except:
-        print_critical_message('A query failed: %s' % query)
-        raise
+    if pages[page].get('notes') and pages[page]['notes']:
+        rows = queries[section['query']](package_rows(suite, arch),
+                                         section['status'].value.name)
+        section['icon_status'] = section['status'].value.icon
+    else:
+        rows = queries[section['query']](package_rows(suite, arch))
     html = ''
     footnote = True if rows else False
     if not rows: # there are no package in this set, do not output anything
-        log.debug('empty query: %s' %
-            query.compile(compile_kwargs={"literal_binds": True}))
+        log.debug('empty query: %s in %s/%s', section['query'], suite, arch)
         return (html, footnote)
     html += build_leading_text_section(section, rows, suite, arch)
     html += '<p>\n' + tab + '<code>\n'
+    # the links only need the notes and the bugs, both loaded once for all
+    # the packages (see rblib.models._Notes_cache and rblib.bugs.Bugs)
     for row in rows:
-        pkg = row[0]
-        html += tab*2 + Package(pkg).html_link(suite, arch)
-    else:
-        html += tab + '</code>\n'
-        html += '</p>'
+        html += tab*2 + Package(row.name).html_link(suite, arch)
+    html += tab + '</code>\n'
+    html += '</p>'
     if section.get('bottom'):
         html += section['bottom']
     html = (tab*2).join(html.splitlines(True))
     return (html, footnote)
 
 
-def build_page(page, suite=None, arch=None):
+def _global_section(page, index, suite, arch, sections):
+    try:
+        return sections[(page, index, suite, arch)]
+    except KeyError:
+        log.debug('global page §' + str(index) + ' in ' + page + ' for ' +
+                  suite + '/' + arch)
+        return build_page_section(page, pages[page]['body'][index],
+                                  suite, arch)[0]
+
+
+def build_page(page, suite=None, arch=None, sections=None):
+    """
+    Build an index page.  For the global pages, the sections already built
+    by global_page_sections() can be given in sections, only the missing
+    ones are built.
+    """
     if 'limit' in pages[page] and DISTRO not in pages[page]['limit']:
         return
+    sections = sections or {}
     gpage = False
     if pages[page].get('global') and pages[page]['global']:
         gpage = True
@@ -795,21 +644,20 @@ def build_page(page, suite=None, arch=None):
             hint = ' <em>These</em> are the packages with failures that <em>still need to be investigated</em>.'
         else:
             hint = ''
-        if pages[page].get('header_query'):
-            result = query_db(pages[page]['header_query'].format(distro=distro_id, suite=suite, arch=arch))
-            html += pages[page]['header'].format(tot=result[0][0], suite=suite, arch=arch, hint=hint)
+        if pages[page].get('header_count'):
+            tot = sum(1 for r in package_rows(suite, arch)
+                      if pages[page]['header_count'](r))
+            html += pages[page]['header'].format(tot=tot, suite=suite, arch=arch, hint=hint)
         else:
             html += pages[page].get('header')
-    for section in page_sections:
+    for index, section in enumerate(page_sections):
         if gpage:
             if section.get('nosuite') and section['nosuite']:  # only defaults
-                html += build_page_section(page, section, suite, arch)[0]
+                html += _global_section(page, index, suite, arch, sections)
             else:
-                for suite in SUITES:
-                    for arch in ARCHS:
-                        log.debug('global page §' + section['status'].name +
-                                  ' in ' + page + ' for ' + suite + '/' + arch)
-                        html += build_page_section(page, section, suite, arch)[0]
+                for s in SUITES:
+                    for a in ARCHS:
+                        html += _global_section(page, index, s, a, sections)
             footnote = True
         else:
             html1, footnote1 = build_page_section(page, section, suite, arch)
@@ -838,12 +686,120 @@ def build_page(page, suite=None, arch=None):
     log.info('"' + title + '" now available at ' + desturl)
 
 
+def is_global(page):
+    return pages[page].get('global', False)
+
+
+def global_page_sections(suite, arch):
+    """
+    Build the sections of the global pages that show the packages of
+    suite/arch, and return them as a {(page, index, suite, arch): html}
+    dict, to be given to build_page().
+    """
+    sections = {}
+    for page in pages:
+        if not is_global(page) or ('limit' in pages[page] and
+                                   DISTRO not in pages[page]['limit']):
+            continue
+        for index, section in enumerate(pages[page]['body']):
+            if section.get('nosuite') and (suite, arch) != (defaultsuite,
+                                                             defaultarch):
+                continue
+            sections[(page, index, suite, arch)] = build_page_section(
+                page, section, suite, arch)[0]
+    return sections
+
+
+def build_suite_arch_pages(suite_arch, with_sections=True):
+    """
+    Build all the index pages of a suite/arch, and with_sections the
+    sections of the global pages for it too.
+    Return (suite, arch, timings, sections), timings being a list of
+    (page, seconds) and sections as returned by global_page_sections().
+    """
+    suite, arch = suite_arch
+    timings = []
+    for page in pages:
+        if is_global(page):
+            continue
+        start = time.monotonic()
+        build_page(page, suite, arch)
+        timings.append((page, time.monotonic() - start))
+    sections = {}
+    if with_sections:
+        start = time.monotonic()
+        sections = global_page_sections(suite, arch)
+        timings.append(('global sections', time.monotonic() - start))
+    return suite, arch, timings, sections
+
+
+def _worker_build_suite_arch_pages(suite_arch, with_sections=True):
+    before = write_stats()
+    before_render = render_stats()
+    result = build_suite_arch_pages(suite_arch, with_sections)
+    after = write_stats()
+    # the counters of the worker are merged into the ones of the parent
+    stats = {k: after[k] - before[k] for k in after}
+    return result, stats, render_stats(since=before_render)
+
+
+def build_all_pages(suite_archs, with_global=True, jobs=None):
+    """
+    Build the index pages of the given (suite, arch), using jobs worker
+    processes (by default the value of the --jobs command line option), and
+    with_global the global pages, out of the sections built by the workers.
+    """
+    if jobs is None:
+        jobs = args.jobs
+    jobs = max(1, min(jobs, len(suite_archs)))
+    log.info('Building the index pages of %s suite/arch using %s '
+             'process(es)', len(suite_archs), jobs)
+    sections = {}
+    timings = []
+
+    def collect(result):
+        suite, arch, page_timings, page_sections = result
+        sections.update(page_sections)
+        for page, seconds in page_timings:
+            log.info('%6.2fs  %s in %s/%s', seconds, page, suite, arch)
+            timings.append((seconds, page, suite + '/' + arch))
+
+    if jobs == 1:
+        for suite_arch in suite_archs:
+            collect(build_suite_arch_pages(suite_arch, with_global))
+    else:
+        with multiprocessing.Pool(jobs, initializer=reconnect_db) as pool:
+            for result, stats, rstats in pool.imap_unordered(
+                    _worker_build_suite_arch_pages, suite_archs):
+                add_write_stats(stats)
+                add_render_stats(rstats)
+                collect(result)
+    if with_global:
+        for page in pages:
+            if is_global(page):
+                start = time.monotonic()
+                build_page(page, sections=sections)
+                seconds = time.monotonic() - start
+                log.info('%6.2fs  %s', seconds, page)
+                timings.append((seconds, page, 'global'))
+    log.info('The slowest pages were:')
+    for seconds, page, where in sorted(timings, reverse=True)[:10]:
+        log.info('%6.2fs  %s (%s)', seconds, page, where)
+
+
 if __name__ == '__main__':
-    for arch in ARCHS:
-        for suite in SUITES:
-            for page in pages.keys():
-                if 'global' not in pages[page] or not pages[page]['global']:
-                    build_page(page, suite, arch)
-    for page in pages.keys():
-        if 'global' in  pages[page] and pages[page]['global']:
-            build_page(page)
+    # in incremental mode only the suites/archs with changes recorded in the
+    # journal since the previous run are rebuilt.  The "last 24h" counters of
+    # the other pages get stale, so a full run is still needed now and then.
+    consumer = 'html_indexes/' + DISTRO
+    if args.incremental:
+        last_id, changes = changes_since(consumer)
+    else:
+        last_id, changes = last_change_id(), None
+    if changes is not None:
+        changed = set((x.suite, x.architecture) for x in changes)
+        log.info('Rebuilding the index pages of: %s', sorted(changed))
+    suite_archs = [(suite, arch) for arch in ARCHS for suite in SUITES
+                   if changes is None or (suite, arch) in changed]
+    build_all_pages(suite_archs, with_global=changes is None or bool(changes))
+    set_watermark(consumer, last_id)
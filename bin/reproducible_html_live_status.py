@@ -9,12 +9,14 @@
 # Depends: python3
 
 from string import Template
-from sqlalchemy import select, func, cast, Integer, and_, bindparam
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, and_, bindparam
 
 from rblib import query_db, db_table
 from rblib.confparse import log
 from rblib.models import Package, Status
 from rblib.utils import convert_into_hms_string
+from rblib.scheduling import Priority, build_rate
 from rblib.html import tab, create_main_navigation, write_html_page
 from reproducible_html_indexes import build_leading_text_section
 from rblib.const import (
@@ -27,7 +29,7 @@ from rblib.const import (
 results = db_table('results')
 sources = db_table('sources')
 schedule = db_table('schedule')
-stats_build = db_table('stats_build')
+durations = db_table('build_duration_stats')
 
 def convert_into_status_html(statusname):
     if statusname == 'None':
@@ -42,20 +44,8 @@ def generate_schedule(arch):
     log.info('Building the schedule index page for ' + arch + '...')
     title = 'Packages currently scheduled on ' + arch + ' for testing for build reproducibility'
 
-    # 'AND h.name=s.name AND h.suite=s.suite AND h.architecture=s.architecture'
-    # in this query and the query below is needed due to not using package_id
-    # in the stats_build table, which should be fixed...
-    averagesql = select([
-        func.coalesce(func.avg(cast(stats_build.c.build_duration, Integer)), 0)
-    ]).where(
-        and_(
-            stats_build.c.status.in_(('reproducible', 'FTBR')),
-            stats_build.c.name == sources.c.name,
-            stats_build.c.suite == sources.c.suite,
-            stats_build.c.architecture == sources.c.architecture,
-        )
-    ).as_scalar()
-
+    # the average build durations come from the build_duration_stats table,
+    # see rblib/durations.py
     query = select([
         schedule.c.date_scheduled,
         sources.c.suite,
@@ -63,15 +53,18 @@ def generate_schedule(arch):
         sources.c.name,
         results.c.status,
         results.c.build_duration,
-        averagesql
+        func.coalesce(durations.c.mean, 0),
+        schedule.c.priority,
     ]).select_from(
-        sources.join(schedule).join(results, isouter=True)
+        sources.join(schedule).join(results, isouter=True).join(
+            durations, durations.c.package_id == sources.c.id, isouter=True)
     ).where(
         and_(
             schedule.c.date_build_started == None,
             sources.c.architecture == bindparam('arch'),
         )
     ).order_by(
+        schedule.c.priority,
         schedule.c.date_scheduled
     )
 
@@ -82,16 +75,30 @@ def generate_schedule(arch):
     html += generate_live_status_table(arch)
     html += '<p><table class="scheduled">\n' + tab
     html += '<tr><th class="center">#</th><th class="center">scheduled at</th><th class="center">suite</th>'
-    html += '<th class="center">arch</th><th class="center">source package</th><th class="center">previous build status</th><th class="center">previous build duration</th><th class="center">average build duration</th></tr>\n'
-    for row in rows:
-        # 0: date_scheduled, 1: suite, 2: arch, 3: pkg name 4: previous status 5: previous build duration 6. avg build duration
+    html += '<th class="center">arch</th><th class="center">source package</th><th class="center">previous build status</th><th class="center">previous build duration</th><th class="center">average build duration</th>'
+    html += '<th class="center">priority</th><th class="center">estimated start</th></tr>\n'
+    # estimate when the packages will be built from the recent build rate,
+    # the queue being ordered like the builders pick from it
+    rate = build_rate(arch)
+    now = datetime.now()
+    for position, row in enumerate(rows):
+        # 0: date_scheduled, 1: suite, 2: arch, 3: pkg name 4: previous status 5: previous build duration 6. avg build duration 7. priority
         pkg = row[3]
         duration = convert_into_hms_string(row[5])
         avg_duration = convert_into_hms_string(row[6])
+        try:
+            priority = Priority(row[7]).name.lower()
+        except ValueError:  # aged, between two priority classes
+            priority = str(row[7])
+        if rate:
+            eta = (now + timedelta(seconds=position/rate)).strftime('%Y-%m-%d %H:%M')
+        else:
+            eta = 'unknown'
         html += tab + '<tr><td>&nbsp;</td><td>' + str(row[0]) + '</td>'
         html += '<td>' + row[1] + '</td><td>' + row[2] + '</td><td><code>'
         html += Package(pkg).html_link(row[1], row[2])
-        html += '</code></td><td>'+convert_into_status_html(str(row[4]))+'</td><td>'+duration+'</td><td>' + avg_duration + '</td></tr>\n'
+        html += '</code></td><td>'+convert_into_status_html(str(row[4]))+'</td><td>'+duration+'</td><td>' + avg_duration + '</td>'
+        html += '<td>' + priority + '</td><td>' + eta + '</td></tr>\n'
     html += '</table></p>\n'
     destfile = DISTRO_BASE + '/index_' + arch + '_scheduled.html'
     desturl = DISTRO_URL + '/index_' + arch + '_scheduled.html'
@@ -104,16 +111,6 @@ def generate_schedule(arch):
 
 
 def generate_live_status_table(arch):
-    averagesql = select([
-        func.coalesce(func.avg(cast(stats_build.c.build_duration, Integer)), 0)
-    ]).where(
-        and_(
-            stats_build.c.status.in_(('reproducible', 'FTBR')),
-            stats_build.c.name == sources.c.name,
-            stats_build.c.suite == sources.c.suite,
-            stats_build.c.architecture == sources.c.architecture,
-        )
-    ).as_scalar()
 
     query = select([
         sources.c.id,
@@ -124,10 +121,11 @@ def generate_live_status_table(arch):
         schedule.c.date_build_started,
         results.c.status,
         results.c.build_duration,
-        averagesql,
+        func.coalesce(durations.c.mean, 0),
         schedule.c.job,
     ]).select_from(
-        sources.join(schedule).join(results, isouter=True)
+        sources.join(schedule).join(results, isouter=True).join(
+            durations, durations.c.package_id == sources.c.id, isouter=True)
     ).where(
         and_(
             schedule.c.date_build_started != None,
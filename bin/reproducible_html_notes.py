@@ -16,7 +16,6 @@ import sys
 import copy
 import yaml
 import popcon
-import pystache
 from string import Template
 from collections import OrderedDict
 from math import sqrt
@@ -27,11 +26,12 @@ from sqlalchemy import select, and_, bindparam
 from rblib import query_db, db_table, get_trailing_bug_icon
 from rblib.models import Package, Status
 from rblib.bugs import Bugs
-from rblib.confparse import log
-from rblib.html import tab, create_main_navigation, write_html_page
+from rblib.confparse import log, args
+from rblib.journal import changes_since, last_change_id, set_watermark
+from rblib.html import tab, create_main_navigation, write_html_page, \
+    render_template
 from rblib.const import (
     REPRODUCIBLE_URL,
-    TEMPLATE_PATH,
     DISTRO_BASE, DISTRO_URL,
     SUITES, ARCHS,
     defaultsuite,
@@ -40,13 +40,12 @@ from rblib.const import (
 )
 
 
-renderer = pystache.Renderer()
-notes_body_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'notes_body'))
-
 NOTES = 'packages.yml'
 ISSUES = 'issues.yml'
 
+# name of this generator in the journal of changes
+JOURNAL_CONSUMER = 'html_notes'
+
 NOTESGIT_DESCRIPTION = 'Our notes about issues affecting packages are stored in <a href="https://salsa.debian.org/reproducible-builds/reproducible-notes" target="_parent">notes.git</a> and are targeted at packages in Debian in \'unstable/amd64\' (unless they say otherwise).'
 
 url2html = re.compile(r'((mailto\:|((ht|f)tps?)\://|file\:///){1}\S+)')
@@ -259,7 +258,7 @@ def gen_html_note(package, note):
         infos += note_comments_html.substitute(comments=comment)
     try:
         version = str(note['version'])
-        return renderer.render(notes_body_template, {
+        return render_template('notes_body', {
             'version': version,
             'infos': infos,
             'notesgit_description': NOTESGIT_DESCRIPTION
@@ -267,7 +266,7 @@ def gen_html_note(package, note):
     except KeyError:
         log.warning('You should really include a version in the ' +
               str(note['package']) + ' note')
-        return renderer.render(notes_body_template, {
+        return render_template('notes_body', {
             'version': 'N/A',
             'infos': infos,
             'notesgit_description': NOTESGIT_DESCRIPTION
@@ -498,11 +497,43 @@ def index_issues(issues, scorefuncs):
     log.info('Issues index now available at ' + desturl)
 
 
+def incremental_update(notes, changes):
+    """
+    Rebuild only what depends on the status of the packages that changed: the
+    pages of the issues they are affected by, and the index pages of their
+    suite/arch.  The note pages only depend on the notes themselves, which
+    didn't change.
+    """
+    changed = set(x.name for x in changes)
+    affected = set()
+    for package in changed & set(notes):
+        affected.update(notes[package].get('issues', []))
+    log.info('Rebuilding the pages of %s issues affected by %s changed '
+             'packages', len(affected), len(changed))
+    iterate_over_issues({x: issues[x] for x in affected if x in issues})
+    for suite, arch in sorted(set((x.suite, x.architecture) for x in changes)):
+        if suite not in SUITES or arch not in ARCHS:
+            continue
+        build_page('notes', suite, arch)
+        build_page('no_notes', suite, arch)
+        build_page('FTBFS', suite, arch)
+
+
 if __name__ == '__main__':
     issues_count = {}
     bugs = Bugs().bugs
     notes = load_notes()
     issues = load_issues()
+    if args.incremental:
+        last_id, changes = changes_since(JOURNAL_CONSUMER)
+        # changes to the notes or the issues themselves need a full run
+        if changes is not None and \
+                not [x for x in changes if x.reason in ('notes', 'issues')]:
+            incremental_update(notes, changes)
+            set_watermark(JOURNAL_CONSUMER, last_id)
+            sys.exit(0)
+    else:
+        last_id = last_change_id()
     iterate_over_notes(notes)
     iterate_over_issues(issues)
     try:
@@ -524,3 +555,4 @@ if __name__ == '__main__':
             build_page('notes', suite, arch)
             build_page('no_notes', suite, arch)
             build_page('FTBFS', suite, arch)
+    set_watermark(JOURNAL_CONSUMER, last_id)
@@ -11,21 +11,26 @@
 # Build rb-pkg pages (the pages that describe the package status)
 
 import os
+import math
 import errno
+import itertools
+import collections
 import urllib
-import pystache
+import multiprocessing
 import apt_pkg
 import sqlalchemy
 apt_pkg.init_system()
 
-from rblib import query_db
+from rblib import query_db, query_db_iter, reconnect_db, get_distribution_id
 from rblib.confparse import log, args
-from rblib.models import Package, Status
+from rblib.models import Package, Status, prefetch_builds, package_cache_stats
+from rblib.journal import changes_since, last_change_id, set_watermark
+from rblib.history import history, archived_years
 from rblib.utils import strip_epoch, convert_into_hms_string
-from rblib.html import gen_status_link_icon, write_html_page
+from rblib.html import gen_status_link_icon, write_html_page, write_stats, \
+    add_write_stats, render_template, render_stats, add_render_stats
 from rblib.const import (
     DISTRO,
-    TEMPLATE_PATH,
     REPRODUCIBLE_URL,
     DISTRO_URL,
     SUITES, ARCHS,
@@ -40,20 +45,13 @@ from rblib.const import (
 )
 
 
-# Templates used for creating package pages
-renderer = pystache.Renderer();
-package_page_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_page'))
-package_navigation_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_navigation'))
-suitearch_section_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_suitearch_section'))
-suitearch_details_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_suitearch_details'))
-project_links_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'project_links'))
-package_history_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_history'))
+# how many packages get their builds status loaded from the db at once
+PREFETCH_CHUNK_SIZE = 500
+
+# name of this generator in the journal of changes
+JOURNAL_CONSUMER = 'html_packages/' + DISTRO
+
+distro_id = get_distribution_id(DISTRO)
 
 
 def sizeof_fmt(num):
@@ -135,10 +133,10 @@ def get_and_clean_dbd_links(package, eversion, suite, arch, status):
     return dbd_links
 
 
-def gen_suitearch_details(package, version, suite, arch, status, spokenstatus,
+def gen_suitearch_details(pkg, version, suite, arch, status, spokenstatus,
                           build_date):
     eversion = strip_epoch(version) # epoch_free_version is too long
-    pkg = Package(package)
+    package = pkg.name
     build = pkg.builds[suite][arch]
 
     context = {}
@@ -197,7 +195,7 @@ def gen_suitearch_details(package, version, suite, arch, status, spokenstatus,
                                   'rbuild_uri' in context
 
     default_view = '/untested.html' if not default_view else default_view
-    suitearch_details_html = renderer.render(suitearch_details_template, context)
+    suitearch_details_html = render_template('package_suitearch_details', context)
     return (suitearch_details_html, default_view)
 
 
@@ -262,7 +260,7 @@ def gen_suitearch_section(package, current_suite, current_arch):
             suitearch_details_html = ''
             if (s == current_suite and a == current_arch):
                 suitearch_details_html, default_view = gen_suitearch_details(
-                    package.name, version, s, a,
+                    package, version, s, a,
                     status.value.name, status.value.spokenstatus, build_date)
 
             dbd_links = get_dbd_links(package.name, strip_epoch(version), s, a)
@@ -291,7 +289,7 @@ def gen_suitearch_section(package, current_suite, current_arch):
                 'suites': suites,
             })
 
-    html = renderer.render(suitearch_section_template, context)
+    html = render_template('package_suitearch_section', context)
     reproducible = True if final_status == 'reproducible' else False
     return html, default_view, reproducible
 
@@ -300,19 +298,47 @@ def shorten_if_debiannet(hostname):
         hostname = hostname[:-11]
     return hostname
 
-def gen_history_page(package, arch=None):
+def history_page(name, arch=None, year=None):
+    """Return the path and url of a history page, see gen_history_page()."""
+    page = name + ('_{}'.format(year) if year else '') + '.html'
+    if arch:
+        page = os.path.join(arch, page)
+    return os.path.join(HISTORY_PATH, page), os.path.join(HISTORY_URI, page)
+
+
+def gen_history_page(package, arch=None, year=None, years=None):
+    """
+    Generate the history page of a package, on every arch or only on arch.
+    The main page only shows the recent builds, with links to one page per
+    year of archived builds (years, a list of years, see
+    rblib.history.archived_years()); if year is given, generate the page of
+    that year instead.
+    """
     keys = ['build date', 'version', 'suite', 'architecture', 'result',
         'build duration', 'node1', 'node2', 'job']
 
+    if year is None:
+        records = package.history
+    else:
+        # the same keys as Package.history
+        records = [dict(zip(['build ID', 'version', 'suite', 'architecture',
+                             'result', 'build date', 'build duration',
+                             'node1', 'node2', 'job'], r))
+                   for r in history(package.name, year=year,
+                                    distribution=distro_id)]
     context = {}
+    if years:
+        context['older'] = {'years': [
+            {'year': y, 'url': history_page(package.name, arch, y)[1]}
+            for y in years]}
     try:
-        package.history[0]  # we don't care about the actual value, it jst need to exist
+        records[0]  # we don't care about the actual value, it jst need to exist
     except IndexError:
         context['arch'] = arch
     else:
         context['keys'] = [{'key': key} for key in keys]
         rows = []
-        for r in package.history:
+        for r in records:
             # make a copy, since we modify in place
             record = dict(r)
             # skip records for suites that are unknown to us (i.e. other distro)
@@ -336,130 +362,252 @@ def gen_history_page(package, arch=None):
             rows.append({'row_items': row_items})
         context['rows'] = rows
 
-    html = renderer.render(package_history_template, context)
-    if arch:
-        destfile = os.path.join(HISTORY_PATH, arch, package.name+'.html')
-    else:
-        destfile = os.path.join(HISTORY_PATH, package.name+'.html')
+    html = render_template('package_history', context)
+    destfile = history_page(package.name, arch, year)[0]
     title = 'build history of {}'.format(package.name)
     if arch:
         title += ' on {}'.format(arch)
+    if year:
+        title += ' in {}'.format(year)
     write_html_page(title=title, body=html, destfile=destfile,
                     noendpage=True)
 
-def gen_packages_html(packages, no_clean=False):
+def gen_history_pages(package, archive=False):
     """
-    generate the /rb-pkg/package.HTML pages.
-    packages should be a list of Package objects.
+    generate the history pages of a package, on all and on every arch, and
+    with archive the pages of its archived years as well.
+    Returns the number of pages written.
     """
-    total = len(packages)
-    log.info('Generating the pages of ' + str(total) + ' package(s)')
-    for package in sorted(packages, key=lambda x: x.name):
-        assert isinstance(package, Package)
-        gen_history_page(package)
-        for arch in ARCHS:
-            gen_history_page(package, arch)
+    years = archived_years(package.name, distro_id)
+    years[None] = sorted({y for x in years.values() for y in x}, reverse=True)
+    written = 0
+    for arch in [None] + ARCHS:
+        gen_history_page(package, arch, years=years.get(arch))
+        written += 1
+        if archive:
+            for year in years.get(arch, []):
+                gen_history_page(package, arch, year, years.get(arch))
+                written += 1
+    return written
+
+
+def gen_package_pages(package):
+    """
+    generate all the pages of a single package: the history pages, and the
+    package page and diffoscope page for every suite/arch it is available in.
+    Returns the number of pages written.
+    """
+    written = gen_history_pages(package)
 
-        pkg = package.name
+    pkg = package.name
 
-        notes_uri = ''
-        notes_file = NOTES_PATH + '/' + pkg + '_note.html'
-        if os.access(notes_file, os.R_OK):
-            notes_uri = NOTES_URI + '/' + pkg + '_note.html'
+    notes_uri = ''
+    notes_file = NOTES_PATH + '/' + pkg + '_note.html'
+    if os.access(notes_file, os.R_OK):
+        notes_uri = NOTES_URI + '/' + pkg + '_note.html'
 
-        for suite in SUITES:
-            for arch in ARCHS:
+    for suite in SUITES:
+        for arch in ARCHS:
 
-                status = package.builds[suite][arch].status
-                version = package.builds[suite][arch].version
-                build_date = package.builds[suite][arch].build_date
-                if status is None:  # the package is not in the checked suite
-                    continue
-                log.debug('Generating the page of %s/%s/%s @ %s built at %s',
-                          pkg, suite, arch, version, build_date)
-
-                suitearch_section_html, default_view, reproducible = \
-                    gen_suitearch_section(package, suite, arch)
-
-                history_uri = '{}/{}.html'.format(HISTORY_URI, pkg)
-                history_archs = []
-                for a in ARCHS:
-                    history_archs.append({
-                        'history_arch': a,
-                        'history_arch_uri': '{}/{}/{}.html'.format(HISTORY_URI, a, pkg)
-                    })
-                project_links = renderer.render(project_links_template)
-                desturl = '{}{}/{}/{}/{}.html'.format(
-                    REPRODUCIBLE_URL,
-                    RB_PKG_URI,
-                    suite,
-                    arch,
-                    pkg,
-                )
-
-                navigation_html = renderer.render(package_navigation_template, {
-                    'package': pkg,
-                    'suite': suite,
-                    'arch': arch,
-                    'version': version,
-                    'history_uri': history_uri,
-                    'history_archs': history_archs,
-                    'notes_uri': notes_uri,
-                    'notify_maintainer': package.notify_maint,
-                    'suitearch_section_html': suitearch_section_html,
-                    'project_links_html': project_links,
-                    'reproducible': reproducible,
-                    'dashboard_url': DISTRO_URL,
-                    'desturl': desturl,
+            status = package.builds[suite][arch].status
+            version = package.builds[suite][arch].version
+            build_date = package.builds[suite][arch].build_date
+            if status is None:  # the package is not in the checked suite
+                continue
+            log.debug('Generating the page of %s/%s/%s @ %s built at %s',
+                      pkg, suite, arch, version, build_date)
+
+            suitearch_section_html, default_view, reproducible = \
+                gen_suitearch_section(package, suite, arch)
+
+            history_uri = '{}/{}.html'.format(HISTORY_URI, pkg)
+            history_archs = []
+            for a in ARCHS:
+                history_archs.append({
+                    'history_arch': a,
+                    'history_arch_uri': '{}/{}/{}.html'.format(HISTORY_URI, a, pkg)
                 })
+            project_links = render_template('project_links')
+            desturl = '{}{}/{}/{}/{}.html'.format(
+                REPRODUCIBLE_URL,
+                RB_PKG_URI,
+                suite,
+                arch,
+                pkg,
+            )
 
-                body_html = renderer.render(package_page_template, {
-                    'default_view': default_view,
-                })
+            navigation_html = render_template('package_navigation', {
+                'package': pkg,
+                'suite': suite,
+                'arch': arch,
+                'version': version,
+                'history_uri': history_uri,
+                'history_archs': history_archs,
+                'notes_uri': notes_uri,
+                'notify_maintainer': package.notify_maint,
+                'suitearch_section_html': suitearch_section_html,
+                'project_links_html': project_links,
+                'reproducible': reproducible,
+                'dashboard_url': DISTRO_URL,
+                'desturl': desturl,
+            })
+
+            body_html = render_template('package_page', {
+                'default_view': default_view,
+            })
 
-                destfile = os.path.join(RB_PKG_PATH, suite, arch, pkg + '.html')
-                title = pkg + ' - reproducible builds result'
+            destfile = os.path.join(RB_PKG_PATH, suite, arch, pkg + '.html')
+            title = pkg + ' - reproducible builds result'
+            write_html_page(title=title, body=body_html, destfile=destfile,
+                            no_header=True, noendpage=True,
+                            left_nav_html=navigation_html)
+            written += 1
+            log.debug("Package page generated at " + desturl)
+
+            # Optionally generate a page in which the main iframe shows the
+            # diffoscope results by default. Needed for navigation between
+            # diffoscope pages for different suites/archs
+            eversion = strip_epoch(version)
+            dbd_links = get_and_clean_dbd_links(pkg, eversion, suite, arch,
+                                                status)
+            # only generate the diffoscope page if diffoscope results exist
+            if 'dbd_uri' in dbd_links:
+                body_html = render_template('package_page', {
+                    'default_view': dbd_links['dbd_uri'],
+                })
+                destfile = dbd_links['dbd_page_file']
+                desturl = REPRODUCIBLE_URL + "/" + dbd_links['dbd_page_uri']
+                title = "{} ({}) diffoscope results in {}/{}".format(
+                    pkg, version, suite, arch)
                 write_html_page(title=title, body=body_html, destfile=destfile,
                                 no_header=True, noendpage=True,
                                 left_nav_html=navigation_html)
-                log.debug("Package page generated at " + desturl)
-
-                # Optionally generate a page in which the main iframe shows the
-                # diffoscope results by default. Needed for navigation between
-                # diffoscope pages for different suites/archs
-                eversion = strip_epoch(version)
-                dbd_links = get_and_clean_dbd_links(pkg, eversion, suite, arch,
-                                                    status)
-                # only generate the diffoscope page if diffoscope results exist
-                if 'dbd_uri' in dbd_links:
-                    body_html = renderer.render(package_page_template, {
-                        'default_view': dbd_links['dbd_uri'],
-                    })
-                    destfile = dbd_links['dbd_page_file']
-                    desturl = REPRODUCIBLE_URL + "/" + dbd_links['dbd_page_uri']
-                    title = "{} ({}) diffoscope results in {}/{}".format(
-                        pkg, version, suite, arch)
-                    write_html_page(title=title, body=body_html, destfile=destfile,
-                                    no_header=True, noendpage=True,
-                                    left_nav_html=navigation_html)
-                    log.debug("Package diffoscope page generated at " + desturl)
+                written += 1
+                log.debug("Package diffoscope page generated at " + desturl)
+    return written
+
+
+def _gen_packages_chunk(packages):
+    # load the status of all the builds of this chunk in one go
+    prefetch_builds(packages, chunk_size=PREFETCH_CHUNK_SIZE)
+    written = 0
+    for package in packages:
+        assert isinstance(package, Package)
+        written += gen_package_pages(package)
+    return written
+
+
+def _worker_init():
+    reconnect_db()
+
+
+def _worker_gen_packages_chunk(names):
+    # Package objects are rebuilt from their names, so that they are tied to
+    # the package cache of the worker process
+    before = write_stats()
+    before_render = render_stats()
+    written = _gen_packages_chunk([Package(x) for x in names])
+    after = write_stats()
+    # the counters of the worker are merged into the ones of the parent
+    stats = {k: after[k] - before[k] for k in after}
+    return (len(names), written, stats, render_stats(since=before_render))
+
+
+def _gen_packages_chunks(chunks, jobs, total=None):
+    """
+    Generate the pages of the packages of chunks, an iterable of lists of
+    package names, using jobs worker processes.  chunks is only read as the
+    workers need more work, so it can be read from the database on the fly.
+    Return the number of pages written.
+    """
+    done = 0
+    written = 0
+    if jobs == 1:
+        for names in chunks:
+            written += _gen_packages_chunk([Package(x) for x in names])
+            done += len(names)
+            log.info('%s/%s packages done', done, total or '?')
+        return written
+    pending = collections.deque()
+    with multiprocessing.Pool(jobs, initializer=_worker_init) as pool:
+        # keep two chunks per worker in flight, so that they are never idle
+        for names in itertools.chain(chunks, [None]):
+            while pending and (names is None or len(pending) >= 2 * jobs):
+                n_pkgs, n_pages, stats, rstats = pending.popleft().get()
+                done += n_pkgs
+                written += n_pages
+                add_write_stats(stats)
+                add_render_stats(rstats)
+                log.info('%s/%s packages done', done, total or '?')
+            if names is not None:
+                pending.append(pool.apply_async(_worker_gen_packages_chunk,
+                                                (names,)))
+    return written
+
+
+def gen_packages_html(packages, no_clean=False, jobs=None):
+    """
+    generate the /rb-pkg/package.HTML pages.
+    packages should be a list of Package objects.
+    jobs is the number of worker processes to use, by default the value of
+    the --jobs command line option.
+    """
+    total = len(packages)
+    if jobs is None:
+        jobs = args.jobs
+    # there is no point in starting workers that would have nothing to do
+    jobs = max(1, min(jobs, math.ceil(total / PREFETCH_CHUNK_SIZE)))
+    log.info('Generating the pages of %s package(s) using %s process(es)',
+             total, jobs)
+    names = sorted(x.name for x in packages)
+    chunks = [names[i:i+PREFETCH_CHUNK_SIZE]
+              for i in range(0, total, PREFETCH_CHUNK_SIZE)]
+    written = _gen_packages_chunks(chunks, jobs, total)
+    log.info('Generated %s pages for %s package(s)', written, total)
 
     if not no_clean:
         purge_old_pages()  # housekeep is always good
 
 
-def gen_all_rb_pkg_pages(no_clean=False):
+def gen_all_rb_pkg_pages(no_clean=False, incremental=None):
+    """
+    generate the pages of all the packages, or with incremental (by default
+    the value of the --incremental command line option) only of the packages
+    changed since the previous run, according to the journal of changes.
+    The names of the packages are streamed from the database, a chunk at a
+    time.
+    """
+    if incremental is None:
+        incremental = args.incremental
+    if incremental:
+        last_id, changes = changes_since(JOURNAL_CONSUMER)
+    else:
+        last_id, changes = last_change_id(), None
     query = (
         'SELECT DISTINCT s.name '
         'FROM sources s JOIN distributions d ON d.id=s.distribution '
-        'WHERE d.name=:d AND s.suite = ANY(:s)'
+        'WHERE d.name=:d AND s.suite = ANY(:s) ORDER BY s.name'
     )
-    rows = query_db(sqlalchemy.text(query), d=DISTRO, s=SUITES)
-    pkgs = [Package(str(i[0]), no_notes=True) for i in rows]
-    log.info('Processing all %s package from all suites/architectures',
-             len(pkgs))
-    gen_packages_html(pkgs, no_clean=True)  # we clean at the end
+    names = (str(x[0]) for x in
+             query_db_iter(sqlalchemy.text(query), d=DISTRO, s=SUITES))
+    jobs = args.jobs
+    if changes is None:
+        log.info('Processing all the packages from all suites/architectures')
+    else:
+        changed = set(x.name for x in changes)
+        names = (x for x in names if x in changed)
+        jobs = max(1, min(jobs, math.ceil(len(changed) / PREFETCH_CHUNK_SIZE)))
+        log.info('Processing the packages among the %s changed since the '
+                 'last run', len(changed))
+    chunks = iter(lambda: list(itertools.islice(names, PREFETCH_CHUNK_SIZE)),
+                  [])
+    written = _gen_packages_chunks(chunks, jobs)
+    log.info('Generated %s pages', written)
+    log.info('Package cache: %(size)s packages cached, %(hits)s hits, '
+             '%(misses)s misses, %(evictions)s evictions',
+             package_cache_stats())
     purge_old_pages()
+    set_watermark(JOURNAL_CONSUMER, last_id)
 
 
 def purge_old_pages():
@@ -15,7 +15,6 @@
 
 import os
 import csv
-import pystache
 from datetime import datetime, timedelta
 from subprocess import check_call
 from collections import OrderedDict
@@ -25,24 +24,15 @@ from rblib.bugs import Bugs
 from rblib.confparse import log
 from rblib.models import Package, Status
 from rblib.utils import create_temp_file
-from rblib.html import create_main_navigation, write_html_page, gen_status_link_icon
+from rblib.html import create_main_navigation, write_html_page, \
+    gen_status_link_icon, render_template
 from rblib.const import (
     BIN_PATH,
     SUITES, ARCHS,
     DISTRO_BASE, DISTRO_URI,
     META_PKGSET, PKGSET_DEF_PATH,
-    TEMPLATE_PATH,
 )
 
-# Templates used for creating package pages
-renderer = pystache.Renderer()
-pkgset_navigation_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'pkgset_navigation'))
-pkgset_details_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'pkgset_details'))
-pkg_legend_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'pkg_symbol_legend'))
-
 # we only do stats up until yesterday
 YESTERDAY = (datetime.now()-timedelta(days=1)).strftime('%Y-%m-%d')
 
@@ -156,7 +146,7 @@ def create_pkgset_navigation(suite, arch, view=None):
     }
     context['package_set_sections'] = \
         [{'section': s, 'pkgsets': sections[s]} for s in sections]
-    return renderer.render(pkgset_navigation_template, context)
+    return render_template('pkgset_navigation', context)
 
 
 def create_index_page(suite, arch):
@@ -215,7 +205,7 @@ def create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name):
         'suite': suite,
         'arch': arch,
         'pkg_symbol_legend_html':
-            renderer.render(pkg_legend_template, {}),
+            render_template('pkg_symbol_legend'),
     })
 
     png_file, png_href = stats_png_file_href(suite, arch, pkgset_name)
@@ -267,7 +257,7 @@ def create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name):
                 stats["count_" + cutename] != 0):
             pkgset_context['status_details'].append(details_context)
 
-    html_body += renderer.render(pkgset_details_template, pkgset_context)
+    html_body += render_template('pkgset_details', pkgset_context)
     title = '%s package set for %s/%s' % \
             (pkgset_name, suite, arch)
     page = "pkg_set_" + pkgset_name + ".html"
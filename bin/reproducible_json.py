@@ -20,7 +20,7 @@ import subprocess
 
 from sqlalchemy.sql import text
 
-from rblib import query_db, get_distribution_id
+from rblib import query_db_iter, get_distribution_id
 from rblib.confparse import log
 from rblib.const import (
     DISTRO, DISTRO_URL,
@@ -28,21 +28,18 @@ from rblib.const import (
     filter_query,
 )
 
-output = []
-output4tracker = []
-
 log.info('Creating json dump of current reproducible status for %s', DISTRO)
 
 distro_id = get_distribution_id(DISTRO)
 
 # filter_query is defined in reproducible_common.py and excludes some FTBFS issues
+# the rows are streamed (and written out) in the order python would sort them
 query = text("SELECT s.name, r.version, s.suite, s.architecture, r.status, r.build_date " + \
         "FROM results AS r JOIN sources AS s ON r.package_id = s.id "+ \
         "WHERE status != '' AND s.distribution = :distro AND status NOT IN ('NFU', 'E404', 'blacklisted' ) AND (( status != 'FTBFS' ) OR " \
-        " ( status = 'FTBFS' and r.package_id NOT IN (SELECT n.package_id FROM NOTES AS n WHERE " + filter_query + " )))")
-
-result = sorted(query_db(query, distro=distro_id))
-log.info('\tprocessing ' + str(len(result)))
+        " ( status = 'FTBFS' and r.package_id NOT IN (SELECT n.package_id FROM NOTES AS n WHERE " + filter_query + " ))) " + \
+        'ORDER BY s.name COLLATE "C", r.version COLLATE "C", s.suite COLLATE "C", ' + \
+        's.architecture COLLATE "C", r.status COLLATE "C", r.build_date')
 
 keys = ['package', 'version', 'suite', 'architecture', 'status', 'build_date']
 crossarchkeys = ['package', 'version', 'suite', 'status']
@@ -52,13 +49,32 @@ archdetailkeys = ['architecture', 'version', 'status', 'build_date']
 # package's test results across all archs (for suite=unstable only)
 crossarch = {}
 
-crossarchversions = {}
-for row in result:
-    pkg = dict(zip(keys, row))
-    pkg['build_date'] = str(pkg['build_date'])
-    log.debug(pkg)
-    output.append(pkg)
 
+def write_json_item(fd, item, first):
+    # write one item of a list the same way json.dump(indent=4) would
+    item = json.dumps(item, indent=4, sort_keys=True)
+    fd.write(('[\n' if first else ',\n') + '    ' +
+             item.replace('\n', '\n    '))
+
+
+def dump_results(fd):
+    """
+    Write the results as a json list to fd, one row at a time, and collect
+    the cross-arch summary of the packages in crossarch on the way.
+    """
+    processed = 0
+    for row in query_db_iter(query, distro=distro_id):
+        pkg = dict(zip(keys, row))
+        pkg['build_date'] = str(pkg['build_date'])
+        log.debug(pkg)
+        write_json_item(fd, pkg, processed == 0)
+        processed += 1
+        add_to_crossarch(pkg)
+    fd.write('\n]' if processed else '[]')
+    log.info('\tprocessed ' + str(processed))
+
+
+def add_to_crossarch(pkg):
     # tracker.d.o should only care about results in testing
     if pkg['suite'] == 'bullseye':
 
@@ -77,7 +93,7 @@ for row in result:
             # if version1 > version2,
             # skip the package results we are currently inspecting
             if (versionscompared > 0):
-                continue
+                return
 
             # if version1 < version2,
             # delete the package results with the older version
@@ -115,16 +131,19 @@ for row in result:
             crossarch[package]['architecture_details'] = \
                 [{key:pkg[key] for key in archdetailkeys}]
 
-output4tracker = list(crossarch.values())
 
-for data, target in (
-    (output, REPRODUCIBLE_JSON),
+def dump_tracker(fd):
+    json.dump(list(crossarch.values()), fd, indent=4, sort_keys=True)
+
+
+for write, target in (
+    (dump_results, REPRODUCIBLE_JSON),
     # json for tracker.d.o, thanks to #785531
-    (output4tracker, REPRODUCIBLE_TRACKER_JSON),
+    (dump_tracker, REPRODUCIBLE_TRACKER_JSON),
 ):
     tmpfile = tempfile.mkstemp(dir=os.path.dirname(target))[1]
     with open(tmpfile, 'w') as fd:
-        json.dump(data, fd, indent=4, sort_keys=True)
+        write(fd)
     os.rename(tmpfile, target)
     os.chmod(target, 0o644)
     log.info("%s/%s has been updated.", DISTRO_URL, os.path.basename(target))
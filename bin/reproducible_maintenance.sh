@@ -50,6 +50,10 @@ if [ "$HOSTNAME" = "$MAINNODE" ] ; then
 		# recreate documentation of database
 		postgresql_autodoc -d $PGDATABASE -t html -f "$BASE/reproducibledb"
 	fi
+
+	# the partitioned tables need their partitions before rows arrive
+	echo "$(date -u) - create the upcoming partitions of the db tables."
+	/srv/jenkins/bin/reproducible_db_maintenance.py --partitions
 fi
 
 #
@@ -527,8 +531,8 @@ if [ "$HOSTNAME" = "$MAINNODE" ] ; then
 		query_to_print "$QUERY" 2> /dev/null || echo "Warning: SQL query '$QUERY' failed."
 		echo
 		for PKG in $(cat $PACKAGES | cut -d "|" -f1) ; do
-			echo "query_db \"UPDATE schedule SET date_build_started = NULL, job = NULL WHERE package_id = '$PKG';\""
-			query_db "UPDATE schedule SET date_build_started = NULL, job = NULL WHERE package_id = '$PKG';"
+			echo "query_db \"UPDATE schedule SET date_build_started = NULL, job = NULL, lease_expires = NULL WHERE package_id = '$PKG';\""
+			query_db "UPDATE schedule SET date_build_started = NULL, job = NULL, lease_expires = NULL WHERE package_id = '$PKG';"
 		done
 		echo "Packages have been rescheduled."
 		echo
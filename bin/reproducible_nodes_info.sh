@@ -66,7 +66,7 @@ TMPFILE2=$(mktemp)
 TMPFILE3=$(mktemp)
 NOW=$(date -u '+%Y-%m-%d %H:%m')
 for i in $BUILD_NODES ; do
-	query_db "SELECT build_date FROM stats_build AS r WHERE ( r.node1='$i' OR r.node2='$i' )" > $TMPFILE1 2>/dev/null
+	query_db "SELECT build_date FROM stats_build_all AS r WHERE ( r.node1='$i' OR r.node2='$i' )" > $TMPFILE1 2>/dev/null
 	j=$(wc -l $TMPFILE1|cut -d " " -f1)
 	k=$(cat $TMPFILE1|cut -d " " -f1|sort -u|wc -l)
 	l=$(echo "scale=1 ; ($j/$k)" | bc)
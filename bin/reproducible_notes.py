@@ -18,6 +18,7 @@ from sqlalchemy import sql
 from rblib import db_table, query_db
 from rblib.confparse import log
 from rblib.const import conn_db
+from rblib.journal import record_package_ids
 from rblib.utils import print_critical_message, irc_msg
 
 apt_pkg.init_system()
@@ -116,8 +117,11 @@ def load_issues():
 def store_issues():
     issues_table = db_table('issues')
     # Get existing issues
-    results = conn_db.execute(sql.select([issues_table.c.name]))
-    existing_issues = set([row[0] for row in results])
+    results = conn_db.execute(sql.select([issues_table.c.name,
+                                          issues_table.c.url,
+                                          issues_table.c.description]))
+    old_issues = {row[0]: (row[1], row[2]) for row in results}
+    existing_issues = set(old_issues)
     to_insert = []
     to_update = []
     for name in issues:
@@ -155,10 +159,26 @@ def store_issues():
         conn_db.execute(delete_query, to_delete)
         log.info("Removed the following issues: " + str(existing_issues) + ".")
 
+    # record the packages whose notes refer to a changed issue
+    changed_issues = set(existing_issues)
+    for row in to_update:
+        if old_issues[row['issuename']] != (row['url'], row['description']):
+            changed_issues.add(row['issuename'])
+    changed_issues.update(x['name'] for x in to_insert)
+    if changed_issues:
+        log.info('The following issues changed: ' + str(changed_issues))
+        query = 'SELECT package_id, issues FROM notes'
+        record_package_ids([x[0] for x in query_db(query)
+                            if changed_issues & set(json.loads(x[1]))],
+                           'issues')
+
 
 def store_notes():
-    log.debug('Removing all notes')
     notes_table = db_table('notes')
+    # remember the current notes, to find out which packages changed
+    query = 'SELECT package_id, version, issues, bugs, comments FROM notes'
+    old_notes = {x[0]: tuple(x[1:]) for x in query_db(query)}
+    log.debug('Removing all notes')
     conn_db.execute(notes_table.delete())
     to_insert = []
     for entry in [x for y in sorted(notes) for x in notes[y]]:
@@ -179,6 +199,15 @@ def store_notes():
         conn_db.execute(notes_table.insert(), to_insert)
         log.info('Saved ' + str(len(to_insert)) + ' notes in the database.')
 
+    # the version may come from yaml as a number, the database returns text
+    new_notes = {x['package_id']: (
+        None if x['version'] is None else str(x['version']),
+        x['issues'], x['bugs'], x['comments']) for x in to_insert}
+    changed = [x for x in set(old_notes) | set(new_notes)
+               if old_notes.get(x) != new_notes.get(x)]
+    log.info('The notes of ' + str(len(changed)) + ' packages changed.')
+    record_package_ids(changed, 'notes')
+
 
 if __name__ == '__main__':
     notes = load_notes()
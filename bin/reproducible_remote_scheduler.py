@@ -15,41 +15,42 @@ import sys
 import time
 import subprocess
 from sqlalchemy import sql
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from rblib import query_db, db_table
 from rblib.const import SUITES, ARCHS, conn_db
 from rblib.confparse import unknown_args, log
 from rblib.utils import bcolors, irc_msg
+from rblib.scheduling import Priority
+from rblib.quota import estimate_costs, admit, cost_report
 
 
-def packages_matching_criteria(arch, suite, criteria):
-    "Return a list of packages in (SUITE, ARCH) matching the given CRITERIA."
-    # TODO: Rewrite this function to query all suites/archs in one go
+def packages_matching_criteria(archs, suites, criteria):
+    "Return a list of packages in all SUITES/ARCHS matching the given CRITERIA."
     issue, status, built_after, built_before = criteria
     del criteria
 
-    formatter = dict(suite=suite, arch=arch, notes_table='')
     log.info('Querying packages with given issues/status...')
-    query = "SELECT s.name " + \
-            "FROM sources AS s, {notes_table} results AS r " + \
-            "WHERE r.package_id=s.id " + \
-            "AND s.architecture= '{arch}' " + \
-            "AND s.suite = '{suite}' AND r.status != 'blacklisted' "
+    query = "SELECT DISTINCT s.name " + \
+            "FROM sources AS s JOIN results AS r ON r.package_id=s.id "
+    params = {'archs': archs, 'suites': suites}
     if issue:
-        query += "AND n.package_id=s.id AND n.issues LIKE '%%{issue}%%' "
-        formatter['issue'] = issue
-        formatter['notes_table'] = "notes AS n,"
+        query += "JOIN notes AS n ON n.package_id=s.id "
+    query += "WHERE s.architecture = ANY(:archs) " + \
+             "AND s.suite = ANY(:suites) AND r.status != 'blacklisted' "
+    if issue:
+        query += "AND n.issues LIKE '%' || :issue || '%' "
+        params['issue'] = issue
     if status:
-        query += "AND r.status = '{status}'"
-        formatter['status'] = status
+        query += "AND r.status = :status "
+        params['status'] = status
     if built_after:
-        query += "AND r.build_date > '{built_after}' "
-        formatter['built_after'] = built_after
+        query += "AND r.build_date > :built_after "
+        params['built_after'] = built_after
     if built_before:
-        query += "AND r.build_date < '{built_before}' "
-        formatter['built_before'] = built_before
-    results = query_db(query.format_map(formatter))
+        query += "AND r.build_date < :built_before "
+        params['built_before'] = built_before
+    results = query_db(sql.text(query), **params)
     results = [x for (x,) in results]
     log.info('Selected packages: ' + ' '.join(results))
     return results
@@ -163,17 +164,13 @@ def parse_args():
     if issue or status or built_after or built_before:
         # Note: this .extend() operation modifies scheduling_args.packages, which
         #       is used by rest()
-        for suite in suites:
-            for arch in archs:
-                packages.extend(
-                  packages_matching_criteria(
-                    arch,
-                    suite,
-                    (issue, status, built_after, built_before),
-                  )
-                )
-            del arch
-        del suite
+        packages.extend(
+          packages_matching_criteria(
+            archs,
+            suites,
+            (issue, status, built_after, built_before),
+          )
+        )
 
     if len(packages) > 50 and notify:
         log.critical(bcolors.RED + bcolors.BOLD)
@@ -213,32 +210,32 @@ def rest(scheduling_args, requester, local, suite, arch):
     ids = []
     pkgs = []
 
-    query1 = """SELECT id FROM sources WHERE name='{pkg}' AND suite='{suite}'
-                AND architecture='{arch}'"""
-    query2 = """SELECT p.date_build_started
-                FROM sources AS s JOIN schedule as p ON p.package_id=s.id
-                WHERE p.package_id='{id}' AND p.build_type='ci_build'"""
+    # look up all the packages at once: whether they exist, and whether they
+    # are already scheduled or building
+    query = sql.text(
+        "SELECT s.name, s.id, p.id AS schedule_id, p.date_build_started "
+        "FROM sources AS s LEFT JOIN schedule AS p "
+        "ON p.package_id=s.id AND p.build_type='ci_build' "
+        "WHERE s.name = ANY(:names) AND s.suite=:suite "
+        "AND s.architecture=:arch")
+    found = {x.name: x for x in query_db(query, names=list(set(packages)),
+                                          suite=suite, arch=arch)}
+    existing_pkg_ids = {}
     for pkg in set(packages):
-        # test whether the package actually exists
-        result = query_db(query1.format(pkg=pkg, suite=suite, arch=arch))
-        # tests whether the package is already building
         try:
-            result2 = query_db(query2.format(id=result[0][0]))
-        except IndexError:
+            result = found[pkg]
+        except KeyError:
             log.error('%sThe package %s is not available in %s/%s%s',
                   bcolors.FAIL, pkg, suite, arch, bcolors.ENDC)
             continue
-        try:
-            if not result2[0][0]:
-                ids.append(result[0][0])
-                pkgs.append(pkg)
-            else:
-                log.warning(bcolors.WARN + 'The package ' + pkg + ' is ' +
-                    'already building, not scheduling it.' + bcolors.ENDC)
-        except IndexError:
-            # it's not in the schedule
-            ids.append(result[0][0])
-            pkgs.append(pkg)
+        if result.date_build_started:
+            log.warning(bcolors.WARN + 'The package ' + pkg + ' is ' +
+                'already building, not scheduling it.' + bcolors.ENDC)
+            continue
+        ids.append(result.id)
+        pkgs.append(pkg)
+        if result.schedule_id is not None:
+            existing_pkg_ids[result.id] = result.schedule_id
 
     def compose_irc_message():
         "One-shot closure to limit scope of the following local variables."
@@ -257,35 +254,44 @@ def rest(scheduling_args, requester, local, suite, arch):
     info_msg = compose_irc_message()
     del compose_irc_message
 
-    # these packages are manually scheduled, so should have high priority,
-    # so schedule them in the past, so they are picked earlier :)
-    # the current date is subtracted twice, so it sorts before early scheduling
-    # schedule on the full hour so we can recognize them easily
+    # these packages are manually scheduled, so they get the highest priority
+    # and are built before anything the scheduler queued up
     epoch = int(time.time())
-    now = datetime.now()
-    days = int(now.strftime('%j'))*2
-    hours = int(now.strftime('%H'))*2
-    minutes = int(now.strftime('%M'))
-    time_delta = timedelta(days=days, hours=hours, minutes=minutes)
-    date = (now - time_delta).strftime('%Y-%m-%d %H:%M')
-    log.debug('date_scheduled = ' + date + ' time_delta = ' + str(time_delta))
-
-
-    # a single person can't schedule more than 500 packages in the same day; this
-    # is actually easy to bypass, but let's give some trust to the Debian people
-    query = """SELECT count(*) FROM manual_scheduler
-               WHERE requester = '{}' AND date_request > '{}'"""
+    date = datetime.now().strftime('%Y-%m-%d %H:%M')
+    log.debug('date_scheduled = ' + date + ' priority = ' + Priority.MANUAL.name)
+
+
+    # every requester has a budget of builder time per day, see rblib/quota.py;
+    # this is actually easy to bypass, but let's give some trust to the
+    # Debian people
+    # the tokens are taken in the same transaction as the scheduling, so that
+    # they are not spent if it fails
+    transaction = conn_db.begin()
     try:
-        amount = int(query_db(query.format(requester, int(time.time()-86400)))[0][0])
-    except IndexError:
-        amount = 0
-    log.debug(requester + ' already scheduled ' + str(amount) + ' packages today')
-    if amount + len(ids) > 500 and not local:
+        costs = estimate_costs(ids)
+        admission = admit(requester, arch, costs, local=local,
+                          dry_run=dry_run)
+    except Exception:
+        transaction.rollback()
+        raise
+    if dry_run:
+        cost_report(requester, arch, dict(zip(ids, pkgs)), costs, admission)
+    log.debug('%s has %.2f build hours left, this costs %.2f', requester,
+              admission.tokens, admission.cost)
+    if not admission.admitted:
+        transaction.rollback()
         log.error(bcolors.FAIL + 'You have exceeded the maximum number of manual ' +
                   'reschedulings allowed for a day. Please ask in ' +
                   '#debian-reproducible if you need to schedule more packages.' +
                   bcolors.ENDC)
         sys.exit(1)
+    priority = Priority.MANUAL
+    if admission.deferred:
+        # the builders are busy, don't let this go before everything else
+        priority = Priority.DEFERRED
+        info_msg += ' - deferred'
+        log.warning(bcolors.WARN + 'The builders are busy, these packages ' +
+                    'are scheduled with a lower priority.' + bcolors.ENDC)
 
 
     # do the actual scheduling
@@ -301,18 +307,13 @@ def rest(scheduling_args, requester, local, suite, arch):
         do_notify = 0
 
     schedule_table = db_table('schedule')
-    if ids:
-        existing_pkg_ids = dict(query_db(sql.select([
-            schedule_table.c.package_id,
-            schedule_table.c.id,
-        ]).where(schedule_table.c.package_id.in_(ids))))
-
     for id in ids:
         if id in existing_pkg_ids:
             update_schedule.append({
                 'update_id': existing_pkg_ids[id],
                 'package_id': id,
                 'date_scheduled': date,
+                'priority': int(priority),
                 'save_artifacts': artifacts_value,
                 'notify': str(do_notify),
                 'scheduler': requester,
@@ -322,6 +323,7 @@ def rest(scheduling_args, requester, local, suite, arch):
             add_to_schedule.append({
                 'package_id': id,
                 'date_scheduled': date,
+                'priority': int(priority),
                 'save_artifacts': artifacts_value,
                 'notify': str(do_notify),
                 'scheduler': requester,
@@ -343,15 +345,19 @@ def rest(scheduling_args, requester, local, suite, arch):
     insert_manual_query = db_table('manual_scheduler').insert()
 
     if not dry_run:
-        transaction = conn_db.begin()
-        if add_to_schedule:
-            conn_db.execute(insert_schedule_query, add_to_schedule)
-        if update_schedule:
-            conn_db.execute(update_schedule_query, update_schedule)
-        if save_schedule:
-            conn_db.execute(insert_manual_query, save_schedule)
+        try:
+            if add_to_schedule:
+                conn_db.execute(insert_schedule_query, add_to_schedule)
+            if update_schedule:
+                conn_db.execute(update_schedule_query, update_schedule)
+            if save_schedule:
+                conn_db.execute(insert_manual_query, save_schedule)
+        except Exception:
+            transaction.rollback()
+            raise
         transaction.commit()
     else:
+        transaction.rollback()
         log.info('Ran with --dry-run, scheduled nothing')
 
     log.info(bcolors.GOOD + info_msg + bcolors.ENDC)
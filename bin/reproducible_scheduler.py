@@ -10,19 +10,25 @@
 #
 # Schedule packages to be build.
 
+import io
 import sys
-import lzma
-import deb822
+import random
 from sqlalchemy import sql
-from urllib.request import urlopen
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from debian.debian_support import Version
 
 from rblib import query_db, db_table
 from rblib.confparse import log
 from rblib.const import SUITES, ARCHS, conn_db
 from rblib.utils import print_critical_message
-from rblib.models import Package
+from rblib.models import Package, invalidate_package
+from rblib.journal import record_changes, purge_changes
+from rblib.archive import iter_sources
+from rblib.scheduling import (Priority, DEFAULT_DURATION, fair_share,
+                              age_schedule, expire_claims, build_costs,
+                              queued_hours)
+from rblib.durations import update_build_stats
 from reproducible_html_live_status import generate_schedule
 from reproducible_html_packages import gen_packages_html
 from reproducible_html_packages import purge_old_pages
@@ -69,6 +75,10 @@ LIMITS_E404 defines how many packages with status E404 are rescheduled at max.
 MINIMUM_AGE = {'amd64': 9, 'i386': 12, 'arm64': 11, 'armhf': 25}
 # maximum queue size, see explainations above
 MAXIMA = {'amd64': 2000, 'i386': 1600, 'arm64': 2000, 'armhf': 1800}
+# maximum queue size in expected build hours, for the architectures listed
+# here it replaces MAXIMA: on the slow ones a package count says little of
+# how long the queue takes to be built (about 20 minutes a build on armhf)
+MAXIMA_HOURS = {'armhf': 600}
 # limits, see explainations above
 LIMITS = {
     'untested': {
@@ -224,6 +234,29 @@ LIMITS = {
 }
 # maximum amount of packages with status E404 which will be rescheduled
 LIMIT_E404 = 255
+# how the builders are shared between the suites, within the same priority
+# (see rblib.scheduling.fair_share()); the suites not listed have weight 1
+SUITE_WEIGHTS = {'unstable': 2}
+# how the queue is packed, using the expected build durations:
+#  'oldest': the packages built the longest ago first, the builders are
+#            shared between the suites by package count
+#  'shortest': the packages expected to build the fastest first
+#  'balanced': like 'oldest', but the builders are shared between the
+#              suites by build hours
+PACKING = 'balanced'
+# the queues, in order of precedence (see classify_candidate()), and the
+# criteria of each of them
+QUEUES = OrderedDict([
+    ('untested', 'not tested before, randomly sorted'),
+    ('new', 'tested before, new version available, sorted by last build date'),
+    ('ftbfs', 'status ftbfs, no bug filed, tested at least 3 days ago, '
+              'no new version available, sorted by last build date'),
+    ('depwait', 'status depwait, no bug filed, tested at least 2 days ago, '
+                'no new version available, sorted by last build date'),
+    ('e404', 'tested at least 12h ago, status E404, sorted by last build date'),
+    ('old', 'tested at least {minimum_age} days ago, no new version '
+            'available, sorted by last build date'),
+])
 
 
 class Limit:
@@ -273,143 +306,117 @@ class Limit:
 
 
 def update_sources(suite):
-    # download the sources file for this suite
-    mirror = 'http://deb.debian.org/debian'
-    remotefile = mirror + '/dists/' + suite + '/main/source/Sources.xz'
-    log.info('Downloading sources file for %s: %s', suite, remotefile)
-    sources = lzma.decompress(urlopen(remotefile).read()).decode('utf8')
-    log.debug('\tdownloaded')
+    # extract relevant info (package name and version) from the sources file
+    # of this suite, streamed from the local cache of the archive
+    sources = {}
+    for name, version, extra_source_only in iter_sources(suite):
+        if extra_source_only:
+            log.debug('Ignoring %s due to Extra-Source-Only',
+                      (name, version, suite))
+            continue
+        # only keep the most recent version of a src for each package/suite
+        sources[name] = version
+    log.debug('\tloaded')
     for arch in ARCHS:
         log.info('Updating sources db for %s/%s...', suite, arch)
         update_sources_db(suite, arch, sources)
         log.info('DB update done for %s/%s done at %s.', suite, arch, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
-def update_sources_db(suite, arch, sources):
-    # extract relevant info (package name and version) from the sources file
-    new_pkgs = set()
-    newest_version = {}
-    for src in deb822.Sources.iter_paragraphs(sources.split('\n')):
-        pkg = (src['Package'], src['Version'], suite, arch)
+def update_sources_db(suite, arch, new_pkgs):
+    """
+    new_pkgs is a dict of the {name: version} of the sources of suite, as
+    listed in the archive.
+    """
+    # Everything happens in a single transaction: the content of the Sources
+    # file is copied into a temporary table, and the differences with the
+    # sources table are computed by the database.
+    transaction = conn_db.begin()
+    query_db('CREATE TEMPORARY TABLE new_sources '
+             '(name TEXT NOT NULL, version TEXT NOT NULL, PRIMARY KEY (name)) '
+             'ON COMMIT DROP')
+    data = io.StringIO(''.join('{}\t{}\n'.format(name, version)
+                               for name, version in new_pkgs.items()))
+    cursor = conn_db.connection.cursor()
+    cursor.copy_from(data, 'new_sources', columns=('name', 'version'))
+    cursor.close()
+    query_db('ANALYZE new_sources')
 
-        if 'Extra-Source-Only' in src and src['Extra-Source-Only'] == 'yes':
-            log.debug('Ignoring {} due to Extra-Source-Only'.format(pkg))
-            continue
-
-        # only keep the most recent version of a src for each package/suite/arch
-        key = src['Package'] + suite + arch
-        if key in newest_version:
-            oldversion = newest_version[key]
-            oldpackage = (src['Package'], oldversion, suite, arch)
-            new_pkgs.remove(oldpackage)
-
-        newest_version[key] = src['Version']
-        new_pkgs.add(pkg)
-
-    # get the current packages in the database
-    query = "SELECT name, version, suite, architecture FROM sources " + \
-            "WHERE suite='{}' AND architecture='{}'".format(suite, arch)
-    cur_pkgs = set([(p.name, p.version, p.suite, p.architecture) for p in query_db(query)])
-    pkgs_to_add = []
+    sources_table = db_table('sources')
+    # updated packages
+    query = sql.text(
+        "SELECT s.id, s.name, s.version AS old_version, n.version "
+        "FROM sources AS s JOIN new_sources AS n ON s.name=n.name "
+        "WHERE s.suite=:suite AND s.architecture=:arch "
+        "AND s.version != n.version")
     updated_pkgs = []
-    different_pkgs = [x for x in new_pkgs if x not in cur_pkgs]
-    log.debug('Packages different in the archive and in the db: %s',
-              different_pkgs)
-    for pkg in different_pkgs:
-        # pkg: (name, version, suite, arch)
-        query = "SELECT id, version, notify_maintainer FROM sources " + \
-                "WHERE name='{}' AND suite='{}' AND architecture='{}'"
-        query = query.format(pkg[0], pkg[2], pkg[3])
-        try:
-            result = query_db(query)[0]
-        except IndexError:  # new package
-            pkgs_to_add.append({
-                'name': pkg[0],
-                'version': pkg[1],
-                'suite': pkg[2],
-                'architecture': pkg[3],
-            })
-            continue
-        pkg_id = result[0]
-        old_version = result[1]
-        notify_maint = int(result[2])
-        if Version(pkg[1]) > Version(old_version):
-            log.debug('New version: ' + str(pkg) + ' (we had  ' +
-                      old_version + ')')
+    for pkg in query_db(query, suite=suite, arch=arch):
+        if Version(pkg.version) > Version(pkg.old_version):
+            log.debug('New version: %s (we had %s)',
+                      (pkg.name, pkg.version, suite, arch), pkg.old_version)
             updated_pkgs.append({
-                'update_id': pkg_id,
-                'name': pkg[0],
-                'version': pkg[1],
-                'suite': pkg[2],
-                'architecture': pkg[3],
-                'notify_maintainer': notify_maint,
+                'update_id': pkg.id,
+                'name': pkg.name,
+                'version': pkg.version,
             })
-    # Now actually update the database:
-    sources_table = db_table('sources')
-    # updated packages
     log.info('Pushing ' + str(len(updated_pkgs)) +
              ' updated packages to the database...')
     if updated_pkgs:
-        transaction = conn_db.begin()
         update_query = sources_table.update().\
-            where(sources_table.c.id == sql.bindparam('update_id'))
+            where(sources_table.c.id == sql.bindparam('update_id')).\
+            values(version=sql.bindparam('version'))
         conn_db.execute(update_query, updated_pkgs)
-        transaction.commit()
+        record_changes([(x['name'], suite, arch) for x in updated_pkgs],
+                       'new version')
 
     # new packages
+    query = sql.text(
+        "INSERT INTO sources (name, version, suite, architecture) "
+        "SELECT n.name, n.version, :suite, :arch FROM new_sources AS n "
+        "WHERE NOT EXISTS (SELECT 1 FROM sources AS s WHERE s.name=n.name "
+        "AND s.suite=:suite AND s.architecture=:arch) "
+        "RETURNING name, version")
+    pkgs_to_add = [{'name': x.name, 'version': x.version} for x in
+                   query_db(query, suite=suite, arch=arch)]
     if pkgs_to_add:
-        log.info('Now inserting %i new sources in the database: %s',
+        log.info('Inserted %i new sources in the database: %s',
                  len(pkgs_to_add), pkgs_to_add)
-        transaction = conn_db.begin()
-        conn_db.execute(sources_table.insert(), pkgs_to_add)
-        transaction.commit()
+        record_changes([(x['name'], suite, arch) for x in pkgs_to_add],
+                       'new package')
 
     # RM'ed packages
-    cur_pkgs_name = [x[0] for x in cur_pkgs]
-    new_pkgs_name = [x[0] for x in new_pkgs]
-    rmed_pkgs = [x for x in cur_pkgs_name if x not in new_pkgs_name]
-    log.info('Now deleting %i removed packages: %s', len(rmed_pkgs),
-             rmed_pkgs)
-    rmed_pkgs_id = []
-    pkgs_to_rm = []
-    query = "SELECT id FROM sources WHERE name='{}' AND suite='{}' " + \
-            "AND architecture='{}'"
-    for pkg in rmed_pkgs:
-        result = query_db(query.format(pkg, suite, arch))
-        rmed_pkgs_id.append({'deleteid': result[0][0]})
-        pkgs_to_rm.append({'name': pkg, 'suite': suite, 'architecture': arch})
-    log.debug('removed packages ID: %s',
-              [str(x['deleteid']) for x in rmed_pkgs_id])
-    log.debug('removed packages: %s', pkgs_to_rm)
+    query = sql.text(
+        "SELECT s.id, s.name FROM sources AS s "
+        "WHERE s.suite=:suite AND s.architecture=:arch "
+        "AND NOT EXISTS (SELECT 1 FROM new_sources AS n WHERE n.name=s.name)")
+    rmed_pkgs = query_db(query, suite=suite, arch=arch)
+    rmed_pkgs_id = [x.id for x in rmed_pkgs]
+    pkgs_to_rm = [{'name': x.name, 'suite': suite, 'architecture': arch}
+                  for x in rmed_pkgs]
+    log.info('Now deleting %i removed packages: %s', len(pkgs_to_rm),
+             [x['name'] for x in pkgs_to_rm])
+    log.debug('removed packages ID: %s', rmed_pkgs_id)
 
     if rmed_pkgs_id:
-        transaction = conn_db.begin()
-        results_table = db_table('results')
-        schedule_table = db_table('schedule')
-        notes_table = db_table('notes')
-        removed_packages_table = db_table('removed_packages')
-
-        delete_results_query = results_table.delete().\
-            where(results_table.c.package_id == sql.bindparam('deleteid'))
-        delete_schedule_query = schedule_table.delete().\
-            where(schedule_table.c.package_id == sql.bindparam('deleteid'))
-        delete_notes_query = notes_table.delete().\
-            where(notes_table.c.package_id == sql.bindparam('deleteid'))
-        delete_sources_query = sources_table.delete().\
-            where(sources_table.c.id == sql.bindparam('deleteid'))
-
-        conn_db.execute(delete_results_query, rmed_pkgs_id)
-        conn_db.execute(delete_schedule_query, rmed_pkgs_id)
-        conn_db.execute(delete_notes_query, rmed_pkgs_id)
-        conn_db.execute(delete_sources_query, rmed_pkgs_id)
-        conn_db.execute(removed_packages_table.insert(), pkgs_to_rm)
-        transaction.commit()
+        record_changes([(x['name'], suite, arch) for x in pkgs_to_rm],
+                       'removed')
+        for table in ('results', 'schedule', 'notes'):
+            query_db(sql.text(
+                'DELETE FROM {} WHERE package_id = ANY(:ids)'.format(table)),
+                ids=rmed_pkgs_id)
+        query_db(sql.text('DELETE FROM sources WHERE id = ANY(:ids)'),
+                 ids=rmed_pkgs_id)
+        conn_db.execute(db_table('removed_packages').insert(), pkgs_to_rm)
+    transaction.commit()
+
+    for pkg in updated_pkgs + pkgs_to_rm:
+        invalidate_package(pkg['name'])
 
     # finally check whether the db has the correct number of packages
     query = "SELECT count(*) FROM sources WHERE suite='{}' " + \
             "AND architecture='{}'"
     pkgs_end = query_db(query.format(suite, arch))
-    count_new_pkgs = len(set([x[0] for x in new_pkgs]))
+    count_new_pkgs = len(new_pkgs)
     if int(pkgs_end[0][0]) != count_new_pkgs:
         print_critical_message('AH! The number of source in the Sources file' +
                                ' is different than the one in the DB!')
@@ -434,24 +441,58 @@ def print_schedule_result(suite, arch, criteria, packages):
     log.info('Packages:   ' + ' '.join([x[1] for x in packages]))
 
 
-def queue_packages(all_pkgs, packages, date):
-    date = date.strftime('%Y-%m-%d %H:%M')
-    pkgs = [x for x in packages if x[0] not in all_pkgs]
-    if len(pkgs) > 0:
-        log.info('The following ' + str(len(pkgs)) + ' source packages have ' +
-             'been queued up for scheduling at ' + date + ': ' +
-             ' '.join([str(x[1]) for x in pkgs]))
-    all_pkgs.update({x[0]: date for x in pkgs})
+def queue_packages(all_pkgs, packages, priority):
+    """
+    Add packages (the usual {suite: [(id, name)]} dict) to all_pkgs, a
+    {priority: {suite: [id]}} dict, skipping the ones already queued.
+    """
+    queued = set(x for p in all_pkgs.values() for s in p.values() for x in s)
+    for suite in SUITES:
+        pkgs = [x for x in packages[suite] if x[0] not in queued]
+        if len(pkgs) > 0:
+            log.info('The following ' + str(len(pkgs)) + ' source packages ' +
+                     'in ' + suite + ' have been queued up for scheduling ' +
+                     'with priority ' + priority.name + ': ' +
+                     ' '.join([str(x[1]) for x in pkgs]))
+        all_pkgs.setdefault(priority, {}).setdefault(suite, []).extend(
+            x[0] for x in pkgs)
     return all_pkgs
 
 
-def schedule_packages(packages):
-    pkgs = [{'package_id': x, 'date_scheduled': packages[x], 'build_type': 'ci_build'} for x in packages.keys()]
-    log.debug('IDs about to be scheduled: %s', packages.keys())
+def schedule_packages(packages, costs=None):
+    start = datetime.now()
+    pkgs = []
+    for priority, by_suite in packages.items():
+        pkgs.extend(fair_share(by_suite, priority, SUITE_WEIGHTS, start,
+                               costs))
+    for pkg in pkgs:
+        pkg['build_type'] = 'ci_build'
+    log.debug('IDs about to be scheduled: %s', [x['package_id'] for x in pkgs])
     if pkgs:
         conn_db.execute(db_table('schedule').insert(), pkgs)
 
 
+def over_maxima(arch, total, hours, factor=1):
+    """
+    Whether the queue of arch, of total packages and hours expected build
+    hours, is over factor times its maximum size.
+    """
+    if arch in MAXIMA_HOURS:
+        return hours > MAXIMA_HOURS[arch] * factor
+    return total > MAXIMA[arch] * factor
+
+
+def candidate_costs(candidates, arch):
+    """
+    Return a {package_id: expected duration} dict of the candidates, to pack
+    the queue by build hours.
+    """
+    costs = build_costs(arch)
+    return {row.id: costs.get(row.id, DEFAULT_DURATION)
+            for queue in candidates.values() for rows in queue.values()
+            for row in rows}
+
+
 def add_up_numbers(packages, arch):
     packages_sum = '+'.join([str(len(packages[x])) for x in SUITES])
     if packages_sum == '0+0+0+0':
@@ -459,124 +500,97 @@ def add_up_numbers(packages, arch):
     return packages_sum
 
 
-def query_untested_packages(suite, arch, limit):
-    criteria = 'not tested before, randomly sorted'
-    query = """SELECT DISTINCT *
-               FROM (
-                    SELECT sources.id, sources.name FROM sources
-                    WHERE sources.suite='{suite}' AND sources.architecture='{arch}'
-                    AND sources.id NOT IN
-                       (SELECT schedule.package_id FROM schedule WHERE build_type='ci_build')
-                    AND sources.id NOT IN
-                       (SELECT results.package_id FROM results)
-                    ORDER BY random()
-                ) AS tmp
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_new_versions(suite, arch, limit):
-    criteria = 'tested before, new version available, sorted by last build date'
-    query = """SELECT s.id, s.name, s.version, r.version, max(r.build_date) max_date
-               FROM sources AS s JOIN results AS r ON s.id = r.package_id
-               WHERE s.suite='{suite}' AND s.architecture='{arch}'
-               AND s.version != r.version
-               AND r.status != 'blacklisted'
-               AND s.id IN (SELECT package_id FROM results)
-               AND s.id NOT IN (SELECT schedule.package_id FROM schedule WHERE build_type='ci_build')
-               GROUP BY s.id, s.name, s.version, r.version
-               ORDER BY max_date
-               LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit)
-    pkgs = query_db(query)
-    # the next line avoids constant rescheduling of packages:
-    # packages in our repository != official repo,
-    # so they will always be selected by the query above
-    # so we only accept them if there version is greater than the already tested one
-    packages = [(x[0], x[1]) for x in pkgs if Version(x[2]) > Version(x[3])]
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_old_ftbfs_versions(suite, arch, limit):
-    criteria = 'status ftbfs, no bug filed, tested at least 3 days ago, ' + \
-               'no new version available, sorted by last build date'
-    date = (datetime.now()-timedelta(days=3)).strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                JOIN notes AS n ON n.package_id=s.id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status='FTBFS'
-                AND ( n.bugs = '[]' OR n.bugs IS NULL )
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule WHERE build_type='ci_build')
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit,
-                                        date=date)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_old_depwait_versions(suite, arch, limit):
-    criteria = 'status depwait, no bug filed, tested at least 2 days ago, ' + \
-               'no new version available, sorted by last build date'
-    date = (datetime.now()-timedelta(days=2)).strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status='depwait'
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule WHERE build_type='ci_build')
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit,
-                                        date=date)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_old_versions(suite, arch, limit):
-    criteria = """tested at least {minimum_age} days ago, no new version available,
-               sorted by last build date""".format(minimum_age=MINIMUM_AGE[arch])
-    date = (datetime.now()-timedelta(days=MINIMUM_AGE[arch]))\
-           .strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status != 'blacklisted'
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule WHERE build_type='ci_build')
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch,
-                                        date=date, limit=limit)
-    packages = query_db(query)
+def query_candidates(arch):
+    """
+    Find all the sources of arch that are not scheduled yet, and classify
+    them in the queue they belong to (see classify_candidate()), with a
+    single query.
+    Returns a {queue: {suite: [rows]}} dict, every list sorted in the order
+    the packages should be picked: randomly for the untested ones, by last
+    build date for the others.
+    """
+    query = sql.text(
+        "SELECT s.id, s.name, s.suite, s.version, r.version AS tested_version, "
+        "r.status, r.build_date, n.package_id IS NOT NULL AS has_note, n.bugs "
+        "FROM sources AS s "
+        "LEFT JOIN results AS r ON r.package_id=s.id "
+        "LEFT JOIN notes AS n ON n.package_id=s.id "
+        "WHERE s.architecture=:arch AND s.suite = ANY(:suites) "
+        "AND NOT EXISTS (SELECT 1 FROM schedule AS p "
+        "WHERE p.package_id=s.id AND p.build_type='ci_build')")
+    costs = build_costs(arch) if PACKING != 'oldest' else None
+    candidates = classify_candidates(query_db(query, arch=arch, suites=SUITES),
+                                     arch, datetime.now(), costs)
+    log.info('Candidates on %s: %s', arch, ', '.join(
+        '{} {}'.format(sum(len(x) for x in candidates[q].values()), q)
+        for q in QUEUES))
+    return candidates
+
+
+def classify_candidates(rows, arch, now, costs=None):
+    """
+    Classify the candidate rows (as returned by the query of
+    query_candidates()) in their queue, see query_candidates().
+    With PACKING = 'shortest', the packages of the queues other than the
+    untested one are sorted by their expected duration, from costs (a
+    {package_id: duration} dict), instead of by last build date.
+    """
+    candidates = {q: {suite: [] for suite in SUITES} for q in QUEUES}
+    for row in rows:
+        queue = classify_candidate(row, arch, now)
+        if queue:
+            candidates[queue][row.suite].append(row)
+    for queue in candidates:
+        for suite in SUITES:
+            if queue == 'untested':
+                random.shuffle(candidates[queue][suite])
+            elif PACKING == 'shortest' and costs is not None:
+                candidates[queue][suite].sort(key=lambda x: (
+                    costs.get(x.id, DEFAULT_DURATION),
+                    x.build_date or datetime.min))
+            else:
+                candidates[queue][suite].sort(
+                    key=lambda x: x.build_date or datetime.min)
+    return candidates
+
+
+def classify_candidate(row, arch, now):
+    """
+    Return the queue of a candidate, or None if it doesn't need to be built.
+    A package only goes in the first queue it qualifies for, in this order:
+    untested, new, ftbfs, depwait, e404, old.
+    """
+    if row.status is None:
+        return 'untested'
+    # packages in our repository != official repo, so we only accept
+    # them if their version is greater than the already tested one
+    if row.status != 'blacklisted' and row.version != row.tested_version \
+            and Version(row.version) > Version(row.tested_version):
+        return 'new'
+    if row.build_date is None:
+        return None
+    if row.status == 'FTBFS' and row.has_note and \
+            row.bugs in ('[]', None) and \
+            row.build_date < now - timedelta(days=3):
+        return 'ftbfs'
+    if row.status == 'depwait' and row.build_date < now - timedelta(days=2):
+        return 'depwait'
+    if row.status == 'E404' and row.build_date < now - timedelta(days=0.5):
+        return 'e404'
+    if row.status != 'blacklisted' and \
+            row.build_date < now - timedelta(days=MINIMUM_AGE[arch]):
+        return 'old'
+    return None
+
+
+def pick_candidates(candidates, queue, suite, arch, limit):
+    packages = [(x.id, x.name) for x in candidates[queue][suite][:limit]]
+    criteria = QUEUES[queue].format(minimum_age=MINIMUM_AGE[arch])
     print_schedule_result(suite, arch, criteria, packages)
     return packages
 
-def query_e404_versions(suite, arch, limit):
-    criteria = """tested at least 12h ago, status E404,
-               sorted by last build date"""
-    date = (datetime.now()-timedelta(days=0.5)).strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status = 'E404'
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule WHERE build_type='ci_build')
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit,
-                                        date=date)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
 
-def schedule_untested_packages(arch, total):
+def schedule_untested_packages(arch, total, candidates):
     packages = {}
     limit = Limit(arch, 'untested')
     for suite in SUITES:
@@ -584,7 +598,8 @@ def schedule_untested_packages(arch, total):
         many_untested = limit.get_limit('*')
         log.info('Requesting %s untested packages in %s/%s...',
                  many_untested, suite, arch)
-        packages[suite] = query_untested_packages(suite, arch, many_untested)
+        packages[suite] = pick_candidates(candidates, 'untested', suite,
+                                          arch, many_untested)
         log.info('Received ' + str(len(packages[suite])) +
                  ' untested packages in ' + suite + '/' + arch + ' to schedule.')
         log.info('--------------------------------------------------------------')
@@ -596,7 +611,7 @@ def schedule_untested_packages(arch, total):
     return packages, msg
 
 
-def schedule_new_versions(arch, total):
+def schedule_new_versions(arch, total, candidates):
     packages = {}
     limit = Limit(arch, 'new')
     for suite in SUITES:
@@ -604,7 +619,8 @@ def schedule_new_versions(arch, total):
         many_new = limit.get_staged_limit(total)
         log.info('Requesting %s new versions in %s/%s...',
                  many_new, suite, arch)
-        packages[suite] = query_new_versions(suite, arch, many_new)
+        packages[suite] = pick_candidates(candidates, 'new', suite, arch,
+                                          many_new)
         log.info('Received ' + str(len(packages[suite])) +
                  ' new packages in ' + suite + '/' + arch + ' to schedule.')
         log.info('--------------------------------------------------------------')
@@ -616,7 +632,7 @@ def schedule_new_versions(arch, total):
     return packages, msg
 
 
-def schedule_old_ftbfs_versions(arch, total):
+def schedule_old_ftbfs_versions(arch, total, candidates):
     packages = {}
     limit = Limit(arch, 'ftbfs')
     for suite in SUITES:
@@ -624,7 +640,8 @@ def schedule_old_ftbfs_versions(arch, total):
         old_ftbfs = limit.get_staged_limit(total)
         log.info('Requesting %s old ftbfs packages in %s/%s...', old_ftbfs,
                  suite, arch)
-        packages[suite] = query_old_ftbfs_versions(suite, arch, old_ftbfs)
+        packages[suite] = pick_candidates(candidates, 'ftbfs', suite, arch,
+                                          old_ftbfs)
         log.info('Received ' + str(len(packages[suite])) +
                  ' old ftbfs packages in ' + suite + '/' + arch + ' to schedule.')
         log.info('--------------------------------------------------------------')
@@ -636,7 +653,7 @@ def schedule_old_ftbfs_versions(arch, total):
     return packages, msg
 
 
-def schedule_old_depwait_versions(arch, total):
+def schedule_old_depwait_versions(arch, total, candidates):
     packages = {}
     limit = Limit(arch, 'depwait')
     for suite in SUITES:
@@ -644,7 +661,8 @@ def schedule_old_depwait_versions(arch, total):
         old_depwait = limit.get_staged_limit(total)
         log.info('Requesting %s old depwait packages in %s/%s...', old_depwait,
                  suite, arch)
-        packages[suite] = query_old_depwait_versions(suite, arch, old_depwait)
+        packages[suite] = pick_candidates(candidates, 'depwait', suite, arch,
+                                          old_depwait)
         log.info('Received ' + str(len(packages[suite])) +
                  ' old depwait packages in ' + suite + '/' + arch + ' to schedule.')
         log.info('--------------------------------------------------------------')
@@ -656,7 +674,7 @@ def schedule_old_depwait_versions(arch, total):
     return packages, msg
 
 
-def schedule_old_versions(arch, total):
+def schedule_old_versions(arch, total, candidates):
     packages = {}
     limit = Limit(arch, 'old')
     for suite in SUITES:
@@ -664,7 +682,8 @@ def schedule_old_versions(arch, total):
         many_old = limit.get_staged_limit(total)
         log.info('Requesting %s old packages in %s/%s...', many_old,
                  suite, arch)
-        packages[suite] = query_old_versions(suite, arch, many_old)
+        packages[suite] = pick_candidates(candidates, 'old', suite, arch,
+                                          many_old)
         log.info('Received ' + str(len(packages[suite])) +
                  ' old packages in ' + suite + '/' + arch + ' to schedule.')
         log.info('--------------------------------------------------------------')
@@ -675,12 +694,13 @@ def schedule_old_versions(arch, total):
         msg = ''
     return packages, msg
 
-def schedule_e404_versions(arch, total):
+def schedule_e404_versions(arch, total, candidates):
     packages = {}
     for suite in SUITES:
         log.info('Requesting E404 packages in %s/%s...',
                  suite, arch)
-        packages[suite] = query_e404_versions(suite, arch, LIMIT_E404)
+        packages[suite] = pick_candidates(candidates, 'e404', suite, arch,
+                                          LIMIT_E404)
         log.info('Received ' + str(len(packages[suite])) +
                  ' E404 packages in ' + suite + '/' + arch + ' to schedule.')
         log.info('--------------------------------------------------------------')
@@ -692,21 +712,23 @@ def schedule_e404_versions(arch, total):
     return packages, msg
 
 
-def scheduler(arch):
-    query = "SELECT count(*) " + \
-            "FROM schedule AS p JOIN sources AS s ON p.package_id=s.id " + \
-            "WHERE s.architecture='{arch}' AND build_type='ci_build'"
-    total = int(query_db(query.format(arch=arch))[0][0])
-    log.info('==============================================================')
-    log.info('Currently scheduled packages in all suites on ' + arch + ': ' + str(total))
-    if total > MAXIMA[arch]:
+def plan_schedule(arch, total, candidates, hours=0):
+    """
+    Decide what to schedule on arch, given the number of packages already
+    scheduled (total), their expected build hours, and the candidates (see
+    query_candidates()).
+    Return the ((packages, message), ...) results of the untested, new,
+    ftbfs, depwait, e404 and old queues, in this order.  Nothing is written
+    to the database, so that this can be used for simulations as well.
+    """
+    if over_maxima(arch, total, hours):
         log.info(str(total) + ' packages already scheduled' +
                  ', only scheduling new versions.')
         empty_pkgs = {}
         for suite in SUITES:
             empty_pkgs[suite] = []
         untested, msg_untested = empty_pkgs, ''
-        new, msg_new = schedule_new_versions(arch, total)
+        new, msg_new = schedule_new_versions(arch, total, candidates)
         old_ftbfs, msg_old_ftbfs = empty_pkgs, ''
         old_depwait, msg_old_depwait = empty_pkgs, ''
         old, msg_old = empty_pkgs, ''
@@ -714,35 +736,49 @@ def scheduler(arch):
     else:
         log.info(str(total) + ' packages already scheduled' +
                  ', scheduling some more...')
-        untested, msg_untested = schedule_untested_packages(arch, total)
-        new, msg_new = schedule_new_versions(arch, total+len(untested))
-        old_ftbfs, msg_old_ftbfs = schedule_old_ftbfs_versions(arch, total+len(untested)+len(new))
-        old_depwait, msg_old_depwait = schedule_old_depwait_versions(arch, total+len(untested)+len(new)+len(old_ftbfs))
-        four04, msg_e404 = schedule_e404_versions(arch, total+len(untested)+len(new)+len(old_ftbfs)+len(old_depwait))
-        old, msg_old = schedule_old_versions(arch, total+len(untested)+len(new)+len(old_ftbfs)+len(old_depwait)+len(four04))
+        untested, msg_untested = schedule_untested_packages(arch, total, candidates)
+        new, msg_new = schedule_new_versions(arch, total+len(untested), candidates)
+        old_ftbfs, msg_old_ftbfs = schedule_old_ftbfs_versions(arch, total+len(untested)+len(new), candidates)
+        old_depwait, msg_old_depwait = schedule_old_depwait_versions(arch, total+len(untested)+len(new)+len(old_ftbfs), candidates)
+        four04, msg_e404 = schedule_e404_versions(arch, total+len(untested)+len(new)+len(old_ftbfs)+len(old_depwait), candidates)
+        old, msg_old = schedule_old_versions(arch, total+len(untested)+len(new)+len(old_ftbfs)+len(old_depwait)+len(four04), candidates)
+    return ((untested, msg_untested), (new, msg_new),
+            (old_ftbfs, msg_old_ftbfs), (old_depwait, msg_old_depwait),
+            (four04, msg_e404), (old, msg_old))
+
+
+def scheduler(arch):
+    query = "SELECT count(*) " + \
+            "FROM schedule AS p JOIN sources AS s ON p.package_id=s.id " + \
+            "WHERE s.architecture='{arch}' AND build_type='ci_build'"
+    total = int(query_db(query.format(arch=arch))[0][0])
+    hours = queued_hours(arch) if arch in MAXIMA_HOURS else 0
+    log.info('==============================================================')
+    log.info('Currently scheduled packages in all suites on ' + arch + ': ' + str(total))
+    candidates = query_candidates(arch)
+    (untested, msg_untested), (new, msg_new), (old_ftbfs, msg_old_ftbfs), \
+        (old_depwait, msg_old_depwait), (four04, msg_e404), (old, msg_old) = \
+        plan_schedule(arch, total, candidates, hours)
 
     now_queued_here = {}
-    # make sure to schedule packages in unstable first
-    # (but keep the view ordering everywhere else)
-    priotized_suite_order = ['unstable']
     for suite in SUITES:
-        if suite not in priotized_suite_order:
-            priotized_suite_order.append(suite)
-    for suite in priotized_suite_order:
         query = "SELECT count(*) " \
                 "FROM schedule AS p JOIN sources AS s ON p.package_id=s.id " \
                 "WHERE s.suite='{suite}' AND s.architecture='{arch}' AND p.build_type='ci_build'"
         query = query.format(suite=suite, arch=arch)
         now_queued_here[suite] = int(query_db(query)[0][0]) + \
             len(untested[suite]+new[suite]+old[suite])
-        # schedule packages differently in the queue...
-        to_be_scheduled = queue_packages({}, untested[suite], datetime.now()+timedelta(minutes=-720))
-        assert(isinstance(to_be_scheduled, dict))
-        to_be_scheduled = queue_packages(to_be_scheduled, new[suite], datetime.now()+timedelta(minutes=-1440))
-        to_be_scheduled = queue_packages(to_be_scheduled, old_ftbfs[suite], datetime.now()+timedelta(minutes=360))
-        to_be_scheduled = queue_packages(to_be_scheduled, old_depwait[suite], datetime.now()+timedelta(minutes=-360))
-        to_be_scheduled = queue_packages(to_be_scheduled, old[suite], datetime.now()+timedelta(minutes=720))
-        to_be_scheduled = queue_packages(to_be_scheduled, four04[suite], datetime.now())
+    # schedule packages differently in the queue...
+    to_be_scheduled = queue_packages({}, untested, Priority.UNTESTED)
+    assert(isinstance(to_be_scheduled, dict))
+    to_be_scheduled = queue_packages(to_be_scheduled, new, Priority.NEW)
+    to_be_scheduled = queue_packages(to_be_scheduled, old_ftbfs, Priority.FTBFS)
+    to_be_scheduled = queue_packages(to_be_scheduled, old_depwait, Priority.DEPWAIT)
+    to_be_scheduled = queue_packages(to_be_scheduled, old, Priority.OLD)
+    to_be_scheduled = queue_packages(to_be_scheduled, four04, Priority.E404)
+    if PACKING == 'balanced':
+        schedule_packages(to_be_scheduled, candidate_costs(candidates, arch))
+    else:
         schedule_packages(to_be_scheduled)
     # update the scheduled page
     generate_schedule(arch)  # from reproducible_html_indexes
@@ -778,6 +814,10 @@ if __name__ == '__main__':
         update_sources(suite)
         log.info('Sources for suite %s done at %s.', suite, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     purge_old_pages()
+    purge_changes()
+    expire_claims()
+    age_schedule()
+    update_build_stats()
     query = "SELECT count(*) " + \
             "FROM schedule AS p JOIN sources AS s ON s.id=p.package_id " + \
             "WHERE s.architecture='{}' AND build_type='ci_build'"
@@ -785,8 +825,10 @@ if __name__ == '__main__':
     for arch in ARCHS:
         log.info('Scheduling for %s...', arch)
         overall = int(query_db(query.format(arch))[0][0])
-        if overall > (MAXIMA[arch]*3):
-            log.info('%s packages already scheduled for %s, nothing to do.', overall, arch)
+        hours = queued_hours(arch) if arch in MAXIMA_HOURS else 0
+        if over_maxima(arch, overall, hours, 3):
+            log.info('%s packages (%.0f build hours) already scheduled for %s, '
+                     'nothing to do.', overall, hours, arch)
             continue
         log.info('%s packages already scheduled for %s, probably scheduling some '
                  'more...', overall, arch)
@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Depends: python3
+#
+# Simulate the scheduler over some weeks, to see the effect of a change of
+# LIMITS, MAXIMA or MINIMUM_AGE (or of the builders throughput) before
+# deploying it.  The decisions are taken by the real scheduler code
+# (classify_candidates(), plan_schedule(), queue_packages() and
+# rblib.scheduling), only the database and the builders are simulated.
+#
+# The initial state is either synthetic (--packages per suite and
+# architecture, all already tested) or a snapshot of the database
+# (--snapshot).  Every simulated hour, uploads happen at the given rate per
+# suite, the scheduler runs, and the builders of every architecture build
+# what is at the top of the queue at the given throughput.
+#
+# Reported, per architecture and simulated week: the queue length, the time
+# between an upload and the first build of the new version, and the age of
+# the results at the end of the week.
+
+import sys
+import math
+import heapq
+import logging
+import random
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import sql
+
+from rblib import query_db
+from rblib.confparse import DEBUG, unknown_args, log
+from rblib.const import SUITES, ARCHS
+from rblib.scheduling import (Priority, DEFAULT_DURATION, aged_priority,
+                              fair_share, build_rate)
+from reproducible_scheduler import (SUITE_WEIGHTS, classify_candidates,
+                                    over_maxima, plan_schedule,
+                                    queue_packages)
+
+
+# builds per hour, when not taken from the database
+DEFAULT_THROUGHPUT = {'amd64': 60, 'i386': 50, 'arm64': 60, 'armhf': 30}
+# uploads per day, the suites not listed get DEFAULT_UPLOADS
+UPLOADS = {'unstable': 400, 'experimental': 40}
+DEFAULT_UPLOADS = 5
+# share of the uploads that are new source packages
+NEW_SOURCES_RATIO = 0.03
+# the status of the results of new versions, in the synthetic state
+STATUSES = [('reproducible', 0.84), ('FTBR', 0.10), ('FTBFS', 0.04),
+            ('depwait', 0.01), ('E404', 0.005), ('blacklisted', 0.005)]
+
+
+class SimPackage:
+    """A source package of an architecture, with the attributes of the rows
+    returned by query_candidates(), so that the scheduler can use it as is."""
+    __slots__ = ('id', 'name', 'suite', 'version', 'tested_version', 'status',
+                 'build_date', 'has_note', 'bugs', 'scheduled', 'uploaded')
+
+    def __init__(self, id, name, suite, version, tested_version=None,
+                 status=None, build_date=None, has_note=False, bugs=None):
+        self.id = id
+        self.name = name
+        self.suite = suite
+        self.version = version
+        self.tested_version = tested_version
+        self.status = status
+        self.build_date = build_date
+        self.has_note = has_note
+        self.bugs = bugs
+        self.scheduled = False
+        self.uploaded = None  # time of the upload not built yet
+
+
+class SimArch:
+    def __init__(self, arch, throughput):
+        self.arch = arch
+        self.throughput = throughput  # builds per hour
+        self.packages = {}  # id → SimPackage
+        self.by_name = {}  # (suite, name) → SimPackage
+        self.queue = []  # heap of [priority, date_scheduled, id]
+        self.credit = 0.0  # fraction of build left from the previous hour
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.queue_lengths = []
+        self.first_builds = []  # hours between upload and first build
+        self.builds = 0
+
+    def add(self, pkg):
+        self.packages[pkg.id] = pkg
+        self.by_name[(pkg.suite, pkg.name)] = pkg
+
+    def enqueue(self, rows):
+        for row in rows:
+            self.packages[row['package_id']].scheduled = True
+            heapq.heappush(self.queue, [row['priority'], row['date_scheduled'],
+                                        row['package_id']])
+
+    def age(self, now):
+        # see rblib.scheduling.age_schedule()
+        for entry in self.queue:
+            entry[0] = aged_priority(entry[0], entry[1], now)
+        heapq.heapify(self.queue)
+
+    def build(self, now):
+        self.credit += self.throughput
+        todo = int(self.credit)
+        self.credit -= todo
+        for n in range(todo):
+            if not self.queue:
+                self.credit = 0.0
+                break
+            pkg = self.packages[heapq.heappop(self.queue)[2]]
+            pkg.scheduled = False
+            finished = now + timedelta(hours=(n + 1) / self.throughput)
+            if pkg.tested_version != pkg.version or \
+                    pkg.status in ('E404', 'depwait'):
+                pkg.status = draw_status()
+            pkg.tested_version = pkg.version
+            pkg.build_date = finished
+            if pkg.uploaded is not None:
+                self.first_builds.append(
+                    (finished - pkg.uploaded).total_seconds() / 3600)
+                pkg.uploaded = None
+            self.builds += 1
+
+    def result_ages(self, now):
+        return [(now - p.build_date).total_seconds() / 86400
+                for p in self.packages.values() if p.build_date is not None]
+
+
+def draw_status():
+    r = random.random()
+    for status, share in STATUSES:
+        r -= share
+        if r < 0:
+            return status
+    return STATUSES[0][0]
+
+
+def poisson(lam):
+    if lam > 50:  # normal approximation, good enough here
+        return max(0, int(round(random.gauss(lam, math.sqrt(lam)))))
+    limit, k, p = math.exp(-lam), 0, random.random()
+    while p > limit:
+        k += 1
+        p *= random.random()
+    return k
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def synthetic_state(archs, count, now):
+    next_id = 0
+    for suite in SUITES:
+        for n in range(count):
+            name = 'src%06d' % n
+            age = timedelta(days=random.uniform(0, 30))
+            status = draw_status()
+            has_note = status == 'FTBFS' and random.random() < 0.5
+            for sim in archs.values():
+                next_id += 1
+                sim.add(SimPackage(next_id, name, suite, '1', '1', status,
+                                   now - age, has_note))
+    return next_id
+
+
+def snapshot_state(archs):
+    """Load the sources, results, notes and schedule from the database."""
+    query = sql.text(
+        "SELECT s.id, s.name, s.suite, s.version, r.version AS tested_version, "
+        "r.status, r.build_date, n.package_id IS NOT NULL AS has_note, n.bugs, "
+        "p.priority, p.date_scheduled "
+        "FROM sources AS s "
+        "LEFT JOIN results AS r ON r.package_id=s.id "
+        "LEFT JOIN notes AS n ON n.package_id=s.id "
+        "LEFT JOIN schedule AS p ON p.package_id=s.id "
+        "AND p.build_type='ci_build' "
+        "WHERE s.architecture=:arch AND s.suite = ANY(:suites)")
+    next_id = 0
+    for arch, sim in archs.items():
+        rows = query_db(query, arch=arch, suites=SUITES)
+        for row in rows:
+            sim.add(SimPackage(row.id, row.name, row.suite, row.version,
+                               row.tested_version, row.status, row.build_date,
+                               row.has_note, row.bugs))
+            if row.priority is not None:
+                sim.enqueue([{'package_id': row.id, 'priority': row.priority,
+                              'date_scheduled': row.date_scheduled}])
+            next_id = max(next_id, row.id)
+        log.warning('Loaded %s packages of %s, %s scheduled', len(rows), arch,
+                    len(sim.queue))
+    return next_id
+
+
+def source_names(archs):
+    names = {suite: set() for suite in SUITES}
+    for sim in archs.values():
+        for suite, name in sim.by_name:
+            names[suite].add(name)
+    return {suite: sorted(x) for suite, x in names.items()}
+
+
+def upload(archs, names, uploads, next_id, now):
+    """Simulate the uploads of one hour, in all the architectures."""
+    for suite in SUITES:
+        for _ in range(poisson(uploads.get(suite, DEFAULT_UPLOADS) / 24)):
+            if not names[suite] or random.random() < NEW_SOURCES_RATIO:
+                name = 'new%06d' % next_id
+                names[suite].append(name)
+                for sim in archs.values():
+                    next_id += 1
+                    pkg = SimPackage(next_id, name, suite, '1')
+                    pkg.uploaded = now
+                    sim.add(pkg)
+                continue
+            name = random.choice(names[suite])
+            for sim in archs.values():
+                pkg = sim.by_name.get((suite, name))
+                if pkg is None:
+                    continue
+                pkg.version += '.1'
+                if pkg.uploaded is None:
+                    pkg.uploaded = now
+    return next_id
+
+
+def schedule(sim, now):
+    """One run of the scheduler for an architecture, see scheduler()."""
+    # the builds are not given a duration here, they all take the default
+    total = len(sim.queue)
+    hours = total * DEFAULT_DURATION / 3600
+    if over_maxima(sim.arch, total, hours, 3):
+        return
+    candidates = classify_candidates(
+        (p for p in sim.packages.values() if not p.scheduled), sim.arch, now)
+    untested, new, ftbfs, depwait, e404, old = \
+        [x[0] for x in plan_schedule(sim.arch, total, candidates, hours)]
+    to_be_scheduled = queue_packages({}, untested, Priority.UNTESTED)
+    to_be_scheduled = queue_packages(to_be_scheduled, new, Priority.NEW)
+    to_be_scheduled = queue_packages(to_be_scheduled, ftbfs, Priority.FTBFS)
+    to_be_scheduled = queue_packages(to_be_scheduled, depwait, Priority.DEPWAIT)
+    to_be_scheduled = queue_packages(to_be_scheduled, old, Priority.OLD)
+    to_be_scheduled = queue_packages(to_be_scheduled, e404, Priority.E404)
+    for priority, by_suite in to_be_scheduled.items():
+        sim.enqueue(fair_share(by_suite, priority, SUITE_WEIGHTS, now))
+
+
+def report(week, archs, now):
+    for arch, sim in archs.items():
+        ages = sim.result_ages(now)
+        print('{:>4} {:<8} {:>7} {:>7.0f} {:>7} {:>7} {:>8.1f} {:>8.1f} '
+              '{:>7.1f} {:>7.1f} {:>7.1f}'.format(
+                  week, arch, sim.builds,
+                  sum(sim.queue_lengths) / max(1, len(sim.queue_lengths)),
+                  max(sim.queue_lengths, default=0), len(sim.queue),
+                  percentile(sim.first_builds, 50),
+                  percentile(sim.first_builds, 95),
+                  percentile(ages, 50), percentile(ages, 95),
+                  max(ages, default=float('nan'))))
+        sim.reset_stats()
+
+
+def simulate(archs, uploads, weeks, interval, next_id, start):
+    names = source_names(archs)
+    print('{:>4} {:<8} {:>7} {:>7} {:>7} {:>7} {:>8} {:>8} {:>7} {:>7} '
+          '{:>7}'.format('week', 'arch', 'builds', 'queue', 'max', 'end',
+                         'ttfb50h', 'ttfb95h', 'age50d', 'age95d', 'agemaxd'))
+    now = start
+    for hour in range(1, weeks * 7 * 24 + 1):
+        next_id = upload(archs, names, uploads, next_id, now)
+        if hour % interval == 0:
+            for sim in archs.values():
+                sim.age(now)
+                schedule(sim, now)
+        for sim in archs.values():
+            sim.build(now)
+            sim.queue_lengths.append(len(sim.queue))
+        now += timedelta(hours=1)
+        if hour % (7 * 24) == 0:
+            report(hour // (7 * 24), archs, now)
+
+
+def parse_rates(values, default):
+    rates = dict(default)
+    for value in values or []:
+        key, _, rate = value.partition('=')
+        rates[key] = float(rate)
+    return rates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate the scheduler and the builders.')
+    parser.add_argument('--weeks', type=int, default=4,
+                        help='number of weeks to simulate')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='start from the current state of the database '
+                        'instead of a synthetic one')
+    parser.add_argument('--packages', type=int, default=30000,
+                        help='number of packages per suite and architecture '
+                        'in the synthetic state')
+    parser.add_argument('--throughput', action='append', metavar='ARCH=N',
+                        help='builds per hour on ARCH (default: the rate of '
+                        'the last day with --snapshot, else %s)' %
+                        DEFAULT_THROUGHPUT)
+    parser.add_argument('--uploads', action='append', metavar='SUITE=N',
+                        help='uploads per day to SUITE (default: %s, %s for '
+                        'the others)' % (UPLOADS, DEFAULT_UPLOADS))
+    parser.add_argument('--scheduler-interval', type=int, default=1,
+                        help='hours between two runs of the scheduler')
+    parser.add_argument('-a', '--architecture', action='append',
+                        choices=ARCHS, help='architectures to simulate '
+                        '(default: all)')
+    parser.add_argument('--seed', type=int, help='random seed, to compare '
+                        'two settings on the same uploads')
+    sim_args = parser.parse_known_args(unknown_args)[0]
+
+    random.seed(sim_args.seed)
+    start = datetime.now()
+    if sim_args.snapshot:
+        default = {arch: build_rate(arch) * 3600 for arch in ARCHS}
+    else:
+        default = DEFAULT_THROUGHPUT
+    throughput = parse_rates(sim_args.throughput, default)
+    uploads = parse_rates(sim_args.uploads, UPLOADS)
+    archs = {arch: SimArch(arch, throughput.get(arch, 1))
+             for arch in sim_args.architecture or ARCHS}
+    # the scheduler is very verbose, only keep the warnings
+    if not DEBUG:
+        log.setLevel(max(log.level, logging.WARNING))
+    if sim_args.snapshot:
+        next_id = snapshot_state(archs)
+    else:
+        next_id = synthetic_state(archs, sim_args.packages, start)
+    for arch, sim in archs.items():
+        if sim.throughput <= 0:
+            log.critical('No build throughput for %s, giving up', arch)
+            sys.exit(1)
+    simulate(archs, uploads, sim_args.weeks, sim_args.scheduler_interval,
+             next_id, start)